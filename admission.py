@@ -0,0 +1,175 @@
+import asyncio
+import math
+import os
+import time
+from collections import deque
+
+from apikey import get_total_keys
+
+# ================== 流量控制設定 ==================
+# 每位使用者同時進行中的 /chat 請求上限
+PER_USER_LIMIT = int(os.environ.get("GEMINICHAT_PER_USER_LIMIT", "2"))
+# 單一 API Key 每分鐘可承受的請求數，全域速率 = Key 數 × 此值
+KEY_RPM = float(os.environ.get("GEMINICHAT_KEY_RPM", "10"))
+# 排隊上限與最長等待秒數，超過即回 429
+MAX_QUEUE = int(os.environ.get("GEMINICHAT_MAX_QUEUE", "32"))
+QUEUE_TIMEOUT = float(os.environ.get("GEMINICHAT_QUEUE_TIMEOUT", "30"))
+# =================================================
+
+
+class AdmissionRejected(Exception):
+    """請求被拒絕（佇列已滿或等待逾時），retry_after 為建議的重試秒數。"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    /chat 的准入控制：
+    - 每位使用者的進行中請求數上限
+    - 依 Key 池大小設定的全域 token bucket
+    - 依使用者輪詢（round-robin）的有界公平佇列，等待逾時即放棄
+    只在 asyncio 事件迴圈中使用，因此不需要額外的鎖。
+    """
+
+    def __init__(
+        self,
+        per_user_limit: int,
+        rate_per_sec: float,
+        burst: float,
+        max_queue: int,
+        queue_timeout: float,
+    ):
+        self.per_user_limit = per_user_limit
+        self.rate = rate_per_sec
+        self.burst = burst
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._inflight: dict[str, int] = {}
+        self._waiting: dict[str, deque[asyncio.Future]] = {}
+        self._order: deque[str] = deque()  # 有人在排隊的使用者，輪詢順序
+        self._timer: asyncio.TimerHandle | None = None
+
+    # ----------------- 對外介面 -----------------
+
+    async def acquire(self, user: str) -> None:
+        """取得執行名額；必要時排隊，失敗時拋出 AdmissionRejected。"""
+        self._refill()
+        if not self._order and self._try_admit(user):
+            return
+
+        if self.queued() >= self.max_queue:
+            raise AdmissionRejected("伺服器忙碌中，請稍後再試", self._retry_after())
+
+        fut = asyncio.get_running_loop().create_future()
+        if user not in self._waiting:
+            self._waiting[user] = deque()
+            self._order.append(user)
+        self._waiting[user].append(fut)
+        self._pump()
+
+        try:
+            done, _ = await asyncio.wait({fut}, timeout=self.queue_timeout)
+        except BaseException:
+            # 呼叫端被取消（例如用戶端斷線）：已拿到名額就歸還，否則退出佇列
+            if fut.done() and not fut.cancelled():
+                self.release(user)
+            else:
+                self._discard(user, fut)
+            raise
+
+        if not done:
+            self._discard(user, fut)
+            raise AdmissionRejected("排隊等候逾時，請稍後再試", self._retry_after())
+
+    def release(self, user: str) -> None:
+        """歸還執行名額，並喚醒下一位排隊者。"""
+        left = self._inflight.get(user, 0) - 1
+        if left > 0:
+            self._inflight[user] = left
+        else:
+            self._inflight.pop(user, None)
+        self._pump()
+
+    def queued(self) -> int:
+        return sum(len(q) for q in self._waiting.values())
+
+    def inflight(self, user: str | None = None) -> int:
+        if user is None:
+            return sum(self._inflight.values())
+        return self._inflight.get(user, 0)
+
+    def queue_position(self, user: str) -> int:
+        """回傳使用者最早一筆排隊請求的位置（1 = 下一個），沒有排隊則回 0。"""
+        if user not in self._waiting:
+            return 0
+        # 佇列中的每位使用者至少有一筆請求，輪詢時排在前面的人各先輪到一次
+        return list(self._order).index(user) + 1
+
+    # ----------------- 內部實作 -----------------
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _try_admit(self, user: str) -> bool:
+        if self._tokens < 1 or self._inflight.get(user, 0) >= self.per_user_limit:
+            return False
+        self._tokens -= 1
+        self._inflight[user] = self._inflight.get(user, 0) + 1
+        return True
+
+    def _pump(self) -> None:
+        """依輪詢順序放行排隊者，直到 token 用完或沒有可放行的人。"""
+        self._refill()
+        progressed = True
+        while self._order and progressed and self._tokens >= 1:
+            progressed = False
+            for _ in range(len(self._order)):
+                user = self._order[0]
+                self._order.rotate(-1)
+                if not self._try_admit(user):
+                    continue
+                queue = self._waiting[user]
+                queue.popleft().set_result(None)
+                if not queue:
+                    del self._waiting[user]
+                    self._order.remove(user)
+                progressed = True
+                break
+
+        # token 不足但仍有人排隊：等下一個 token 產生時再放行
+        if self._order and self._tokens < 1 and self._timer is None:
+            delay = (1 - self._tokens) / self.rate
+            self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._pump()
+
+    def _discard(self, user: str, fut: asyncio.Future) -> None:
+        queue = self._waiting.get(user)
+        if queue and fut in queue:
+            queue.remove(fut)
+            if not queue:
+                del self._waiting[user]
+                self._order.remove(user)
+        fut.cancel()
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil((self.queued() + 1) / self.rate))
+
+
+admission = AdmissionController(
+    per_user_limit=PER_USER_LIMIT,
+    rate_per_sec=get_total_keys() * KEY_RPM / 60,
+    burst=max(1, get_total_keys()),
+    max_queue=MAX_QUEUE,
+    queue_timeout=QUEUE_TIMEOUT,
+)
@@ -0,0 +1,244 @@
+import hashlib
+import logging
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import BinaryIO
+
+from google.genai import types
+from google.genai.types import Part
+
+from database import (
+    APP_DIR,
+    add_attachment,
+    delete_unreferenced_attachment,
+    get_attachment_upload,
+    list_unreferenced_attachments,
+    save_attachment_upload,
+)
+
+try:  # 縮圖為選用功能，沒有安裝 Pillow 時直接略過
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# ================== 附件設定 ==================
+# 內容定址儲存：attachments/<sha 前兩碼>/<sha256>
+ATTACH_DIR = os.path.join(APP_DIR, "attachments")
+THUMB_DIR = os.path.join(ATTACH_DIR, "thumbs")
+os.makedirs(THUMB_DIR, exist_ok=True)
+
+MAX_ATTACHMENT_BYTES = int(os.environ.get("GEMINICHAT_MAX_ATTACHMENT_MB", "50")) * 1024 * 1024
+COPY_CHUNK = 1024 * 1024
+THUMB_SIZE = (256, 256)
+# Gemini Files API 的檔案 48 小時後過期，提早一小時重新上傳
+UPLOAD_TTL = 47 * 60 * 60
+# 沒有被任何訊息引用的附件保留時間（例如上傳後請求失敗）
+ORPHAN_GRACE = timedelta(days=1)
+
+# 圖片只收點陣格式（SVG 可以內嵌腳本）；文字檔一律以 text/plain 回傳
+RASTER_IMAGE_TYPES = {
+    "image/png",
+    "image/jpeg",
+    "image/gif",
+    "image/webp",
+    "image/heic",
+    "image/heif",
+}
+ALLOWED_PREFIXES = ("text/",)
+ALLOWED_TYPES = RASTER_IMAGE_TYPES | {"application/pdf", "application/json"}
+# 可以在瀏覽器直接顯示的類型；其餘一律下載
+INLINE_TYPES = {"image/png", "image/jpeg", "image/gif", "image/webp", "text/plain"}
+# 附件回應的安全標頭：不讓瀏覽器猜測類型，也不執行任何腳本
+SERVE_HEADERS = {
+    "X-Content-Type-Options": "nosniff",
+    "Content-Security-Policy": "default-src 'none'; img-src 'self'; style-src 'unsafe-inline'; sandbox",
+    "Cache-Control": "private, max-age=86400",
+}
+# 儲存去重與清理之間的鎖（依 sha 分段，不必為每個檔案建立一把鎖）
+LOCK_STRIPES = 64
+# =================================================
+
+_sha_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+_thumb_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="thumbnail")
+
+
+class AttachmentError(ValueError):
+    """附件格式或大小不符合限制，status_code 為回應用的 HTTP 狀態碼"""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def blob_path(sha256: str) -> str:
+    return os.path.join(ATTACH_DIR, sha256[:2], sha256)
+
+
+def thumb_path(sha256: str) -> str:
+    return os.path.join(THUMB_DIR, f"{sha256}.webp")
+
+
+def _guess_mime(filename: str, declared: str | None) -> str:
+    mime = declared or ""
+    if not mime or mime == "application/octet-stream":
+        mime = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    return mime
+
+
+def _sha_lock(sha256: str) -> threading.Lock:
+    return _sha_locks[int(sha256[:4], 16) % LOCK_STRIPES]
+
+
+def is_allowed(mime_type: str) -> bool:
+    return mime_type in ALLOWED_TYPES or mime_type.startswith(ALLOWED_PREFIXES)
+
+
+def serve_as(mime_type: str) -> tuple[str, str]:
+    """
+    附件回傳給瀏覽器時的 (Content-Type, Content-Disposition 類型)。
+    文字檔一律當純文字，能內嵌的只有點陣圖與純文字，其餘（PDF、JSON、舊資料中的
+    HTML / SVG）都以下載方式回傳，不會在本站網域下被當成頁面執行。
+    """
+    if mime_type.startswith("text/"):
+        mime_type = "text/plain; charset=utf-8"
+    if mime_type.split(";")[0] in INLINE_TYPES:
+        return mime_type, "inline"
+    return mime_type, "attachment"
+
+
+def store_upload(fileobj: BinaryIO, filename: str, content_type: str | None) -> dict:
+    """
+    以固定大小區塊把上傳內容串流寫到磁碟，同時計算 sha256；
+    內容已存在時直接沿用（去重），整個檔案不會一次讀進記憶體。
+    """
+    mime = _guess_mime(filename, content_type)
+    if not is_allowed(mime):
+        raise AttachmentError(f"不支援的檔案類型：{mime}", 415)
+
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp = tempfile.mkstemp(dir=ATTACH_DIR, prefix=".upload-")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while chunk := fileobj.read(COPY_CHUNK):
+                size += len(chunk)
+                if size > MAX_ATTACHMENT_BYTES:
+                    raise AttachmentError(
+                        f"檔案超過 {MAX_ATTACHMENT_BYTES // (1024 * 1024)} MB 上限：{filename}",
+                        413,
+                    )
+                digest.update(chunk)
+                out.write(chunk)
+
+        sha = digest.hexdigest()
+        dest = blob_path(sha)
+        # 確認檔案存在到更新 last_stored_at 之間不能被清理插隊刪掉
+        with _sha_lock(sha):
+            if os.path.exists(dest):
+                os.remove(tmp)
+            else:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                os.replace(tmp, dest)
+            record = add_attachment(sha, mime, size, os.path.basename(filename) or sha[:12])
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+    schedule_thumbnail(record)
+    return record
+
+
+# ----------------- 縮圖 -----------------
+
+
+def _make_thumbnail(sha256: str) -> None:
+    dest = thumb_path(sha256)
+    if os.path.exists(dest):
+        return
+    with Image.open(blob_path(sha256)) as img:
+        img.draft("RGB", THUMB_SIZE)  # JPEG 直接以較低解析度解碼，省記憶體
+        img.thumbnail(THUMB_SIZE)
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA")
+        tmp = dest + ".tmp"
+        img.save(tmp, "WEBP", quality=80)
+    os.replace(tmp, dest)
+
+
+def _log_thumbnail_error(future) -> None:
+    if future.exception():
+        logging.warning(f"縮圖產生失敗：{future.exception()}")
+
+
+def schedule_thumbnail(record: dict) -> None:
+    """在背景執行緒池產生圖片縮圖，不阻塞請求"""
+    if Image is None or record["mime_type"] not in RASTER_IMAGE_TYPES:
+        return
+    if os.path.exists(thumb_path(record["sha256"])):
+        return
+    _thumb_pool.submit(_make_thumbnail, record["sha256"]).add_done_callback(
+        _log_thumbnail_error
+    )
+
+
+# ----------------- Gemini 檔案控制代碼 -----------------
+
+
+def key_fingerprint(api_key: str) -> str:
+    """上傳的檔案只屬於該 API Key 的專案；資料庫只存 Key 的雜湊"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+def gemini_part(client, api_key: str, record: dict) -> Part:
+    """
+    取得附件的 Part：該 Key 已上傳且未過期就沿用檔案 URI，
+    否則上傳一次並記錄，之後每一輪對話都不必重送檔案內容。
+    """
+    fp = key_fingerprint(api_key)
+    upload = get_attachment_upload(record["sha256"], fp)
+    if upload is None:
+        uploaded = client.files.upload(
+            file=blob_path(record["sha256"]),
+            config=types.UploadFileConfig(
+                mime_type=record["mime_type"], display_name=record["filename"]
+            ),
+        )
+        expires_at = time.time() + UPLOAD_TTL
+        if uploaded.expiration_time:
+            expires_at = min(expires_at, uploaded.expiration_time.timestamp() - 3600)
+        save_attachment_upload(record["sha256"], fp, uploaded.name, uploaded.uri, expires_at)
+        upload = {"file_uri": uploaded.uri}
+    return Part.from_uri(file_uri=upload["file_uri"], mime_type=record["mime_type"])
+
+
+# ----------------- 清理 -----------------
+
+
+def purge_orphans() -> int:
+    """
+    刪除沒有被任何訊息引用的附件檔案與縮圖。
+    每個附件在 sha 鎖內重新確認後才刪，與同時間去重到同一檔案的上傳互斥；
+    剛上傳、還沒連結到訊息的附件有 ORPHAN_GRACE 的寬限期（從 last_stored_at 起算）。
+    """
+    cutoff = (datetime.utcnow() - ORPHAN_GRACE).isoformat()
+    purged = 0
+    for sha in list_unreferenced_attachments(cutoff):
+        with _sha_lock(sha):
+            if not delete_unreferenced_attachment(sha, cutoff):
+                continue
+            for path in (blob_path(sha), thumb_path(sha)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        purged += 1
+    if purged:
+        logging.info(f"已清除 {purged} 個未被引用的附件")
+    return purged
@@ -0,0 +1,336 @@
+"""
+批次提示工具：把 JSONL 檔中的提示分散到所有 API Key 並行執行。
+
+輸入每行一個 JSON 物件：
+    {"prompt": "翻譯成英文：你好", "id": "greet-1", "model": "...", "system": "..."}
+只有 prompt 是必填；id 會原樣帶到輸出，model / system 可逐筆覆寫預設值。
+
+進度逐筆寫入 SQLite（batch_jobs / batch_items），當機或中斷後用 resume 接續，
+已完成的項目不會重跑。輸出為 JSONL，每完成一筆就寫一行（順序為完成順序，
+可用 seq 欄位還原輸入順序）。
+
+用法：
+    python batch.py run prompts.jsonl --model gemini-2.5-flash [-o out.jsonl]
+    python batch.py resume <job_id> [--retry-failed]
+    python batch.py list
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+from google.genai.types import Content, Part
+
+import gemini_client
+from apikey import API_KEYS
+from database import (
+    create_batch_job,
+    finish_batch_item,
+    finish_batch_job,
+    get_batch_job,
+    init_db,
+    list_batch_jobs,
+    load_batch_items,
+    reset_failed_batch_items,
+)
+
+# ================== 批次設定 ==================
+# 每把 Key 同時進行的請求數；總並行數 = Key 數 × 此值
+PER_KEY_CONCURRENCY = int(os.environ.get("GEMINICHAT_BATCH_PER_KEY", "2"))
+# 單筆最多嘗試次數（429 / 5xx / 連線錯誤才會重試）
+MAX_ATTEMPTS = int(os.environ.get("GEMINICHAT_BATCH_MAX_ATTEMPTS", "4"))
+# Key 被限流後的退避秒數（指數成長，加上隨機抖動）
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 60.0
+PROGRESS_INTERVAL = 10.0
+# =================================================
+
+
+class _KeySlot:
+    """一把 API Key 的狀態：被限流時整把 Key 暫停，認證失敗則停用"""
+
+    def __init__(self, index: int, api_key: str, pool):
+        self.index = index
+        self.client = gemini_client.client_for(api_key, pool)
+        self.cooldown_until = 0.0
+        self.failures = 0
+        self.disabled = False
+        self.lock = threading.Lock()
+
+    def backoff(self) -> None:
+        with self.lock:
+            self.failures += 1
+            delay = min(BACKOFF_MAX, BACKOFF_BASE ** self.failures)
+            self.cooldown_until = time.monotonic() + delay * random.uniform(0.5, 1.0)
+
+    def succeeded(self) -> None:
+        with self.lock:
+            self.failures = 0
+
+
+def _classify(err: Exception) -> str:
+    """retry：可重試（限流、伺服器錯誤、網路）；key：這把 Key 不能用；fatal：提示本身有問題"""
+    code = getattr(err, "code", None)
+    if code in (401, 403):
+        return "key"
+    if code is None or code == 429 or code >= 500:
+        return "retry"
+    return "fatal"
+
+
+class _Sink:
+    """先寫入 SQLite 再輸出一行 JSONL；兩者在同一把鎖內，輸出不會交錯"""
+
+    def __init__(self, job_id: int, out):
+        self.job_id = job_id
+        self.out = out
+        self.lock = threading.Lock()
+        self.done = 0
+        self.failed = 0
+
+    def write_line(self, item: dict) -> None:
+        line = {
+            "seq": item["seq"],
+            "id": item["custom_id"],
+            "status": "ok" if item["status"] == "done" else "error",
+            "text": item["result"],
+            "error": item["error"],
+            "latency_ms": item["latency_ms"],
+        }
+        self.out.write(json.dumps(line, ensure_ascii=False) + "\n")
+        self.out.flush()
+
+    def record(self, item: dict, status: str, **fields) -> None:
+        item.update(status=status, **fields)
+        with self.lock:
+            finish_batch_item(
+                self.job_id,
+                item["seq"],
+                status,
+                item["attempts"],
+                result=item.get("result"),
+                error=item.get("error"),
+                latency_ms=item.get("latency_ms"),
+            )
+            self.write_line(item)
+            if status == "done":
+                self.done += 1
+            else:
+                self.failed += 1
+
+
+def _contents(item: dict) -> list[Content]:
+    contents = []
+    if item["system"]:
+        contents.append(Content(role="user", parts=[Part(text=item["system"])]))
+    contents.append(Content(role="user", parts=[Part(text=item["prompt"])]))
+    return contents
+
+
+def _run_items(job: dict, items: list[dict], sink: _Sink, per_key: int) -> bool:
+    """執行所有 pending 項目；全部結束回傳 True，所有 Key 都不可用時回傳 False"""
+    pending: queue.Queue = queue.Queue()
+    for item in items:
+        pending.put(item)
+    remaining = len(items)
+    remaining_lock = threading.Lock()
+    stop = threading.Event()
+
+    # 批次專用的連線池，大小至少要容納所有工作執行緒，否則會卡在等連線
+    pool = gemini_client.open_pool(max(gemini_client.MAX_CONNECTIONS, len(API_KEYS) * per_key))
+    slots = [_KeySlot(i, key, pool) for i, key in enumerate(API_KEYS)]
+
+    def _settle() -> None:
+        nonlocal remaining
+        with remaining_lock:
+            remaining -= 1
+            if remaining == 0:
+                stop.set()
+
+    def _worker(slot: _KeySlot) -> None:
+        while not stop.is_set() and not slot.disabled:
+            wait = slot.cooldown_until - time.monotonic()
+            if wait > 0:
+                stop.wait(wait)
+                continue
+            try:
+                item = pending.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            model = item["model"] or job["model"]
+            start = time.perf_counter()
+            try:
+                # 不經過 completion_cache：single-flight 的鍵不含 API Key，
+                # 重複的提示會合併到另一把 Key 的呼叫，連它的 401 / 429 一起被算到這把 Key 頭上
+                res = slot.client.models.generate_content(model=model, contents=_contents(item))
+            except Exception as e:
+                kind = _classify(e)
+                if kind == "key":
+                    logging.warning(f"第 {slot.index + 1} 組 API Key 無法使用，停用：{e}")
+                    slot.disabled = True
+                    pending.put(item)
+                    if all(s.disabled for s in slots):
+                        stop.set()
+                    return
+                item["attempts"] += 1
+                if kind == "retry" and item["attempts"] < MAX_ATTEMPTS:
+                    slot.backoff()
+                    pending.put(item)
+                    continue
+                sink.record(item, "failed", error=str(e))
+                _settle()
+                continue
+
+            item["attempts"] += 1
+            slot.succeeded()
+            sink.record(
+                item,
+                "done",
+                result=res.text,
+                error=None,
+                latency_ms=int((time.perf_counter() - start) * 1000),
+            )
+            _settle()
+
+    threads = [
+        threading.Thread(target=_worker, args=(slot,), name=f"batch-key{slot.index}", daemon=True)
+        for slot in slots
+        for _ in range(per_key)
+    ]
+    for t in threads:
+        t.start()
+
+    started = time.monotonic()
+    total = len(items)
+    try:
+        while not stop.wait(PROGRESS_INTERVAL):
+            finished = sink.done + sink.failed
+            elapsed = time.monotonic() - started
+            logging.info(
+                f"進度 {finished}/{total}（失敗 {sink.failed}），"
+                f"{finished / elapsed * 60:.1f} 筆/分鐘"
+            )
+    except KeyboardInterrupt:
+        # 進行中的項目維持 pending，resume 時會重跑
+        logging.warning("已中斷，等待進行中的請求結束...")
+        stop.set()
+        raise
+    finally:
+        for t in threads:
+            t.join()
+        pool.shutdown()
+    return remaining == 0
+
+
+def _read_input(path: str):
+    """逐行解析輸入檔，產生 (custom_id, model, system, prompt)"""
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                obj = json.loads(line)
+                prompt = obj["prompt"]
+            except (ValueError, KeyError, TypeError):
+                raise SystemExit(f"{path} 第 {lineno} 行格式錯誤：需要含 prompt 欄位的 JSON 物件")
+            custom_id = obj.get("id")
+            yield (
+                None if custom_id is None else str(custom_id),
+                obj.get("model"),
+                obj.get("system"),
+                prompt,
+            )
+
+
+def execute(job_id: int, per_key: int = PER_KEY_CONCURRENCY) -> bool:
+    job = get_batch_job(job_id)
+    if job is None:
+        raise SystemExit(f"找不到批次工作 {job_id}")
+    items = load_batch_items(job_id, ("pending",))
+    out = sys.stdout if job["output_path"] == "-" else open(job["output_path"], "w", encoding="utf-8")
+    sink = _Sink(job_id, out)
+    try:
+        # 輸出以資料庫為準：接續執行時先依 seq 重寫已完成的項目再附加新結果，
+        # 當機發生在「寫入資料庫」與「寫入檔案」之間也不會重複或遺漏
+        if out is not sys.stdout:
+            for item in load_batch_items(job_id, ("done", "failed")):
+                sink.write_line(item)
+
+        logging.info(
+            f"批次工作 {job_id}：{len(items)} 筆待執行，"
+            f"{len(API_KEYS)} 組 Key × 每組 {per_key} 個並行"
+        )
+        started = time.monotonic()
+        complete = _run_items(job, items, sink, per_key) if items else True
+        elapsed = time.monotonic() - started
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    if complete:
+        finish_batch_job(job_id)
+    logging.info(
+        f"批次工作 {job_id} {'完成' if complete else '未完成（Key 全數停用）'}："
+        f"成功 {sink.done}、失敗 {sink.failed}，耗時 {elapsed:.1f} 秒"
+    )
+    return complete
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="GeminiChat 批次提示工具")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run = sub.add_parser("run", help="建立並執行新的批次工作")
+    run.add_argument("input", help="輸入 JSONL 檔")
+    run.add_argument("--model", required=True, help="預設模型")
+    run.add_argument("-o", "--output", help="輸出 JSONL 檔（- 為標準輸出），預設 <輸入檔名>.out.jsonl")
+    run.add_argument("--per-key", type=int, default=PER_KEY_CONCURRENCY, help="每組 Key 的並行數")
+
+    resume = sub.add_parser("resume", help="接續未完成的批次工作")
+    resume.add_argument("job_id", type=int)
+    resume.add_argument("--retry-failed", action="store_true", help="失敗的項目也重新執行")
+    resume.add_argument("--per-key", type=int, default=PER_KEY_CONCURRENCY, help="每組 Key 的並行數")
+
+    sub.add_parser("list", help="列出最近的批次工作")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s", stream=sys.stderr)
+    init_db()
+
+    if args.command == "list":
+        for j in list_batch_jobs():
+            state = "完成" if j["finished_at"] else "未完成"
+            print(
+                f"#{j['id']}  {state}  {j['done']}/{j['total']}（失敗 {j['failed']}）"
+                f"  {j['model']}  {j['input_path']}  {j['created_at']}"
+            )
+        return 0
+
+    if args.command == "run":
+        output = args.output or os.path.splitext(args.input)[0] + ".out.jsonl"
+        if output != "-":
+            output = os.path.abspath(output)
+        job_id = create_batch_job(
+            os.path.abspath(args.input), output, args.model, _read_input(args.input)
+        )
+        logging.info(f"已建立批次工作 {job_id}，中斷後可用 `python batch.py resume {job_id}` 接續")
+    else:
+        job_id = args.job_id
+        if args.retry_failed:
+            logging.info(f"重新排入 {reset_failed_batch_items(job_id)} 筆失敗項目")
+
+    try:
+        return 0 if execute(job_id, args.per_key) else 1
+    finally:
+        gemini_client.shutdown()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import os
+import secrets
+import time
+
+from google.genai import types
+from starlette.concurrency import run_in_threadpool
+
+import completion_cache
+import gemini_client
+import model_router
+from admission import AdmissionRejected, admission
+
+# ================== 比較模式設定 ==================
+MAX_MODELS = int(os.environ.get("GEMINICHAT_COMPARE_MAX_MODELS", "4"))
+# 超過截止時間還沒回覆的模型直接放棄（秒）
+DEADLINE = float(os.environ.get("GEMINICHAT_COMPARE_DEADLINE", "60"))
+# 比較結果在記憶體中保留多久，逾時就無法再採用（秒）
+RUN_TTL = 10 * 60
+# =================================================
+
+
+class CompareRun:
+    """
+    一次比較：同一個 thread 同時送給多個模型，各模型一個 asyncio.Task。
+    每個模型各自向准入控制取得一個名額，呼叫結束才歸還；
+    trackers 用來在丟棄比較時從連線層中止還在進行的呼叫。
+    parent_id 是建立 thread 時的分支末端，採用的回答接在它之後。
+    """
+
+    def __init__(
+        self,
+        admission_user: str,
+        user_id: int,
+        conversation_id: int,
+        user_input: str,
+        attachments: list[dict],
+        models: list[str],
+        parent_id: int | None = None,
+    ):
+        self.id = secrets.token_urlsafe(9)
+        self.admission_user = admission_user
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.user_input = user_input
+        self.attachments = attachments
+        self.models = models
+        self.parent_id = parent_id
+        self.created = time.monotonic()
+        self.deadline = self.created + DEADLINE
+        self.tasks: list[asyncio.Task] = []
+        self.trackers = [gemini_client.RequestTracker() for _ in models]
+
+
+_runs: dict[str, CompareRun] = {}
+
+
+def _generate(client, model: str, thread: list, config, tracker) -> object:
+    with gemini_client.closing_responses(tracker):
+        return completion_cache.generate_content(client, model, thread, config=config)
+
+
+async def _call_model(run: CompareRun, index: int, client, thread: list) -> dict:
+    """
+    取得准入名額後呼叫單一模型並記錄延遲 / token 用量。截止時間同時涵蓋排隊等待，
+    剩餘時間也設成 HTTP 逾時，執行緒池裡的請求會在截止時確實中斷。
+    """
+    model, tracker = run.models[index], run.trackers[index]
+    result = {"model": model, "status": "ok", "text": None, "error": None}
+    start = time.perf_counter()
+    try:
+        await asyncio.wait_for(
+            admission.acquire(run.admission_user), max(run.deadline - time.monotonic(), 0.01)
+        )
+    except asyncio.TimeoutError:
+        result.update(status="timeout", latency_ms=int((time.perf_counter() - start) * 1000))
+        result["error"] = f"超過 {DEADLINE:.0f} 秒仍在排隊"
+        return result
+    except AdmissionRejected as e:
+        result.update(status="busy", error=str(e), latency_ms=0)
+        return result
+
+    try:
+        remaining = max(run.deadline - time.monotonic(), 1.0)
+        config = types.GenerateContentConfig(
+            http_options=types.HttpOptions(timeout=int(remaining * 1000))
+        )
+        try:
+            res = await asyncio.wait_for(
+                run_in_threadpool(_generate, client, model, thread, config, tracker),
+                remaining,
+            )
+            usage = res.usage_metadata
+            result.update(
+                text=res.text or "",
+                prompt_tokens=usage.prompt_token_count if usage else None,
+                output_tokens=usage.candidates_token_count if usage else None,
+            )
+        except asyncio.TimeoutError:
+            tracker.cancel()
+            result.update(status="timeout")
+        except Exception as e:
+            if tracker.cancelled:
+                raise asyncio.CancelledError from e
+            logging.warning(f"比較模式：模型 {model} 呼叫失敗：{e}")
+            result.update(status=model_router.classify_error(e), error=str(e))
+        if result["status"] == "timeout":
+            result["error"] = f"超過 {DEADLINE:.0f} 秒未回覆"
+        result["latency_ms"] = int((time.perf_counter() - start) * 1000)
+
+        await run_in_threadpool(
+            model_router.observe,
+            model,
+            "compare",
+            result["status"],
+            result["latency_ms"],
+            result.get("prompt_tokens") or model_router.thread_tokens(thread),
+            result.get("output_tokens"),
+        )
+        return result
+    finally:
+        admission.release(run.admission_user)
+
+
+def _expire() -> None:
+    now = time.monotonic()
+    for run_id in [rid for rid, run in _runs.items() if now - run.created > RUN_TTL]:
+        discard_run(run_id)
+
+
+def start_run(
+    client,
+    admission_user: str,
+    user_id: int,
+    conversation_id: int,
+    user_input: str,
+    attachments: list[dict],
+    models: list[str],
+    thread: list,
+    parent_id: int | None = None,
+) -> CompareRun:
+    """立即對所有模型發出請求；窗格之後再各自等待自己的結果"""
+    _expire()
+    run = CompareRun(
+        admission_user, user_id, conversation_id, user_input, attachments, models, parent_id
+    )
+    run.tasks = [
+        asyncio.create_task(_call_model(run, index, client, thread)) for index in range(len(models))
+    ]
+    _runs[run.id] = run
+    return run
+
+
+def get_run(run_id: str, user_id: int | None) -> CompareRun | None:
+    run = _runs.get(run_id)
+    if run is None or run.user_id != user_id:
+        return None
+    return run
+
+
+async def wait_result(run: CompareRun, index: int) -> dict:
+    # shield：窗格請求被取消（使用者離開頁面）時不要連帶取消模型呼叫
+    try:
+        return await asyncio.shield(run.tasks[index])
+    except asyncio.CancelledError:
+        if not run.tasks[index].cancelled():
+            raise  # 是窗格請求本身被取消
+        return {
+            "model": run.models[index],
+            "status": "cancelled",
+            "text": None,
+            "error": "比較已結束",
+            "latency_ms": 0,
+        }
+
+
+def discard_run(run_id: str) -> CompareRun | None:
+    """
+    移除比較並中止還在進行的模型呼叫：關閉其 HTTP 連線（上游不再產生、不再耗用配額）
+    並取消對應的 task。回傳被移除的比較；已不存在時回傳 None，
+    呼叫端可據此確保同一次比較只被採用一次。
+    """
+    run = _runs.pop(run_id, None)
+    if run:
+        for task, tracker in zip(run.tasks, run.trackers):
+            if not task.done():
+                tracker.cancel()
+                task.cancel()
+    return run
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, wait
+from typing import Any, Callable
+
+# ================== 快取設定 ==================
+CACHE_MAX_ENTRIES = int(os.environ.get("GEMINICHAT_CACHE_MAX_ENTRIES", "512"))
+# 標題、模型探測等可重複使用的回應預設保留秒數
+TITLE_CACHE_TTL = float(os.environ.get("GEMINICHAT_TITLE_CACHE_TTL", "3600"))
+PROBE_CACHE_TTL = float(os.environ.get("GEMINICHAT_PROBE_CACHE_TTL", "600"))
+# 等待其他呼叫的結果時，每隔多久檢查一次自己是否已被中止（秒）
+FOLLOWER_POLL = 0.1
+# =================================================
+
+
+def _jsonable(item: Any) -> Any:
+    """Content / Part 等 pydantic 物件轉成可序列化的 dict，dict 原樣保留"""
+    if hasattr(item, "model_dump"):
+        return item.model_dump(mode="json", exclude_none=True)
+    return item
+
+
+def request_key(model: str, contents: list, config: Any = None) -> str:
+    """以 (model, 完整 contents, config) 計算請求雜湊"""
+    body = [model, [_jsonable(c) for c in contents]]
+    if config is not None:
+        body.append(_jsonable(config))
+    payload = json.dumps(
+        body,
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Abandoned(Exception):
+    """等待其他呼叫的結果時，自己先被中止了"""
+
+
+class SingleFlight:
+    """相同 key 的並行呼叫只實際執行一次，其餘呼叫等待並共用結果（含例外）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[str, Future] = {}
+
+    def do(self, key: str, fn: Callable[[], Any], stop: threading.Event | None = None) -> Any:
+        """
+        stop 被設定時，等待中的呼叫不再等下去，拋出 Abandoned
+        （帶頭執行 fn 的呼叫不受影響，由 fn 自己處理中止）。
+        """
+        with self._lock:
+            fut = self._calls.get(key)
+            leader = fut is None
+            if leader:
+                fut = Future()
+                self._calls[key] = fut
+
+        if not leader:
+            if stop is None:
+                return fut.result()
+            while not wait([fut], timeout=FOLLOWER_POLL).done:
+                if stop.is_set():
+                    raise Abandoned(key)
+            return fut.result()
+
+        try:
+            fut.set_result(fn())
+        except BaseException as e:
+            fut.set_exception(e)
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+        return fut.result()
+
+
+class TTLCache:
+    """有存活時間與容量上限（LRU 淘汰）的回應快取"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+_flight = SingleFlight()
+_cache = TTLCache(CACHE_MAX_ENTRIES)
+
+
+def generate_content(
+    client, model: str, contents: list, cache_ttl: float | None = None, config: Any = None
+):
+    """
+    呼叫 client.models.generate_content，並：
+    - 合併同時進行中的相同請求（single-flight）
+    - cache_ttl 有值時，成功結果寫入快取，TTL 內的相同請求直接回傳
+    只有冪等的提示（標題、模型探測）才應該傳入 cache_ttl。
+    """
+    key = request_key(model, contents, config)
+    if cache_ttl:
+        cached = _cache.get(key)
+        if cached is not None:
+            return cached
+
+    res = _flight.do(
+        key,
+        lambda: client.models.generate_content(model=model, contents=contents, config=config),
+    )
+    if cache_ttl:
+        _cache.set(key, res, cache_ttl)
+    return res
+
+
+def single_flight(key: str, fn: Callable[[], Any], stop: threading.Event | None = None) -> Any:
+    """
+    以 key 合併同時進行中的相同工作（不寫入快取）；
+    給不經過 generate_content 的呼叫使用，例如串流回覆。
+    等待別人的結果期間 stop 被設定時拋出 Abandoned。
+    """
+    return _flight.do(key, fn, stop)
+
+
+def is_cached(model: str, contents: list, config: Any = None) -> bool:
+    """相同請求目前是否有未過期的快取結果"""
+    return _cache.get(request_key(model, contents, config)) is not None
+
+
+def clear() -> None:
+    """清空回應快取（例如切換 API Key 後，探測結果不再可信）"""
+    _cache.clear()
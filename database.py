@@ -1,7 +1,12 @@
+import json
 import os
 import sqlite3
+import threading
+import time
 from datetime import datetime
 
+import message_codec
+
 # ================== 路徑設定 ==================
 # 使用者家目錄 (自動抓 C:\Users\<username>\)
 USER_HOME = os.path.expanduser("~")
@@ -12,14 +17,116 @@ os.makedirs(APP_DIR, exist_ok=True)
 
 # DB 檔案路徑
 DB_PATH = os.path.join(APP_DIR, "chat_data.db")
+# 其他連線持有寫入鎖時的最長等待秒數
+BUSY_TIMEOUT = 30
 # =================================================
 
 
+# 訊息表結構（刪除會話時以外鍵 ON DELETE CASCADE 連帶刪除訊息）
+# 訊息以 parent_id 串成樹：分支共用相同的前段，不複製訊息。
+# parent_id 刻意不設外鍵：連鎖刪除會沿整條對話遞迴，長對話會超過 SQLite 的觸發深度上限；
+# 訊息本來就是整個會話一起清除
+MESSAGES_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        conversation_id INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        text TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        codec INTEGER NOT NULL DEFAULT 0,
+        zdict_id INTEGER,
+        parent_id INTEGER,
+        FOREIGN KEY(conversation_id) REFERENCES conversations(id) ON DELETE CASCADE
+    )
+"""
+
+
+def get_connection() -> sqlite3.Connection:
+    """
+    開啟資料庫連線；WAL 模式下讀寫互不阻塞，寫入衝突時最多等待 BUSY_TIMEOUT 秒。
+    SQLite 的外鍵檢查是每條連線各自開啟的。
+    """
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT)
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+
+def _column_names(cursor: sqlite3.Cursor, table: str) -> list[str]:
+    return [row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def _migrate_messages_cascade(cursor: sqlite3.Cursor) -> None:
+    """
+    舊版 messages 表的外鍵沒有 ON DELETE CASCADE，SQLite 無法直接修改外鍵，
+    只能以新結構重建表格並搬移資料（只做一次）。
+    """
+    fks = cursor.execute("PRAGMA foreign_key_list(messages)").fetchall()
+    # foreign_key_list 欄位：id, seq, table, from, to, on_update, on_delete, match
+    if all(fk[6] == "CASCADE" for fk in fks if fk[2] == "conversations"):
+        return
+
+    cursor.execute("PRAGMA foreign_keys = OFF")
+    cursor.execute("BEGIN")
+    cursor.execute(MESSAGES_SCHEMA.format(name="messages_new"))
+    new_cols = _column_names(cursor, "messages_new")
+    cols = ", ".join(c for c in _column_names(cursor, "messages") if c in new_cols)
+    # 順便清掉所屬會話早已不存在的孤兒訊息
+    cursor.execute(
+        f"""
+        INSERT INTO messages_new ({cols})
+        SELECT {cols} FROM messages
+        WHERE conversation_id IN (SELECT id FROM conversations)
+        """
+    )
+    cursor.execute("DROP TABLE messages")
+    cursor.execute("ALTER TABLE messages_new RENAME TO messages")
+    cursor.execute("COMMIT")
+    cursor.execute("PRAGMA foreign_keys = ON")
+
+
+def _migrate_message_tree(cursor: sqlite3.Cursor) -> None:
+    """
+    舊版訊息是每個會話一條直線：補上 parent_id（前一則訊息）與
+    conversations.active_leaf_id（最後一則訊息），之後就能在任一則分岔。
+    """
+    if "active_leaf_id" in _column_names(cursor, "conversations"):
+        return
+    cursor.execute("BEGIN")
+    if "parent_id" not in _column_names(cursor, "messages"):
+        cursor.execute("ALTER TABLE messages ADD COLUMN parent_id INTEGER")
+    cursor.execute("ALTER TABLE conversations ADD COLUMN active_leaf_id INTEGER")
+    # 以 (conversation_id, id) 索引找出同會話的前一則訊息
+    cursor.execute(
+        """
+        UPDATE messages SET parent_id = (
+            SELECT MAX(p.id) FROM messages p
+            WHERE p.conversation_id = messages.conversation_id AND p.id < messages.id
+        )
+        """
+    )
+    cursor.execute(
+        """
+        UPDATE conversations SET active_leaf_id = (
+            SELECT MAX(m.id) FROM messages m WHERE m.conversation_id = conversations.id
+        )
+        """
+    )
+    cursor.execute("COMMIT")
+
+
 def init_db():
-    """初始化資料庫，建立 users / conversations / messages 表格（如果不存在）。"""
-    conn = sqlite3.connect(DB_PATH)
+    """初始化資料庫，建立 users / conversations / messages / sessions 表格（如果不存在）。"""
+    conn = get_connection()
     cursor = conn.cursor()
 
+    # 增量 vacuum 只能在建立第一個表格之前直接設定；
+    # 既有資料庫需要一次完整 VACUUM，由 `python maintenance.py vacuum` 手動執行，啟動時不做
+    if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        if cursor.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone() is None:
+            cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    # WAL：背景維護（清理、vacuum）進行時不阻塞一般讀寫
+    cursor.execute("PRAGMA journal_mode = WAL")
+
     # 使用者表
     cursor.execute(
         """
@@ -43,16 +150,224 @@ def init_db():
         """
     )
 
+    # 軟刪除：刪除會話只標記 deleted_at，訊息由背景清理分批刪除
+    if "deleted_at" not in _column_names(cursor, "conversations"):
+        cursor.execute("ALTER TABLE conversations ADD COLUMN deleted_at TEXT")
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_conversations_deleted
+        ON conversations(deleted_at) WHERE deleted_at IS NOT NULL
+        """
+    )
+
     # 訊息表
+    cursor.execute(MESSAGES_SCHEMA.format(name="messages"))
+    conn.commit()
+    _migrate_messages_cascade(cursor)
+
+    # 訊息內容壓縮：codec 0 = 原文，1 = deflate BLOB（zdict_id 為使用的共用字典）
+    message_cols = _column_names(cursor, "messages")
+    if "codec" not in message_cols:
+        cursor.execute("ALTER TABLE messages ADD COLUMN codec INTEGER NOT NULL DEFAULT 0")
+    if "zdict_id" not in message_cols:
+        cursor.execute("ALTER TABLE messages ADD COLUMN zdict_id INTEGER")
     cursor.execute(
         """
-        CREATE TABLE IF NOT EXISTS messages (
+        CREATE TABLE IF NOT EXISTS zdicts (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
+            data BLOB NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        """
+    )
+
+    # 依會話分頁載入訊息用的索引（keyset：conversation_id + id）
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_messages_conversation
+        ON messages(conversation_id, id)
+        """
+    )
+
+    # 分支：找子訊息（兄弟訊息、切換分支）用的索引
+    _migrate_message_tree(cursor)
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_messages_parent
+        ON messages(parent_id)
+        """
+    )
+
+    # 語意檢索用的訊息向量（float32 little-endian BLOB）；
+    # user_id / conversation_id 冗餘存放，載入某使用者的向量時不必 JOIN
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS message_embeddings (
+            message_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
             conversation_id INTEGER NOT NULL,
-            role TEXT NOT NULL,
-            text TEXT NOT NULL,
-            timestamp TEXT NOT NULL,
-            FOREIGN KEY(conversation_id) REFERENCES conversations(id)
+            embedder TEXT NOT NULL,
+            vector BLOB NOT NULL,
+            FOREIGN KEY(message_id) REFERENCES messages(id) ON DELETE CASCADE
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_message_embeddings_user
+        ON message_embeddings(user_id, embedder, message_id)
+        """
+    )
+    # 背景建索引的進度（每種嵌入方式已掃描到的訊息 id），重新啟動後不必從頭掃描
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS embedding_progress (
+            embedder TEXT PRIMARY KEY,
+            last_message_id INTEGER NOT NULL
+        )
+        """
+    )
+
+    # 舊訊息壓縮的掃描進度：重新啟動後從這裡接續，不必從頭解碼每一則訊息
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS compression_progress (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_message_id INTEGER NOT NULL
+        )
+        """
+    )
+
+    # 附件：內容定址（sha256），同一檔案只存一份
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS attachments (
+            sha256 TEXT PRIMARY KEY,
+            mime_type TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS message_attachments (
+            message_id INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            position INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (message_id, sha256),
+            FOREIGN KEY(message_id) REFERENCES messages(id) ON DELETE CASCADE,
+            FOREIGN KEY(sha256) REFERENCES attachments(sha256)
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_message_attachments_sha
+        ON message_attachments(sha256)
+        """
+    )
+    # 最近一次有人上傳同內容的時間：清理未引用附件的寬限期從這裡起算，
+    # 剛去重沿用、還沒連結到訊息的舊附件才不會被清掉
+    if "last_stored_at" not in _column_names(cursor, "attachments"):
+        cursor.execute("ALTER TABLE attachments ADD COLUMN last_stored_at TEXT")
+    # 已封存會話引用的附件：訊息列已刪除，但封存檔還原時要能重新連結
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS archived_attachments (
+            user_id INTEGER NOT NULL,
+            conversation_id INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            PRIMARY KEY (user_id, conversation_id, sha256),
+            FOREIGN KEY(sha256) REFERENCES attachments(sha256)
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_archived_attachments_sha
+        ON archived_attachments(sha256)
+        """
+    )
+    # 已上傳到 Gemini Files API 的檔案控制代碼（依 API Key 區分，會過期）
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS attachment_uploads (
+            sha256 TEXT NOT NULL,
+            key_fingerprint TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            file_uri TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (sha256, key_fingerprint),
+            FOREIGN KEY(sha256) REFERENCES attachments(sha256) ON DELETE CASCADE
+        )
+        """
+    )
+
+    # 批次提示工作與逐筆進度（中斷後可從 pending 的項目接續）
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS batch_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            input_path TEXT NOT NULL,
+            output_path TEXT NOT NULL,
+            model TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            finished_at TEXT
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS batch_items (
+            job_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            custom_id TEXT,
+            model TEXT,
+            system TEXT,
+            prompt TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            result TEXT,
+            error TEXT,
+            latency_ms INTEGER,
+            finished_at REAL,
+            PRIMARY KEY (job_id, seq),
+            FOREIGN KEY(job_id) REFERENCES batch_jobs(id) ON DELETE CASCADE
+        )
+        """
+    )
+
+    # 每次模型呼叫的延遲與 token 用量（比較模型用）
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS model_calls (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            model TEXT NOT NULL,
+            mode TEXT NOT NULL,
+            status TEXT NOT NULL,
+            latency_ms INTEGER,
+            prompt_tokens INTEGER,
+            output_tokens INTEGER,
+            created_at REAL NOT NULL
+        )
+        """
+    )
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_model_calls_created
+        ON model_calls(created_at)
+        """
+    )
+
+    # 伺服器端 session 表（cookie 只存 session id）
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
         )
         """
     )
@@ -60,11 +375,286 @@ def init_db():
     conn.close()
 
 
+# ----------------- compression helpers -----------------
+
+# 共用字典快取：{id: bytes}，以及新訊息壓縮時使用的最新字典 id
+_zdicts: dict[int, bytes] = {}
+_current_zdict_id: int | None = None
+_zdict_loaded = False
+_zdict_lock = threading.Lock()
+
+
+def _load_zdicts(cursor: sqlite3.Cursor) -> None:
+    global _current_zdict_id, _zdict_loaded
+    with _zdict_lock:
+        if _zdict_loaded:
+            return
+        for zid, data in cursor.execute("SELECT id, data FROM zdicts ORDER BY id"):
+            _zdicts[zid] = data
+            _current_zdict_id = zid
+        _zdict_loaded = True
+
+
+def _encode_text(cursor: sqlite3.Cursor, text: str) -> tuple[int, int | None, str | bytes]:
+    """壓縮訊息內容，回傳 (codec, zdict_id, 儲存值)"""
+    _load_zdicts(cursor)
+    zid = _current_zdict_id
+    codec, value = message_codec.encode(text, _zdicts.get(zid) if zid else None)
+    return codec, (zid if codec != message_codec.CODEC_PLAIN else None), value
+
+
+def _decode_text(codec: int, zdict_id: int | None, value: str | bytes) -> str:
+    if codec == message_codec.CODEC_PLAIN:
+        return value
+    if zdict_id is not None and zdict_id not in _zdicts:
+        conn = get_connection()
+        _load_zdicts(conn.cursor())
+        if zdict_id not in _zdicts:  # 字典是在本程序載入後才新增的
+            row = conn.execute("SELECT data FROM zdicts WHERE id = ?", (zdict_id,)).fetchone()
+            _zdicts[zdict_id] = row[0]
+        conn.close()
+    return message_codec.decode(codec, value, _zdicts.get(zdict_id) if zdict_id else None)
+
+
+class _LazyMessage(dict):
+    """訊息 dict：text 在第一次被讀取時才解壓縮（只取中繼資料時不付解壓成本）"""
+
+    def __init__(self, stored: tuple, **fields):
+        super().__init__(**fields)
+        self._stored = stored
+
+    def __missing__(self, key):
+        if key != "text":
+            raise KeyError(key)
+        text = _decode_text(*self._stored)
+        self["text"] = text
+        return text
+
+    def get(self, key, default=None):
+        if key == "text":
+            return self["text"]
+        return super().get(key, default)
+
+
+def add_zdict(data: bytes) -> int:
+    """新增共用字典，之後寫入的訊息改用它壓縮，回傳字典 id"""
+    global _current_zdict_id
+    conn = get_connection()
+    cur = conn.cursor()
+    _load_zdicts(cur)
+    cur.execute(
+        "INSERT INTO zdicts (data, created_at) VALUES (?, ?)",
+        (data, datetime.utcnow().isoformat()),
+    )
+    zid = cur.lastrowid
+    conn.commit()
+    conn.close()
+    _zdicts[zid] = data
+    _current_zdict_id = zid
+    return zid
+
+
+def has_zdict() -> bool:
+    conn = get_connection()
+    _load_zdicts(conn.cursor())
+    conn.close()
+    return _current_zdict_id is not None
+
+
+def sample_message_texts(limit: int = 500) -> list[str]:
+    """取最近的長訊息當作字典訓練樣本"""
+    conn = get_connection()
+    rows = conn.execute(
+        """
+        SELECT codec, zdict_id, text FROM messages
+        WHERE role = 'model'
+        ORDER BY id DESC LIMIT ?
+        """,
+        (limit,),
+    ).fetchall()
+    conn.close()
+    texts = [_decode_text(*row) for row in rows]
+    return [t for t in texts if len(t.encode("utf-8")) >= message_codec.COMPRESS_MIN_BYTES]
+
+
+def get_compression_progress() -> int:
+    conn = get_connection()
+    row = conn.execute("SELECT last_message_id FROM compression_progress WHERE id = 1").fetchone()
+    conn.close()
+    return row[0] if row else 0
+
+
+def compress_plain_messages(after_id: int, batch_size: int = 200) -> tuple[int, int]:
+    """
+    將 id 大於 after_id 的一批原文訊息改存壓縮版本（單一短交易）。
+    回傳 (本批最後掃描到的 id, 壓縮筆數)；沒有更多訊息時 id 不變。
+    掃描進度在同一交易內寫入 compression_progress。
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    rows = cur.execute(
+        """
+        SELECT id, text FROM messages
+        WHERE id > ? AND codec = 0
+        ORDER BY id LIMIT ?
+        """,
+        (after_id, batch_size),
+    ).fetchall()
+    updates = []
+    for mid, text in rows:
+        codec, zid, value = _encode_text(cur, text)
+        if codec != message_codec.CODEC_PLAIN:
+            updates.append((codec, zid, value, mid))
+    cur.executemany(
+        "UPDATE messages SET codec = ?, zdict_id = ?, text = ? WHERE id = ? AND codec = 0",
+        updates,
+    )
+    if rows:
+        cur.execute(
+            """
+            INSERT INTO compression_progress (id, last_message_id) VALUES (1, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                last_message_id = MAX(last_message_id, excluded.last_message_id)
+            """,
+            (rows[-1][0],),
+        )
+    conn.commit()
+    conn.close()
+    return (rows[-1][0] if rows else after_id), len(updates)
+
+
+def compression_stats() -> dict:
+    """各 codec 的訊息筆數與儲存位元組數"""
+    conn = get_connection()
+    rows = conn.execute(
+        "SELECT codec, COUNT(*), SUM(LENGTH(CAST(text AS BLOB))) FROM messages GROUP BY codec"
+    ).fetchall()
+    conn.close()
+    names = {message_codec.CODEC_PLAIN: "plain", message_codec.CODEC_ZLIB: "zlib"}
+    return {
+        names.get(codec, str(codec)): {"rows": n, "stored_bytes": size or 0}
+        for codec, n, size in rows
+    }
+
+
+# ----------------- embedding helpers -----------------
+
+
+def load_unindexed_messages(embedder: str, after_id: int, limit: int = 256) -> list[dict]:
+    """取出 id > after_id、尚未以 embedder 建立向量的訊息（已刪除的會話不建索引）"""
+    conn = get_connection()
+    rows = conn.execute(
+        """
+        SELECT m.id, c.user_id, m.conversation_id, m.codec, m.zdict_id, m.text
+        FROM messages m
+        JOIN conversations c ON c.id = m.conversation_id
+        LEFT JOIN message_embeddings e ON e.message_id = m.id AND e.embedder = ?
+        WHERE m.id > ? AND e.message_id IS NULL AND c.deleted_at IS NULL
+        ORDER BY m.id
+        LIMIT ?
+        """,
+        (embedder, after_id, limit),
+    ).fetchall()
+    conn.close()
+    return [
+        {"id": mid, "user_id": uid, "conversation_id": cid, "text": _decode_text(codec, zid, value)}
+        for mid, uid, cid, codec, zid, value in rows
+    ]
+
+
+def get_embedding_progress(embedder: str) -> int:
+    conn = get_connection()
+    row = conn.execute(
+        "SELECT last_message_id FROM embedding_progress WHERE embedder = ?", (embedder,)
+    ).fetchone()
+    conn.close()
+    return row[0] if row else 0
+
+
+def save_embeddings(embedder: str, rows: list[tuple[int, int, int, bytes]]) -> None:
+    """
+    rows 為 (message_id, user_id, conversation_id, vector_bytes)；
+    同一交易內把建索引進度推進到最後一筆，向量與進度不會不一致。
+    """
+    conn = get_connection()
+    conn.executemany(
+        """
+        INSERT OR REPLACE INTO message_embeddings
+            (message_id, user_id, conversation_id, embedder, vector)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        [(mid, uid, cid, embedder, vec) for mid, uid, cid, vec in rows],
+    )
+    if rows:
+        conn.execute(
+            """
+            INSERT INTO embedding_progress (embedder, last_message_id) VALUES (?, ?)
+            ON CONFLICT(embedder) DO UPDATE SET
+                last_message_id = MAX(last_message_id, excluded.last_message_id)
+            """,
+            (embedder, max(r[0] for r in rows)),
+        )
+    conn.commit()
+    conn.close()
+
+
+def load_user_embeddings(user_id: int, embedder: str, after_id: int = 0) -> list[tuple]:
+    """依 message_id 順序回傳 (message_id, conversation_id, vector_bytes)"""
+    conn = get_connection()
+    rows = conn.execute(
+        """
+        SELECT message_id, conversation_id, vector FROM message_embeddings
+        WHERE user_id = ? AND embedder = ? AND message_id > ?
+        ORDER BY message_id
+        """,
+        (user_id, embedder, after_id),
+    ).fetchall()
+    conn.close()
+    return rows
+
+
+def load_messages_by_ids(message_ids: list[int]) -> dict[int, dict]:
+    """依 id 取出訊息與所屬會話標題；已刪除（含軟刪除）的不回傳"""
+    if not message_ids:
+        return {}
+    conn = get_connection()
+    rows = conn.execute(
+        f"""
+        SELECT m.id, m.conversation_id, c.title, m.role, m.timestamp, m.codec, m.zdict_id, m.text
+        FROM messages m
+        JOIN conversations c ON c.id = m.conversation_id
+        WHERE m.id IN ({','.join('?' * len(message_ids))}) AND c.deleted_at IS NULL
+        """,
+        message_ids,
+    ).fetchall()
+    conn.close()
+    return {
+        mid: {
+            "id": mid,
+            "conversation_id": cid,
+            "title": title,
+            "role": role,
+            "timestamp": ts,
+            "text": _decode_text(codec, zid, value),
+        }
+        for mid, cid, title, role, ts, codec, zid, value in rows
+    }
+
+
+def embedding_stats() -> dict:
+    conn = get_connection()
+    rows = conn.execute(
+        "SELECT embedder, COUNT(*), SUM(LENGTH(vector)) FROM message_embeddings GROUP BY embedder"
+    ).fetchall()
+    conn.close()
+    return {name: {"rows": n, "bytes": size or 0} for name, n, size in rows}
+
+
 # ----------------- user helpers -----------------
 
 
 def get_or_create_user(username: str) -> int:
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
     row = cursor.fetchone()
@@ -82,7 +672,7 @@ def get_or_create_user(username: str) -> int:
 
 
 def create_conversation(user_id: int, title: str) -> int:
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     ts = datetime.utcnow().isoformat()
     cursor.execute(
@@ -96,12 +686,12 @@ def create_conversation(user_id: int, title: str) -> int:
 
 
 def load_conversations(user_id: int, offset: int = 0, limit: int = 20) -> list[dict]:
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(
         """
         SELECT id, title, created_at
-        FROM conversations WHERE user_id = ?
+        FROM conversations WHERE user_id = ? AND deleted_at IS NULL
         ORDER BY created_at DESC
         LIMIT ? OFFSET ?
         """,
@@ -113,87 +703,223 @@ def load_conversations(user_id: int, offset: int = 0, limit: int = 20) -> list[d
 
 
 def get_conversation(cid: int) -> dict | None:
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(
-        "SELECT id, title, created_at FROM conversations WHERE id = ?", (cid,)
+        """
+        SELECT id, title, created_at, user_id FROM conversations
+        WHERE id = ? AND deleted_at IS NULL
+        """,
+        (cid,),
     )
     row = cursor.fetchone()
     conn.close()
     if row:
-        return {"id": row[0], "title": row[1], "created_at": row[2]}
+        return {"id": row[0], "title": row[1], "created_at": row[2], "user_id": row[3]}
     return None
 
 
 # ----------------- message helpers -----------------
 
 
-def save_message(conversation_id: int, role: str, text: str):
-    conn = sqlite3.connect(DB_PATH)
+class ConversationDeleted(LookupError):
+    """會話不存在或已標記刪除（例如在另一個分頁被刪掉），不能再寫入訊息"""
+
+
+def save_message(
+    conversation_id: int,
+    role: str,
+    text: str,
+    parent_id: int | None = None,
+    fork: bool = False,
+) -> int:
+    """
+    新增訊息並設為會話目前的分支末端。預設接在目前分支的最後一則之後；
+    fork=True 時改接在 parent_id 之後（None 表示從會話開頭另起分支）。
+    會話已標記刪除時拋出 ConversationDeleted：寫進去的訊息只會被背景清理默默刪掉。
+    """
+    conn = get_connection()
     cursor = conn.cursor()
     ts = datetime.utcnow().isoformat()
+    codec, zid, value = _encode_text(cursor, text)
+    # 父訊息在 INSERT 裡取得，與更新 active_leaf_id 在同一個交易內，不會被並行寫入插隊
+    if fork:
+        parent_sql, parent_arg = "?", parent_id
+    else:
+        parent_sql, parent_arg = "(SELECT active_leaf_id FROM conversations WHERE id = ?)", conversation_id
+    cursor.execute(
+        f"""
+        INSERT INTO messages (conversation_id, role, text, timestamp, codec, zdict_id, parent_id)
+        SELECT ?, ?, ?, ?, ?, ?, {parent_sql}
+        WHERE EXISTS (SELECT 1 FROM conversations WHERE id = ? AND deleted_at IS NULL)
+        """,
+        (conversation_id, role, value, ts, codec, zid, parent_arg, conversation_id),
+    )
+    if cursor.rowcount == 0:
+        conn.close()
+        raise ConversationDeleted(conversation_id)
+    mid = cursor.lastrowid
     cursor.execute(
-        "INSERT INTO messages (conversation_id, role, text, timestamp) VALUES (?, ?, ?, ?)",
-        (conversation_id, role, text, ts),
+        "UPDATE conversations SET active_leaf_id = ? WHERE id = ?", (mid, conversation_id)
     )
     conn.commit()
     conn.close()
+    return mid
+
+
+def get_message(mid: int) -> dict | None:
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        """
+        SELECT id, conversation_id, role, parent_id, timestamp, codec, zdict_id, text
+        FROM messages WHERE id = ?
+        """,
+        (mid,),
+    )
+    row = cur.fetchone()
+    conn.close()
+    if not row:
+        return None
+    mid, cid, role, parent_id, ts, codec, zid, value = row
+    return {
+        "id": mid,
+        "conversation_id": cid,
+        "role": role,
+        "parent_id": parent_id,
+        "timestamp": ts,
+        "text": _decode_text(codec, zid, value),
+    }
 
 
 def load_messages(
-    conversation_id: int, before_ts: str | None = None, limit: int = 50
+    conversation_id: int,
+    before_ts: str | None = None,
+    limit: int = 50,
+    before_id: int | None = None,
 ) -> list[dict]:
-    conn = sqlite3.connect(DB_PATH)
+    """
+    載入會話目前分支最近 limit 筆訊息（舊到新排序）。
+    從分支末端（active_leaf_id）沿 parent_id 往上走，每一步都是主鍵查詢，
+    不會掃到其他分支的訊息。before_id 為分頁游標：從它的父訊息開始往上取；
+    before_ts 為舊版以時間戳分頁的參數。
+    """
+    conn = get_connection()
     cursor = conn.cursor()
-    if before_ts:
-        cursor.execute(
-            """
-            SELECT role, text, timestamp
-            FROM messages
-            WHERE conversation_id = ? AND timestamp < ?
-            ORDER BY timestamp DESC
-            LIMIT ?
-            """,
-            (conversation_id, before_ts, limit),
-        )
+    # 已標記刪除的會話在清理前仍有訊息，但一律當作不存在
+    if before_id is not None:
+        start_sql = """
+            SELECT m.parent_id FROM messages m JOIN conversations c ON c.id = m.conversation_id
+            WHERE m.id = ? AND m.conversation_id = ? AND c.deleted_at IS NULL
+        """
+        params: list = [before_id, conversation_id]
     else:
-        cursor.execute(
-            """
-            SELECT role, text, timestamp
-            FROM messages
-            WHERE conversation_id = ?
-            ORDER BY timestamp DESC
-            LIMIT ?
-            """,
-            (conversation_id, limit),
+        start_sql = "SELECT active_leaf_id FROM conversations WHERE id = ? AND deleted_at IS NULL"
+        params = [conversation_id]
+    # 以時間戳分頁時不知道要往上走幾步，只能走完整條路徑再過濾
+    max_depth = -1 if before_ts else limit
+    cursor.execute(
+        f"""
+        WITH RECURSIVE path(id, depth) AS (
+            SELECT ({start_sql}), 0
+            UNION ALL
+            SELECT m.parent_id, path.depth + 1
+            FROM messages m JOIN path ON m.id = path.id
+            WHERE m.parent_id IS NOT NULL AND path.depth + 1 != ?
         )
+        SELECT m.id, m.role, m.timestamp, m.parent_id, m.codec, m.zdict_id, m.text
+        FROM path JOIN messages m ON m.id = path.id
+        WHERE ? IS NULL OR m.timestamp < ?
+        ORDER BY path.depth
+        LIMIT ?
+        """,
+        (*params, max_depth, before_ts, before_ts, limit),
+    )
     rows = cursor.fetchall()
     conn.close()
     return [
-        {"role": role, "text": text, "timestamp": ts}
-        for role, text, ts in reversed(rows)
+        _LazyMessage((codec, zid, value), id=mid, role=role, timestamp=ts, parent_id=parent_id)
+        for mid, role, ts, parent_id, codec, zid, value in reversed(rows)
     ]
 
 
-def delete_user_messages(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM conversations WHERE user_id = ?", (user_id,))
-    conv_ids = [row[0] for row in cursor.fetchall()]
-
-    if conv_ids:
-        cursor.execute(
-            f"DELETE FROM messages WHERE conversation_id IN ({','.join('?'*len(conv_ids))})",
-            conv_ids,
+def load_siblings(conversation_id: int, messages: list[dict]) -> dict[int, list[int]]:
+    """
+    找出這些訊息各自的兄弟訊息（同一個父訊息的所有回覆 / 改寫，含自己，依建立順序）。
+    只回傳有分岔（兄弟數 > 1）的訊息：{訊息 id: [兄弟 id...]}。
+    """
+    parents = {m["parent_id"] for m in messages}
+    parent_ids = [p for p in parents if p is not None]
+    if not parent_ids and None not in parents:
+        return {}
+    conn = get_connection()
+    cur = conn.cursor()
+    queries, params = [], []
+    if parent_ids:
+        queries.append(
+            f"SELECT id, parent_id FROM messages WHERE parent_id IN ({','.join('?' * len(parent_ids))})"
+        )
+        params.extend(parent_ids)
+    if None in parents:
+        queries.append(
+            "SELECT id, parent_id FROM messages WHERE conversation_id = ? AND parent_id IS NULL"
+        )
+        params.append(conversation_id)
+    cur.execute(" UNION ALL ".join(queries) + " ORDER BY id", params)
+    children: dict[int | None, list[int]] = {}
+    for mid, parent_id in cur.fetchall():
+        children.setdefault(parent_id, []).append(mid)
+    conn.close()
+    return {
+        m["id"]: children[m["parent_id"]]
+        for m in messages
+        if len(children.get(m["parent_id"], ())) > 1
+    }
+
+
+def set_active_branch(conversation_id: int, mid: int) -> int | None:
+    """
+    切換到包含 mid 的分支：從 mid 一路往下走到最新的子訊息為止，設為會話的分支末端。
+    mid 不屬於此會話時回傳 None。
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        """
+        WITH RECURSIVE down(id, depth) AS (
+            SELECT id, 0 FROM messages WHERE id = ? AND conversation_id = ?
+            UNION ALL
+            SELECT (SELECT MAX(c.id) FROM messages c WHERE c.parent_id = down.id), down.depth + 1
+            FROM down WHERE down.id IS NOT NULL
         )
-        cursor.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+        SELECT id FROM down WHERE id IS NOT NULL ORDER BY depth DESC LIMIT 1
+        """,
+        (mid, conversation_id),
+    )
+    row = cur.fetchone()
+    if row:
+        cur.execute(
+            "UPDATE conversations SET active_leaf_id = ? WHERE id = ?", (row[0], conversation_id)
+        )
+        conn.commit()
+    conn.close()
+    return row[0] if row else None
+
 
+def delete_user_messages(user_id: int):
+    """刪除使用者所有會話：只標記刪除，訊息交給背景清理（purge_deleted_messages）。"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE conversations SET deleted_at = ? WHERE user_id = ? AND deleted_at IS NULL",
+        (datetime.utcnow().isoformat(), user_id),
+    )
     conn.commit()
     conn.close()
 
 
 def update_conversation_title(cid: int, new_title: str) -> None:
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cur = conn.cursor()
     cur.execute("UPDATE conversations SET title = ? WHERE id = ?", (new_title, cid))
     conn.commit()
@@ -201,220 +927,630 @@ def update_conversation_title(cid: int, new_title: str) -> None:
 
 
 def delete_conversation(cid: int) -> None:
-    conn = sqlite3.connect(DB_PATH)
+    """刪除會話：只標記刪除，訊息交給背景清理（purge_deleted_messages）。"""
+    conn = get_connection()
     cur = conn.cursor()
-    cur.execute("DELETE FROM messages       WHERE conversation_id = ?", (cid,))
-    cur.execute("DELETE FROM conversations  WHERE id = ?", (cid,))
+    cur.execute(
+        "UPDATE conversations SET deleted_at = ? WHERE id = ? AND deleted_at IS NULL",
+        (datetime.utcnow().isoformat(), cid),
+    )
     conn.commit()
     conn.close()
 
 
-import os
-import sqlite3
-from datetime import datetime
+def purge_deleted_messages(batch_size: int = 500) -> int:
+    """刪除一批屬於已標記刪除會話的訊息（單一短交易），回傳刪除筆數。"""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        """
+        DELETE FROM messages WHERE id IN (
+            SELECT m.id FROM conversations c
+            JOIN messages m ON m.conversation_id = c.id
+            WHERE c.deleted_at IS NOT NULL
+            LIMIT ?
+        )
+        """,
+        (batch_size,),
+    )
+    deleted = cur.rowcount
+    conn.commit()
+    conn.close()
+    return deleted
 
-# ================== 路徑設定 ==================
-# 使用者家目錄 (自動抓 C:\Users\<username>\)
-USER_HOME = os.path.expanduser("~")
 
-# 在使用者家目錄下建立 GeminiChat 資料夾
-APP_DIR = os.path.join(USER_HOME, "GeminiChat")
-os.makedirs(APP_DIR, exist_ok=True)
+def purge_deleted_conversations() -> int:
+    """刪除訊息已清空的已標記會話，回傳刪除筆數（剩餘訊息會由外鍵連帶刪除）。"""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        """
+        DELETE FROM conversations
+        WHERE deleted_at IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM messages WHERE conversation_id = conversations.id)
+        """
+    )
+    deleted = cur.rowcount
+    conn.commit()
+    conn.close()
+    return deleted
 
-# DB 檔案路徑
-DB_PATH = os.path.join(APP_DIR, "chat_data.db")
-# =================================================
 
+# ----------------- attachment helpers -----------------
 
-def init_db():
-    """初始化資料庫，建立 users / conversations / messages 表格（如果不存在）。"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
 
-    # 使用者表
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL
-        )
+def add_attachment(sha256: str, mime_type: str, size: int, filename: str) -> dict:
+    """登記附件（內容相同的檔案只保留第一次的紀錄並更新 last_stored_at），回傳附件資料。"""
+    now = datetime.utcnow().isoformat()
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(
         """
+        INSERT INTO attachments (sha256, mime_type, size, filename, created_at, last_stored_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(sha256) DO UPDATE SET last_stored_at = excluded.last_stored_at
+        """,
+        (sha256, mime_type, size, filename, now, now),
     )
+    conn.commit()
+    conn.close()
+    return {"sha256": sha256, "mime_type": mime_type, "size": size, "filename": filename}
 
-    # 會話表
-    cursor.execute(
+
+def get_attachment(sha256: str) -> dict | None:
+    conn = get_connection()
+    row = conn.execute(
+        "SELECT sha256, mime_type, size, filename FROM attachments WHERE sha256 = ?",
+        (sha256,),
+    ).fetchone()
+    conn.close()
+    if row:
+        return {"sha256": row[0], "mime_type": row[1], "size": row[2], "filename": row[3]}
+    return None
+
+
+def link_attachments(message_id: int, attachments: list[dict]) -> None:
+    conn = get_connection()
+    conn.executemany(
+        "INSERT OR IGNORE INTO message_attachments (message_id, sha256, position) VALUES (?, ?, ?)",
+        [(message_id, a["sha256"], i) for i, a in enumerate(attachments)],
+    )
+    conn.commit()
+    conn.close()
+
+
+def user_can_access_attachment(user_id: int, sha256: str) -> bool:
+    """附件是否連結在該使用者（未刪除的）會話訊息上"""
+    conn = get_connection()
+    row = conn.execute(
         """
-        CREATE TABLE IF NOT EXISTS conversations (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            title TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            FOREIGN KEY(user_id) REFERENCES users(id)
+        SELECT 1 FROM message_attachments ma
+        JOIN messages m ON m.id = ma.message_id
+        JOIN conversations c ON c.id = m.conversation_id
+        WHERE ma.sha256 = ? AND c.user_id = ? AND c.deleted_at IS NULL
+        LIMIT 1
+        """,
+        (sha256, user_id),
+    ).fetchone()
+    conn.close()
+    return row is not None
+
+
+def load_message_attachments(message_ids: list[int]) -> dict[int, list[dict]]:
+    """一次查出多則訊息的附件：{message_id: [附件, ...]}"""
+    if not message_ids:
+        return {}
+    conn = get_connection()
+    rows = conn.execute(
+        f"""
+        SELECT ma.message_id, a.sha256, a.mime_type, a.size, a.filename
+        FROM message_attachments ma
+        JOIN attachments a ON a.sha256 = ma.sha256
+        WHERE ma.message_id IN ({','.join('?' * len(message_ids))})
+        ORDER BY ma.message_id, ma.position
+        """,
+        message_ids,
+    ).fetchall()
+    conn.close()
+    result: dict[int, list[dict]] = {}
+    for mid, sha, mime, size, filename in rows:
+        result.setdefault(mid, []).append(
+            {"sha256": sha, "mime_type": mime, "size": size, "filename": filename}
         )
+    return result
+
+
+def get_attachment_upload(sha256: str, key_fingerprint: str) -> dict | None:
+    """取得尚未過期的 Gemini 檔案控制代碼"""
+    conn = get_connection()
+    row = conn.execute(
         """
-    )
+        SELECT file_name, file_uri, expires_at FROM attachment_uploads
+        WHERE sha256 = ? AND key_fingerprint = ? AND expires_at > ?
+        """,
+        (sha256, key_fingerprint, time.time()),
+    ).fetchone()
+    conn.close()
+    if row:
+        return {"file_name": row[0], "file_uri": row[1], "expires_at": row[2]}
+    return None
 
-    # 訊息表
-    cursor.execute(
+
+def save_attachment_upload(
+    sha256: str, key_fingerprint: str, file_name: str, file_uri: str, expires_at: float
+) -> None:
+    conn = get_connection()
+    conn.execute(
         """
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            conversation_id INTEGER NOT NULL,
-            role TEXT NOT NULL,
-            text TEXT NOT NULL,
-            timestamp TEXT NOT NULL,
-            FOREIGN KEY(conversation_id) REFERENCES conversations(id)
-        )
+        INSERT OR REPLACE INTO attachment_uploads
+            (sha256, key_fingerprint, file_name, file_uri, expires_at)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        (sha256, key_fingerprint, file_name, file_uri, expires_at),
+    )
+    conn.commit()
+    conn.close()
+
+
+# 沒有任何訊息或封存檔引用，且寬限期內沒有人再上傳同內容
+_UNREFERENCED_ATTACHMENT = """
+    COALESCE(a.last_stored_at, a.created_at) < ?
+    AND NOT EXISTS (SELECT 1 FROM message_attachments ma WHERE ma.sha256 = a.sha256)
+    AND NOT EXISTS (SELECT 1 FROM archived_attachments aa WHERE aa.sha256 = a.sha256)
+"""
+
+
+def list_unreferenced_attachments(older_than_ts: str) -> list[str]:
+    """列出可清除的附件 sha256（實際刪除前要以 delete_unreferenced_attachment 再確認一次）"""
+    conn = get_connection()
+    rows = conn.execute(
+        f"SELECT sha256 FROM attachments a WHERE {_UNREFERENCED_ATTACHMENT}",
+        (older_than_ts,),
+    ).fetchall()
+    conn.close()
+    return [row[0] for row in rows]
+
+
+def delete_unreferenced_attachment(sha256: str, older_than_ts: str) -> bool:
+    """在同一條 DELETE 中重新確認仍未被引用才刪除附件紀錄，回傳是否刪除。"""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        f"DELETE FROM attachments WHERE sha256 = ? AND sha256 IN "
+        f"(SELECT sha256 FROM attachments a WHERE {_UNREFERENCED_ATTACHMENT})",
+        (sha256, older_than_ts),
+    )
+    deleted = cur.rowcount > 0
+    conn.commit()
+    conn.close()
+    return deleted
+
+
+def pin_archived_attachments(user_id: int, conversation_id: int, shas: list[str]) -> None:
+    """記錄封存會話引用的附件，避免被清除"""
+    conn = get_connection()
+    conn.executemany(
         """
+        INSERT OR IGNORE INTO archived_attachments (user_id, conversation_id, sha256)
+        VALUES (?, ?, ?)
+        """,
+        [(user_id, conversation_id, sha) for sha in shas],
     )
     conn.commit()
     conn.close()
 
 
-# ----------------- user helpers -----------------
+def unpin_archived_attachments(user_id: int, conversation_id: int) -> None:
+    conn = get_connection()
+    conn.execute(
+        "DELETE FROM archived_attachments WHERE user_id = ? AND conversation_id = ?",
+        (user_id, conversation_id),
+    )
+    conn.commit()
+    conn.close()
 
 
-def get_or_create_user(username: str) -> int:
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-    row = cursor.fetchone()
-    if row:
-        uid = row[0]
-    else:
-        cursor.execute("INSERT INTO users (username) VALUES (?)", (username,))
-        uid = cursor.lastrowid
-        conn.commit()
+# ----------------- batch helpers -----------------
+
+BATCH_INSERT_CHUNK = 1000
+
+
+def create_batch_job(input_path: str, output_path: str, model: str, items) -> int:
+    """
+    建立批次工作；items 為 (custom_id, model, system, prompt) 的可迭代物件，
+    分段寫入但只在全部成功後才提交，避免留下缺項的工作。
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO batch_jobs (input_path, output_path, model, created_at) VALUES (?, ?, ?, ?)",
+        (input_path, output_path, model, datetime.utcnow().isoformat()),
+    )
+    job_id = cur.lastrowid
+    chunk = []
+    for seq, item in enumerate(items):
+        chunk.append((job_id, seq, *item))
+        if len(chunk) >= BATCH_INSERT_CHUNK:
+            cur.executemany(
+                "INSERT INTO batch_items (job_id, seq, custom_id, model, system, prompt) VALUES (?, ?, ?, ?, ?, ?)",
+                chunk,
+            )
+            chunk.clear()
+    cur.executemany(
+        "INSERT INTO batch_items (job_id, seq, custom_id, model, system, prompt) VALUES (?, ?, ?, ?, ?, ?)",
+        chunk,
+    )
+    conn.commit()
     conn.close()
-    return uid
+    return job_id
 
 
-# ----------------- conversation helpers -----------------
+def get_batch_job(job_id: int) -> dict | None:
+    conn = get_connection()
+    row = conn.execute(
+        """
+        SELECT id, input_path, output_path, model, created_at, finished_at
+        FROM batch_jobs WHERE id = ?
+        """,
+        (job_id,),
+    ).fetchone()
+    conn.close()
+    if row is None:
+        return None
+    keys = ("id", "input_path", "output_path", "model", "created_at", "finished_at")
+    return dict(zip(keys, row))
 
 
-def create_conversation(user_id: int, title: str) -> int:
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    ts = datetime.utcnow().isoformat()
-    cursor.execute(
-        "INSERT INTO conversations (user_id, title, created_at) VALUES (?, ?, ?)",
-        (user_id, title, ts),
+def list_batch_jobs(limit: int = 20) -> list[dict]:
+    """最近的批次工作與各狀態筆數"""
+    conn = get_connection()
+    rows = conn.execute(
+        """
+        SELECT j.id, j.model, j.input_path, j.created_at, j.finished_at,
+               COUNT(i.seq),
+               SUM(i.status = 'done'),
+               SUM(i.status = 'failed')
+        FROM batch_jobs j LEFT JOIN batch_items i ON i.job_id = j.id
+        GROUP BY j.id ORDER BY j.id DESC LIMIT ?
+        """,
+        (limit,),
+    ).fetchall()
+    conn.close()
+    keys = ("id", "model", "input_path", "created_at", "finished_at", "total", "done", "failed")
+    return [dict(zip(keys, (*r[:5], r[5], r[6] or 0, r[7] or 0))) for r in rows]
+
+
+def load_batch_items(job_id: int, statuses: tuple[str, ...]) -> list[dict]:
+    """依 seq 順序取出指定狀態的項目"""
+    conn = get_connection()
+    rows = conn.execute(
+        f"""
+        SELECT seq, custom_id, model, system, prompt, status, attempts, result, error, latency_ms
+        FROM batch_items
+        WHERE job_id = ? AND status IN ({','.join('?' * len(statuses))})
+        ORDER BY seq
+        """,
+        (job_id, *statuses),
+    ).fetchall()
+    conn.close()
+    keys = (
+        "seq", "custom_id", "model", "system", "prompt",
+        "status", "attempts", "result", "error", "latency_ms",
+    )
+    return [dict(zip(keys, r)) for r in rows]
+
+
+def finish_batch_item(
+    job_id: int,
+    seq: int,
+    status: str,
+    attempts: int,
+    result: str | None = None,
+    error: str | None = None,
+    latency_ms: int | None = None,
+) -> None:
+    """記錄單筆完成（done / failed）；每筆各自提交，當機時最多損失進行中的項目"""
+    conn = get_connection()
+    conn.execute(
+        """
+        UPDATE batch_items
+        SET status = ?, attempts = ?, result = ?, error = ?, latency_ms = ?, finished_at = ?
+        WHERE job_id = ? AND seq = ?
+        """,
+        (status, attempts, result, error, latency_ms, time.time(), job_id, seq),
     )
-    cid = cursor.lastrowid
     conn.commit()
     conn.close()
-    return cid
 
 
-def load_conversations(user_id: int, offset: int = 0, limit: int = 20) -> list[dict]:
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
+def reset_failed_batch_items(job_id: int) -> int:
+    """把失敗的項目改回 pending，以便重新執行"""
+    conn = get_connection()
+    cur = conn.execute(
         """
-        SELECT id, title, created_at
-        FROM conversations WHERE user_id = ?
-        ORDER BY created_at DESC
-        LIMIT ? OFFSET ?
+        UPDATE batch_items SET status = 'pending', attempts = 0, error = NULL
+        WHERE job_id = ? AND status = 'failed'
         """,
-        (user_id, limit, offset),
+        (job_id,),
     )
-    rows = cursor.fetchall()
+    conn.commit()
     conn.close()
-    return [{"id": cid, "title": title, "created_at": ts} for cid, title, ts in rows]
+    return cur.rowcount
 
 
-def get_conversation(cid: int) -> dict | None:
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT id, title, created_at FROM conversations WHERE id = ?", (cid,)
+def finish_batch_job(job_id: int) -> None:
+    conn = get_connection()
+    conn.execute(
+        "UPDATE batch_jobs SET finished_at = ? WHERE id = ?",
+        (datetime.utcnow().isoformat(), job_id),
     )
-    row = cursor.fetchone()
+    conn.commit()
     conn.close()
-    if row:
-        return {"id": row[0], "title": row[1], "created_at": row[2]}
-    return None
 
 
-# ----------------- message helpers -----------------
+# ----------------- model stats helpers -----------------
 
 
-def save_message(conversation_id: int, role: str, text: str):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    ts = datetime.utcnow().isoformat()
-    cursor.execute(
-        "INSERT INTO messages (conversation_id, role, text, timestamp) VALUES (?, ?, ?, ?)",
-        (conversation_id, role, text, ts),
+def record_model_call(
+    model: str,
+    mode: str,
+    status: str,
+    latency_ms: int | None,
+    prompt_tokens: int | None = None,
+    output_tokens: int | None = None,
+) -> None:
+    conn = get_connection()
+    conn.execute(
+        """
+        INSERT INTO model_calls
+            (model, mode, status, latency_ms, prompt_tokens, output_tokens, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        (model, mode, status, latency_ms, prompt_tokens, output_tokens, time.time()),
     )
     conn.commit()
     conn.close()
 
 
-def load_messages(
-    conversation_id: int, before_ts: str | None = None, limit: int = 50
-) -> list[dict]:
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    if before_ts:
-        cursor.execute(
-            """
-            SELECT role, text, timestamp
-            FROM messages
-            WHERE conversation_id = ? AND timestamp < ?
-            ORDER BY timestamp DESC
-            LIMIT ?
-            """,
-            (conversation_id, before_ts, limit),
-        )
-    else:
-        cursor.execute(
-            """
-            SELECT role, text, timestamp
-            FROM messages
-            WHERE conversation_id = ?
-            ORDER BY timestamp DESC
-            LIMIT ?
-            """,
-            (conversation_id, limit),
-        )
-    rows = cursor.fetchall()
+def load_model_calls(since_ts: float) -> list[tuple]:
+    """依時間順序回傳 (model, status, latency_ms, prompt_tokens, output_tokens, created_at)"""
+    conn = get_connection()
+    rows = conn.execute(
+        """
+        SELECT model, status, latency_ms, prompt_tokens, output_tokens, created_at
+        FROM model_calls WHERE created_at >= ?
+        ORDER BY created_at
+        """,
+        (since_ts,),
+    ).fetchall()
     conn.close()
-    return [
-        {"role": role, "text": text, "timestamp": ts}
-        for role, text, ts in reversed(rows)
-    ]
+    return rows
+
+
+def model_call_summary(since_ts: float) -> dict[str, dict]:
+    """
+    各模型自 since_ts 以來的呼叫統計：次數、各狀態筆數、成功呼叫的
+    延遲中位數 / p90 與平均 token 數。
+    """
+    grouped: dict[str, list[tuple]] = {}
+    for row in load_model_calls(since_ts):
+        grouped.setdefault(row[0], []).append(row[1:5])
+
+    def _pct(values: list[int], q: float) -> int | None:
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    summary = {}
+    for model, calls in grouped.items():
+        ok = [c for c in calls if c[0] == "ok"]
+        latencies = sorted(c[1] for c in ok if c[1] is not None)
+        statuses: dict[str, int] = {}
+        for c in calls:
+            statuses[c[0]] = statuses.get(c[0], 0) + 1
+        summary[model] = {
+            "calls": len(calls),
+            "statuses": statuses,
+            "latency_p50_ms": _pct(latencies, 0.5),
+            "latency_p90_ms": _pct(latencies, 0.9),
+            "avg_prompt_tokens": round(sum(c[2] or 0 for c in ok) / len(ok)) if ok else None,
+            "avg_output_tokens": round(sum(c[3] or 0 for c in ok) / len(ok)) if ok else None,
+        }
+    return summary
+
+
+def purge_model_calls(before_ts: float) -> int:
+    conn = get_connection()
+    cur = conn.execute("DELETE FROM model_calls WHERE created_at < ?", (before_ts,))
+    conn.commit()
+    conn.close()
+    return cur.rowcount
 
 
-def delete_user_messages(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM conversations WHERE user_id = ?", (user_id,))
-    conv_ids = [row[0] for row in cursor.fetchall()]
+# ----------------- session helpers -----------------
 
-    if conv_ids:
-        cursor.execute(
-            f"DELETE FROM messages WHERE conversation_id IN ({','.join('?'*len(conv_ids))})",
-            conv_ids,
-        )
-        cursor.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
 
+def load_session(sid: str) -> tuple[dict, float] | None:
+    """讀取未過期的 session，回傳 (資料, 到期時間)；不存在或已過期則回 None。"""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT data, expires_at FROM sessions WHERE id = ? AND expires_at > ?",
+        (sid, time.time()),
+    )
+    row = cur.fetchone()
+    conn.close()
+    if row:
+        return json.loads(row[0]), row[1]
+    return None
+
+
+def save_session(sid: str, data: dict, expires_at: float) -> None:
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        """
+        INSERT INTO sessions (id, data, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at
+        """,
+        (sid, json.dumps(data, ensure_ascii=False), expires_at),
+    )
     conn.commit()
     conn.close()
 
 
-def update_conversation_title(cid: int, new_title: str) -> None:
-    conn = sqlite3.connect(DB_PATH)
+def delete_session(sid: str) -> None:
+    conn = get_connection()
     cur = conn.cursor()
-    cur.execute("UPDATE conversations SET title = ? WHERE id = ?", (new_title, cid))
+    cur.execute("DELETE FROM sessions WHERE id = ?", (sid,))
     conn.commit()
     conn.close()
 
 
-def delete_conversation(cid: int) -> None:
-    conn = sqlite3.connect(DB_PATH)
+def purge_expired_sessions() -> int:
+    """刪除所有過期 session，回傳刪除筆數。"""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),))
+    deleted = cur.rowcount
+    conn.commit()
+    conn.close()
+    return deleted
+
+
+# ----------------- archive helpers -----------------
+
+
+def list_stale_conversations(cutoff_ts: str, limit: int = 50) -> list[dict]:
+    """回傳最後活動時間（最後一則訊息，沒有訊息則為建立時間）早於 cutoff_ts 的會話。"""
+    conn = get_connection()
     cur = conn.cursor()
-    cur.execute("DELETE FROM messages       WHERE conversation_id = ?", (cid,))
-    cur.execute("DELETE FROM conversations  WHERE id = ?", (cid,))
+    cur.execute(
+        """
+        SELECT c.id, c.user_id, c.title,
+               COALESCE(MAX(m.timestamp), c.created_at) AS last_active
+        FROM conversations c
+        LEFT JOIN messages m ON m.conversation_id = c.id
+        WHERE c.deleted_at IS NULL
+        GROUP BY c.id
+        HAVING last_active < ?
+        ORDER BY last_active
+        LIMIT ?
+        """,
+        (cutoff_ts, limit),
+    )
+    rows = cur.fetchall()
+    conn.close()
+    return [
+        {"id": cid, "user_id": uid, "title": title, "last_active": ts}
+        for cid, uid, title, ts in rows
+    ]
+
+
+def export_conversation(cid: int) -> dict | None:
+    """匯出會話與其全部訊息（封存用）。"""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT id, user_id, title, created_at FROM conversations WHERE id = ?",
+        (cid,),
+    )
+    row = cur.fetchone()
+    if not row:
+        conn.close()
+        return None
+    cur.execute(
+        """
+        SELECT id, parent_id, role, timestamp, codec, zdict_id, text FROM messages
+        WHERE conversation_id = ? ORDER BY id
+        """,
+        (cid,),
+    )
+    messages = [
+        {
+            "id": mid,
+            "parent_id": parent_id,
+            "role": role,
+            "text": _decode_text(codec, zid, value),
+            "timestamp": ts,
+        }
+        for mid, parent_id, role, ts, codec, zid, value in cur.fetchall()
+    ]
+    by_id = {m["id"]: m for m in messages}
+    cur.execute(
+        """
+        SELECT ma.message_id, a.sha256, a.mime_type, a.size, a.filename
+        FROM message_attachments ma
+        JOIN attachments a ON a.sha256 = ma.sha256
+        JOIN messages m ON m.id = ma.message_id
+        WHERE m.conversation_id = ?
+        ORDER BY ma.message_id, ma.position
+        """,
+        (cid,),
+    )
+    for mid, sha, mime, size, filename in cur.fetchall():
+        by_id[mid].setdefault("attachments", []).append(
+            {"sha256": sha, "mime_type": mime, "size": size, "filename": filename}
+        )
+    active_leaf_id = cur.execute(
+        "SELECT active_leaf_id FROM conversations WHERE id = ?", (cid,)
+    ).fetchone()[0]
+    conn.close()
+    return {
+        "id": row[0],
+        "user_id": row[1],
+        "title": row[2],
+        "created_at": row[3],
+        "active_leaf_id": active_leaf_id,
+        "messages": messages,
+    }
+
+
+def import_conversation(user_id: int, data: dict) -> int:
+    """將匯出的會話寫回資料庫（還原封存），回傳新的會話 ID。"""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO conversations (user_id, title, created_at) VALUES (?, ?, ?)",
+        (user_id, data["title"], data["created_at"]),
+    )
+    cid = cur.lastrowid
+    # 訊息依 id 排序匯出，父訊息一定先寫入；舊版封存沒有 id / parent_id，視為一條直線
+    new_ids: dict[int, int] = {}
+    last_mid = None
+    for m in data["messages"]:
+        codec, zid, value = _encode_text(cur, m["text"])
+        parent_id = new_ids.get(m["parent_id"]) if "id" in m else last_mid
+        cur.execute(
+            """
+            INSERT INTO messages (conversation_id, role, text, timestamp, codec, zdict_id, parent_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (cid, m["role"], value, m["timestamp"], codec, zid, parent_id),
+        )
+        last_mid = cur.lastrowid
+        if "id" in m:
+            new_ids[m["id"]] = last_mid
+        # 附件檔案在封存期間由 archived_attachments 保留，紀錄若已不在就依封存內容補回
+        for position, a in enumerate(m.get("attachments", [])):
+            cur.execute(
+                """
+                INSERT OR IGNORE INTO attachments (sha256, mime_type, size, filename, created_at)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (a["sha256"], a["mime_type"], a["size"], a["filename"], datetime.utcnow().isoformat()),
+            )
+            cur.execute(
+                """
+                INSERT OR IGNORE INTO message_attachments (message_id, sha256, position)
+                VALUES (?, ?, ?)
+                """,
+                (last_mid, a["sha256"], position),
+            )
+    cur.execute(
+        "UPDATE conversations SET active_leaf_id = ? WHERE id = ?",
+        (new_ids.get(data.get("active_leaf_id"), last_mid), cid),
+    )
     conn.commit()
-    conn.close()
\ No newline at end of file
+    conn.close()
+    return cid
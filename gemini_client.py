@@ -0,0 +1,299 @@
+import importlib.util
+import logging
+import os
+import socket
+import ssl
+import threading
+import time
+from contextlib import contextmanager
+
+import certifi
+import httpcore
+import httpx
+from google import genai
+from google.genai import types
+
+from apikey import API_KEYS, get_api_key
+
+# ================== 連線設定 ==================
+# 可用環境變數調整，預設值依照本機單人 / 小團隊使用量設定
+GEMINI_BASE_URL = "https://generativelanguage.googleapis.com/"
+
+CONNECT_TIMEOUT = float(os.environ.get("GEMINICHAT_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.environ.get("GEMINICHAT_READ_TIMEOUT", "120"))
+WRITE_TIMEOUT = float(os.environ.get("GEMINICHAT_WRITE_TIMEOUT", "30"))
+POOL_TIMEOUT = float(os.environ.get("GEMINICHAT_POOL_TIMEOUT", "10"))
+
+# 同時進行中的請求上限 = 連線池大小；keep-alive 連線保留數
+MAX_CONNECTIONS = int(os.environ.get("GEMINICHAT_MAX_CONNECTIONS", "20"))
+MAX_KEEPALIVE = int(os.environ.get("GEMINICHAT_MAX_KEEPALIVE", "10"))
+KEEPALIVE_EXPIRY = float(os.environ.get("GEMINICHAT_KEEPALIVE_EXPIRY", "120"))
+
+# 有安裝 h2 套件才啟用 HTTP/2，否則退回 HTTP/1.1
+HTTP2_ENABLED = importlib.util.find_spec("h2") is not None
+# =================================================
+
+TIMEOUT = httpx.Timeout(
+    connect=CONNECT_TIMEOUT, read=READ_TIMEOUT, write=WRITE_TIMEOUT, pool=POOL_TIMEOUT
+)
+
+
+class RequestTracker:
+    """
+    追蹤某個執行緒在 closing_responses() 區塊內發出的請求，讓其他執行緒可以中止它們。
+    cancel() 直接 shutdown 正在使用的 socket：阻塞在 recv 的執行緒會立刻收到
+    ReadError，就算模型還沒送出第一個片段（甚至回應標頭還沒到）也一樣；
+    只 close() 回應並不會喚醒另一個執行緒中的 recv。
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._responses: list[httpx.Response] = []
+        self._streams: list["_TrackedStream"] = []
+
+    def cancel(self) -> None:
+        with _stream_lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            for stream in self._streams:
+                # 回應已讀完、連線已交給其他請求使用時，owner 已經換人，不能中斷
+                if stream.owner is self:
+                    stream.abort()
+
+    def _attach(self, stream: "_TrackedStream") -> None:
+        """在 _stream_lock 內呼叫：登記本執行緒即將在這條連線上讀寫"""
+        if self.cancelled:
+            raise httpcore.ReadError("請求已被中止")
+        stream.owner = self
+        if stream not in self._streams:
+            self._streams.append(stream)
+
+    def _close(self) -> None:
+        for response in self._responses:
+            response.close()
+        with _stream_lock:
+            for stream in self._streams:
+                if stream.owner is self:
+                    stream.owner = None
+            self._streams.clear()
+
+
+class _TrackedStream(httpcore.NetworkStream):
+    """每次讀寫前把連線登記到目前執行緒的 RequestTracker（沒有追蹤時直接轉呼叫）"""
+
+    def __init__(self, stream: httpcore.NetworkStream):
+        self._stream = stream
+        self.owner: RequestTracker | None = None
+
+    def _enter(self) -> None:
+        tracker = getattr(_tracked, "tracker", None)
+        if tracker is None and self.owner is None:
+            return
+        with _stream_lock:
+            if tracker is None:
+                self.owner = None  # 連線換給沒有追蹤的請求使用
+            else:
+                tracker._attach(self)
+
+    def abort(self) -> None:
+        # HTTP/2 的連線由多個請求共用，不能整條中斷；只處理 HTTP/1.1
+        ssl_object = self._stream.get_extra_info("ssl_object")
+        if ssl_object is not None and ssl_object.selected_alpn_protocol() == "h2":
+            return
+        sock = self._stream.get_extra_info("socket")
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def read(self, max_bytes: int, timeout: float | None = None) -> bytes:
+        self._enter()
+        return self._stream.read(max_bytes, timeout)
+
+    def write(self, buffer: bytes, timeout: float | None = None) -> None:
+        self._enter()
+        self._stream.write(buffer, timeout)
+
+    def close(self) -> None:
+        self._stream.close()
+
+    def start_tls(self, *args, **kwargs) -> httpcore.NetworkStream:
+        return _TrackedStream(self._stream.start_tls(*args, **kwargs))
+
+    def get_extra_info(self, info: str):
+        return self._stream.get_extra_info(info)
+
+
+class _TrackedBackend(httpcore.NetworkBackend):
+    """建立連線時包上 _TrackedStream"""
+
+    def __init__(self, backend: httpcore.NetworkBackend):
+        self._backend = backend
+
+    def connect_tcp(self, *args, **kwargs) -> httpcore.NetworkStream:
+        return _TrackedStream(self._backend.connect_tcp(*args, **kwargs))
+
+    def connect_unix_socket(self, *args, **kwargs) -> httpcore.NetworkStream:
+        return _TrackedStream(self._backend.connect_unix_socket(*args, **kwargs))
+
+    def sleep(self, seconds: float) -> None:
+        self._backend.sleep(seconds)
+
+
+class _SharedTransport(httpx.HTTPTransport):
+    """
+    所有 genai.Client 共用的連線池：
+    - SDK 沒有指定逾時的請求會帶 timeout=None（代表不逾時），這裡改成 TIMEOUT；
+      以 HttpOptions(timeout=...) 指定單次逾時的請求則保留原設定
+    - SDK 的 httpx.Client 被回收時會呼叫 close()，共用連線池不能因此被關掉
+    - 在 closing_responses() 區塊內發出的請求，回應會被記下來以便確實關閉，
+      也可以由其他執行緒以 RequestTracker.cancel() 中止
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._pool._network_backend = _TrackedBackend(self._pool._network_backend)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        if all(v is None for v in request.extensions.get("timeout", {}).values()):
+            request.extensions["timeout"] = TIMEOUT.as_dict()
+        response = super().handle_request(request)
+        tracker = getattr(_tracked, "tracker", None)
+        if tracker is not None:
+            tracker._responses.append(response)
+        return response
+
+    def close(self) -> None:
+        pass
+
+    def shutdown(self) -> None:
+        super().close()
+
+
+_transport: _SharedTransport | None = None
+_clients: dict[str, genai.Client] = {}
+_lock = threading.Lock()
+_tracked = threading.local()
+# 保護 _TrackedStream.owner 的交接：中止時不會誤斷已交給其他請求的連線
+_stream_lock = threading.Lock()
+
+
+@contextmanager
+def closing_responses(tracker: RequestTracker | None = None):
+    """
+    區塊內（同一執行緒）發出的請求，回應在離開區塊時一律關閉。
+    串流讀到一半就放棄時 SDK 不會關閉回應，連線要等垃圾回收才會釋放；
+    有參考循環時可能一直佔用連線池的名額。
+    傳入的 tracker 可交給其他執行緒，用 cancel() 立即中止區塊內的請求。
+    """
+    tracker = tracker or RequestTracker()
+    _tracked.tracker = tracker
+    try:
+        yield tracker
+    finally:
+        _tracked.tracker = None
+        tracker._close()
+
+
+def open_pool(max_connections: int = MAX_CONNECTIONS) -> _SharedTransport:
+    """
+    建立一個連線池；一般請求共用 _get_transport() 的那一個，
+    需要不同上限的工作（例如批次 CLI）自己開一個，用完以 shutdown() 關閉。
+    """
+    ctx = ssl.create_default_context(
+        cafile=os.environ.get("SSL_CERT_FILE", certifi.where()),
+        capath=os.environ.get("SSL_CERT_DIR"),
+    )
+    return _SharedTransport(
+        verify=ctx,
+        http2=HTTP2_ENABLED,
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=min(MAX_KEEPALIVE, max_connections),
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+        retries=1,  # 只重試連線建立失敗，不重送請求本體
+    )
+
+
+def _get_transport() -> _SharedTransport:
+    global _transport
+    if _transport is None:
+        _transport = open_pool()
+    return _transport
+
+
+def client_for(api_key: str, transport: _SharedTransport) -> genai.Client:
+    """以指定的連線池建立 genai.Client（不快取）"""
+    return genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(client_args={"transport": transport}),
+    )
+
+
+def get_client(api_key: str | None = None) -> genai.Client:
+    """取得指定 Key（預設為目前 Key）的長駐 genai.Client，同一把 Key 只建立一次。"""
+    key = api_key or get_api_key()
+    with _lock:
+        cli = _clients.get(key)
+        if cli is None:
+            cli = _clients[key] = client_for(key, _get_transport())
+        return cli
+
+
+def prewarm(api_keys: list[str] | None = None) -> None:
+    """啟動時預先建立 client 與 TLS 連線，讓第一次呼叫不用等握手。"""
+    for key in api_keys or API_KEYS:
+        get_client(key)
+    try:
+        with httpx.Client(transport=_get_transport()) as warm:
+            warm.head(GEMINI_BASE_URL)
+        logging.info(
+            f"Gemini 連線池預熱完成（HTTP/{'2' if HTTP2_ENABLED else '1.1'}）"
+        )
+    except Exception as e:
+        logging.warning(f"Gemini 連線預熱失敗：{e}")
+
+
+def prewarm_in_background() -> None:
+    """在背景執行緒預熱，不拖慢伺服器啟動。"""
+    threading.Thread(target=prewarm, name="gemini-prewarm", daemon=True).start()
+
+
+def shutdown() -> None:
+    """關閉共用連線池（伺服器結束時呼叫）。"""
+    global _transport
+    with _lock:
+        _clients.clear()
+        if _transport is not None:
+            _transport.shutdown()
+            _transport = None
+
+
+if __name__ == "__main__":
+    # 簡易基準：比較「每次新建 client」與「共用長駐 client」的首次 / 穩定延遲
+    # 用法：python gemini_client.py [model] [rounds]
+    import sys
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    model = sys.argv[1] if len(sys.argv) > 1 else "gemini-2.5-flash"
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    contents = [{"role": "user", "parts": [{"text": "Hello"}]}]
+
+    def _timed(make_client) -> float:
+        start = time.perf_counter()
+        make_client().models.generate_content(model=model, contents=contents)
+        return (time.perf_counter() - start) * 1000
+
+    fresh = [_timed(lambda: genai.Client(api_key=get_api_key())) for _ in range(rounds)]
+    prewarm([get_api_key()])
+    pooled = [_timed(get_client) for _ in range(rounds)]
+
+    for label, samples in (("每次新建 client", fresh), ("共用連線池", pooled)):
+        steady = sorted(samples[1:]) or samples
+        logging.info(
+            f"{label}：首次 {samples[0]:.0f} ms，"
+            f"穩定中位數 {steady[len(steady) // 2]:.0f} ms（{rounds} 次）"
+        )
+    shutdown()
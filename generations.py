@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import os
+import secrets
+import threading
+import time
+
+from fastapi import Request
+from starlette.concurrency import run_in_threadpool
+
+import completion_cache
+import gemini_client
+import model_router
+
+# ================== 生成中止設定 ==================
+# 等待模型回覆期間，每隔多久檢查一次用戶端是否已斷線（秒）
+DISCONNECT_POLL = 0.25
+# 用戶端斷線（重新整理、關閉視窗）時是否保留已產生的部分內容
+KEEP_PARTIAL_ON_DISCONNECT = os.environ.get("GEMINICHAT_KEEP_PARTIAL_ON_DISCONNECT", "0") == "1"
+# 中止後最多等工作執行緒收尾多久（秒），上游連線確實關閉後才歸還准入名額
+CANCEL_GRACE = float(os.environ.get("GEMINICHAT_CANCEL_GRACE", "2"))
+# =================================================
+
+
+class GenerationCancelled(Exception):
+    """生成被中止；partial 為中止前已產生的內容，keep_partial 表示要保留下來"""
+
+    def __init__(self, gen: "Generation"):
+        super().__init__(f"生成已中止（{gen.reason}）")
+        self.partial = gen.text
+        self.keep_partial = gen.keep_partial
+        self.reason = gen.reason
+
+
+class Generation:
+    """
+    一次進行中的生成：串流回來的片段暫存在這裡，cancel_event 由工作執行緒在片段之間檢查。
+    tracker 讓中止的一方直接中斷 HTTP 連線，不必等到下一個片段（第一個片段可能要等很久）。
+    """
+
+    def __init__(self, gen_id: str, user_id: int, conversation_id: int):
+        self.id = gen_id
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.started = time.monotonic()
+        self.cancel_event = threading.Event()
+        self.chunks: list[str] = []
+        self.keep_partial = False
+        self.reason: str | None = None
+        self.tracker = gemini_client.RequestTracker()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    @property
+    def text(self) -> str:
+        return "".join(self.chunks)
+
+    def cancel(self, reason: str, keep_partial: bool = False) -> None:
+        if self.cancelled:
+            return
+        self.reason = reason
+        self.keep_partial = keep_partial
+        self.cancel_event.set()
+        self.tracker.cancel()
+
+
+# 只在事件迴圈中增刪，不需要鎖
+_active: dict[str, Generation] = {}
+
+
+def generation_id(request: Request) -> str:
+    """前端以 X-Generation-Id 標頭指定 id，之後才能用它中止；沒有就由伺服器產生"""
+    gen_id = request.headers.get("X-Generation-Id", "")
+    if not gen_id or len(gen_id) > 64 or gen_id in _active:
+        return secrets.token_urlsafe(9)
+    return gen_id
+
+
+def register(gen_id: str, user_id: int, conversation_id: int) -> Generation:
+    gen = Generation(gen_id, user_id, conversation_id)
+    _active[gen_id] = gen
+    return gen
+
+
+def cancel(user_id: int, gen_id: str | None = None, keep_partial: bool = False) -> int:
+    """中止使用者的某個生成（未指定 id 時中止全部），回傳中止的數量"""
+    targets = [
+        gen
+        for gen in _active.values()
+        if gen.user_id == user_id and gen_id in (None, gen.id) and not gen.cancelled
+    ]
+    for gen in targets:
+        gen.cancel("stopped", keep_partial)
+    return len(targets)
+
+
+def _stream(
+    gen: Generation, client, model: str, contents: list, mode: str, prompt_tokens: int
+) -> tuple[str, bool]:
+    """實際發出串流請求；回傳 (累積的文字, 是否完整產生完畢)"""
+    gen.chunks.clear()
+    start = time.perf_counter()
+    usage = None
+    try:
+        with gemini_client.closing_responses(gen.tracker):
+            for chunk in client.models.generate_content_stream(model=model, contents=contents):
+                if chunk.text:
+                    gen.chunks.append(chunk.text)
+                usage = chunk.usage_metadata or usage
+                if gen.cancelled:
+                    break
+    except Exception as e:
+        # 中止時連線被直接中斷，讀取端會收到連線錯誤：視為中止而不是模型失敗
+        if not gen.cancelled:
+            model_router.observe(
+                model,
+                mode,
+                model_router.classify_error(e),
+                int((time.perf_counter() - start) * 1000),
+                prompt_tokens,
+            )
+            raise
+
+    model_router.observe(
+        model,
+        mode,
+        "cancelled" if gen.cancelled else "ok",
+        int((time.perf_counter() - start) * 1000),
+        (usage.prompt_token_count if usage else None) or prompt_tokens,
+        usage.candidates_token_count if usage else None,
+    )
+    return gen.text, not gen.cancelled
+
+
+def stream(
+    gen: Generation,
+    client,
+    model: str,
+    contents: list,
+    mode: str,
+    prompt_tokens: int | None = None,
+) -> str:
+    """
+    以串流呼叫模型（在執行緒池中執行），每收到一個片段就檢查是否被中止；
+    中止時中斷 HTTP 連線，模型不再繼續產生、也不再消耗配額。
+    同時進行中的相同請求（例如連點兩下送出）只實際呼叫一次，其餘等待並沿用完整回覆；
+    帶頭的生成被中止時，等待中的請求重新排一次，不沿用部分內容。
+    回傳目前累積的文字（被中止時為部分內容）。
+    """
+    if prompt_tokens is None:
+        prompt_tokens = model_router.thread_tokens(contents)
+    # auto 模式換下一個模型重試時，前一次的片段作廢
+    gen.chunks.clear()
+    key = completion_cache.request_key(model, contents, {"stream": True})
+    while not gen.cancelled:
+        led = False
+
+        def _lead() -> tuple[str, bool]:
+            nonlocal led
+            led = True
+            return _stream(gen, client, model, contents, mode, prompt_tokens)
+
+        try:
+            text, complete = completion_cache.single_flight(key, _lead, gen.cancel_event)
+        except completion_cache.Abandoned:
+            break  # 自己被中止：不再等帶頭的請求，工作執行緒立即結束
+        if led:
+            return text
+        if complete:
+            gen.chunks[:] = [text]
+            return text
+    return gen.text
+
+
+async def run(request: Request, gen: Generation, fn, *args):
+    """
+    在執行緒池中執行 fn(*args)，期間持續檢查用戶端是否斷線。
+    被中止時連線已由 Generation.cancel() 中斷，最多再等 CANCEL_GRACE 秒讓工作執行緒收尾
+    後拋出 GenerationCancelled；准入名額在上游請求確實結束後才歸還。
+    """
+    task = asyncio.ensure_future(run_in_threadpool(fn, *args))
+    # 提早離開時仍要取走工作執行緒的結果，避免「例外未被取用」的警告
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL)
+            if done and not gen.cancelled:
+                return task.result()
+            if not gen.cancelled and await request.is_disconnected():
+                logging.info(f"用戶端已斷線，中止生成 {gen.id}")
+                gen.cancel("disconnected", KEEP_PARTIAL_ON_DISCONNECT)
+            if gen.cancelled:
+                await asyncio.wait({task}, timeout=CANCEL_GRACE)
+                raise GenerationCancelled(gen)
+    finally:
+        _active.pop(gen.id, None)
@@ -1,27 +1,38 @@
-from fastapi import FastAPI, Form, Request
+from fastapi import Depends, FastAPI, File, Form, HTTPException, Path, Request, UploadFile
 from fastapi.responses import (
     HTMLResponse,
     RedirectResponse,
     PlainTextResponse,
     JSONResponse,
+    FileResponse,
+    Response,
 )  # 確保 PlainTextResponse 已匯入
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
-import io
 import json
+from contextlib import asynccontextmanager
+import functools
 import logging
 import os
 import sys
+import time
 from typing import Optional
-from google import genai
 from google.genai.types import Content, Part
 import google.generativeai as legacy_genai
 import uvicorn
 import socket
-from markupsafe import Markup
-import markdown2
 from apikey import get_api_key, switch_to_next_key, get_current_index, get_total_keys
-from starlette.middleware.sessions import SessionMiddleware
+import gemini_client
+import attachments
+import retrieval
+from rendering import templates, message_html
+import compare
+import generations
+import model_router
+import maintenance
+import completion_cache
+from admission import admission, AdmissionRejected
+from starlette.concurrency import run_in_threadpool
+from session_store import ServerSideSessionMiddleware
 import urllib.parse
 from database import (
     init_db,
@@ -30,31 +41,55 @@ from database import (
     load_conversations,
     load_messages,
     save_message,
+    get_message,
+    load_siblings,
+    set_active_branch,
     delete_user_messages,
     update_conversation_title,
+    ConversationDeleted,
     get_conversation,
     delete_conversation,  # 確保 delete_conversation 已匯入
+    get_attachment,
+    link_attachments,
+    load_message_attachments,
+    model_call_summary,
+    user_can_access_attachment,
 )
 
 init_db()  # 應用程式啟動時初始化資料庫
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 啟動時預熱 Gemini 連線池，結束時釋放
+    gemini_client.prewarm_in_background()
+    model_router.load_history()
+    maintenance.start()
+    yield
+    maintenance.stop()
+    gemini_client.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
-templates.env.filters["markdown"] = lambda text: Markup(
-    markdown2.markdown(text, extras=["fenced-code-blocks", "code-friendly"])
-)
-app.add_middleware(SessionMiddleware, secret_key="Gemini-API-Chat")
+# session 內容存在伺服器端，cookie 只放 session id
+app.add_middleware(ServerSideSessionMiddleware)
 
 # 日誌設定
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
-sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8")
-sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding="utf-8")
+# 就地改編碼；另包一層 TextIOWrapper 會在舊物件被回收時關閉底層檔案
+sys.stdout.reconfigure(encoding="utf-8")
+sys.stderr.reconfigure(encoding="utf-8")
 
 # API 金鑰設定
 current_key = get_api_key()
 legacy_genai.configure(api_key=current_key)
-client = genai.Client(api_key=current_key)
+client = gemini_client.get_client(current_key)
+
+# 歷史訊息分頁：首屏只載入少量訊息，往上捲動時再以 keyset 分頁載入更舊的
+INITIAL_PAGE_SIZE = 20
+HISTORY_PAGE_SIZE = 30
+HISTORY_PAGE_MAX = 100
 
 # 聊天訊息緩存
 chat_messages: list[dict[str, str]] = []
@@ -191,9 +226,12 @@ def get_available_models() -> list[str]:
             try:
                 # 檢查該模型是否支援 generateContent
                 # 某些 SDK 的模型物件有 supported_generation_methods，此處用一次性嘗試最保險
-                client.models.generate_content(
-                    model=nm,
-                    contents=[{"role": "user", "parts": [{"text": "Hello"}]}],
+                model_router.call(
+                    client,
+                    nm,
+                    [{"role": "user", "parts": [{"text": "Hello"}]}],
+                    "probe",
+                    cache_ttl=completion_cache.PROBE_CACHE_TTL,
                 )
                 usable.append(nm)
             except Exception:
@@ -239,9 +277,13 @@ def get_available_models() -> list[str]:
 
 
 def get_default_model() -> str:
-    """取得預設模型名稱"""
+    """取得預設模型名稱：優先 gemini-2.5-flash，它目前被暫停時改用路由器排名第一的模型"""
     available = get_available_models()
-    return "gemini-2.5-flash" if "gemini-2.5-flash" in available else available[0]
+    preferred = "gemini-2.5-flash" if "gemini-2.5-flash" in available else available[0]
+    if model_router.is_healthy(preferred):
+        return preferred
+    ranked = model_router.rank(model_router.auto_candidates(available), 0)
+    return ranked[0] if ranked else preferred
 
 
 def reping_all_models() -> list[str]:
@@ -255,9 +297,12 @@ def reping_all_models() -> list[str]:
             name = getattr(m, "name", "").split("/")[-1]
             if "generateContent" in getattr(m, "supported_generation_methods", []):
                 try:
-                    client.models.generate_content(
-                        model=name,
-                        contents=[{"role": "user", "parts": [{"text": "Hello"}]}],
+                    model_router.call(
+                        client,
+                        name,
+                        [{"role": "user", "parts": [{"text": "Hello"}]}],
+                        "probe",
+                        cache_ttl=completion_cache.PROBE_CACHE_TTL,
                     )
                     usable.append(name)
                 except Exception as e:
@@ -297,7 +342,7 @@ def call_gemini(prompt: str, model_name: str, thread: list[Content]) -> str:
         # 新增使用者訊息到 thread
         thread.append(Content(role="user", parts=[Part(text=prompt)]))
         # 真正呼叫
-        res = client.models.generate_content(model=model_name, contents=thread)
+        res = completion_cache.generate_content(client, model_name, thread)
         # 新增模型回覆到 thread
         thread.append(Content(role="model", parts=[Part(text=res.text)]))
         return res.text
@@ -309,13 +354,38 @@ def call_gemini(prompt: str, model_name: str, thread: list[Content]) -> str:
             f"已切換到第 {get_current_index() + 1} 組 API Key（共 {get_total_keys()} 組）"
         )
         legacy_genai.configure(api_key=new_key)
-        # 更新 client 物件
-        globals()["client"] = genai.Client(api_key=new_key)
+        # 更新 client 物件（沿用該 Key 的長駐 client 與共用連線池）
+        globals()["client"] = gemini_client.get_client(new_key)
+        # 舊 Key 的探測結果不再可信
+        completion_cache.clear()
         # 重新掃描模型快取
         reping_models_and_update_cache()
         return "[發生錯誤，請重新整理然後再次送出]"
 
 
+def _load_history_page(
+    cid: int, limit: int, before_id: int | None = None
+) -> tuple[list[dict], bool]:
+    """載入一頁歷史訊息，多取一筆用來判斷是否還有更舊的訊息"""
+    msgs = load_messages(cid, limit=limit + 1, before_id=before_id)
+    has_more = len(msgs) > limit
+    msgs = msgs[1:] if has_more else msgs
+    _attach_to_messages(msgs)
+    # 有分岔的訊息帶上兄弟 id，前端顯示「‹ 2/3 ›」切換分支
+    siblings = load_siblings(cid, msgs)
+    for m in msgs:
+        m["siblings"] = siblings.get(m["id"], [])
+    return msgs, has_more
+
+
+def _attach_to_messages(msgs: list[dict]) -> dict[int, list[dict]]:
+    """替訊息補上 attachments 欄位（一次查詢），並回傳 {message_id: 附件}"""
+    found = load_message_attachments([m["id"] for m in msgs])
+    for m in msgs:
+        m["attachments"] = found.get(m["id"], [])
+    return found
+
+
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
     username = request.session.get("username")
@@ -333,13 +403,14 @@ async def index(request: Request):
     # 關鍵：首屏也把當前會話寫進 session（保險）
     request.session["conversation_id"] = cid
 
-    msgs = load_messages(cid)
+    msgs, has_more = _load_history_page(cid, INITIAL_PAGE_SIZE)
 
     return templates.TemplateResponse(
         "index.html",
         {
             "request": request,
             "chat_messages": msgs,
+            "has_more": has_more,
             "conversation_id": cid,
             "model_list": get_available_models(),
             "default_model": get_default_model(),
@@ -374,91 +445,549 @@ async def models_status():
     return JSONResponse(status)
 
 
-@app.post("/chat", response_class=HTMLResponse)
+def _admission_user(request: Request) -> str:
+    """准入控制以使用者名稱區分；未登入時退回用戶端 IP"""
+    username = request.session.get("username")
+    if username:
+        return f"user:{username}"
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+
+async def chat_admission(request: Request):
+    """/chat 的准入控制：排隊取得名額，超載時回 429 + Retry-After"""
+    user = _admission_user(request)
+    try:
+        await admission.acquire(user)
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    try:
+        yield
+    finally:
+        admission.release(user)
+
+
+@app.get("/api/queue")
+async def queue_status(request: Request):
+    """回報目前使用者在 /chat 佇列中的位置（0 = 未排隊）"""
+    user = _admission_user(request)
+    return JSONResponse(
+        {
+            "position": admission.queue_position(user),
+            "inflight": admission.inflight(user),
+            "queued": admission.queued(),
+        }
+    )
+
+
+def _chat_conversation_id(request: Request, conversation_id: int | None) -> int | None:
+    """以 session 中的目前會話為準，Form 的 conversation_id 只作為備援"""
+    session_cid = request.session.get("conversation_id")
+    if session_cid is not None:
+        return int(session_cid)
+    return conversation_id
+
+
+def _owned_conversation(request: Request, cid: int) -> dict | None:
+    """目前使用者自己、且未被刪除的會話；別人的或已刪除的會話一律當作不存在"""
+    conv = get_conversation(cid)
+    if conv is None or conv["user_id"] != request.session.get("user_id"):
+        return None
+    return conv
+
+
+async def _store_uploads(files: list[UploadFile]) -> list[dict]:
+    """附件以串流方式寫入內容定址儲存區（相同內容只存一份）"""
+    return [
+        await run_in_threadpool(attachments.store_upload, f.file, f.filename, f.content_type)
+        for f in files
+        if f.filename
+    ]
+
+
+async def _build_chat_thread(
+    user_id: int,
+    conversation_id: int,
+    user_input: str,
+    new_attachments: list[dict],
+    before_id: int | None = None,
+) -> tuple[list[Content], int | None]:
+    """
+    系統提示 + 其他會話的相關片段 + 本會話歷史（含附件）+ 本次輸入。
+    歷史只取目前分支；before_id 用於重新產生 / 編輯：只取該則訊息之前的路徑。
+    一併回傳歷史的最後一則訊息 id：新訊息要接在它之後，而不是生成期間才變動的
+    active_leaf_id（例如同時切換了分支，或另一個分頁先存了訊息）。
+    """
+    # 從資料庫載入當前對話的歷史訊息，每次 API 呼叫都帶完整上下文
+    db_messages = load_messages(conversation_id, before_id=before_id)
+    chat_thread: list[Content] = [
+        Content(role="user", parts=[Part(text=system_prompt)])
+    ]
+
+    # 從使用者其他會話檢索相關片段，接在系統提示之後
+    context = await run_in_threadpool(
+        retrieval.build_context, user_id, conversation_id, user_input
+    )
+    if context:
+        chat_thread.append(Content(role="user", parts=[Part(text=context)]))
+
+    # 歷史訊息的附件沿用已上傳的檔案控制代碼，不重送檔案內容
+    history_attachments = _attach_to_messages(db_messages)
+    api_key = get_api_key()
+
+    async def _parts(text: str, records: list[dict]) -> list[Part]:
+        parts = [Part(text=text)]
+        for rec in records:
+            parts.append(
+                await run_in_threadpool(attachments.gemini_part, client, api_key, rec)
+            )
+        return parts
+
+    for msg in db_messages:
+        chat_thread.append(
+            Content(
+                role=msg["role"],
+                parts=await _parts(msg["text"], history_attachments.get(msg["id"], [])),
+            )
+        )
+
+    # 將使用者本次輸入新增到 thread 的末端
+    chat_thread.append(
+        Content(role="user", parts=await _parts(user_input, new_attachments))
+    )
+    return chat_thread, (db_messages[-1]["id"] if db_messages else None)
+
+
+async def _generate_reply(
+    request: Request, conversation_id: int, model: str, chat_thread: list[Content]
+) -> tuple[str, str, str | None]:
+    """
+    以串流呼叫模型（auto 時自動路由），回傳 (回覆, 實際使用的模型, 自動選到的模型或 None)。
+    生成登記為可中止的工作：使用者按停止或用戶端斷線時拋出 generations.GenerationCancelled。
+    """
+    gen = generations.register(
+        generations.generation_id(request), request.session["user_id"], conversation_id
+    )
+    stream = functools.partial(generations.stream, gen)
+    # 在執行緒池中呼叫，避免阻塞事件迴圈（其他使用者的請求才能同時進行）
+    if model == model_router.AUTO_MODEL:
+        reply_text, routed_model = await generations.run(
+            request,
+            gen,
+            model_router.generate_auto,
+            client,
+            get_available_models(),
+            chat_thread,
+            None,
+            stream,
+        )
+        return reply_text, routed_model, routed_model
+    reply_text = await generations.run(request, gen, stream, client, model, chat_thread, "chat")
+    return reply_text, model, None
+
+
+def _kept_partial(e: generations.GenerationCancelled) -> str | None:
+    """被中止的生成若使用者要保留、且確實有內容，回傳部分內容；否則為 None（什麼都不存）"""
+    if e.keep_partial and e.partial.strip():
+        return e.partial
+    return None
+
+
+async def _maybe_generate_title(conversation_id: int, model: str, user_input: str) -> str | None:
+    """會話還是預設標題時，請模型依第一則輸入產生標題"""
+    conv = get_conversation(conversation_id)
+    if not conv or conv["title"] != "新的對話":
+        return None
+    title_prompt = (
+        "請為以下對話內容提供一句話簡短扼要的標題，字數6字以內，風格不要太死板，直接給我標題就好：\n"
+        + user_input
+    )
+    title_res = await run_in_threadpool(
+        completion_cache.generate_content,
+        client,
+        model,
+        [Content(role="user", parts=[Part(text=title_prompt)])],
+        cache_ttl=completion_cache.TITLE_CACHE_TTL,
+    )
+    new_title = title_res.text.strip()
+    update_conversation_title(conversation_id, new_title)
+    return new_title
+
+
+def _dual_messages_response(
+    request: Request,
+    user_input: str,
+    new_attachments: list[dict],
+    reply_text: str,
+    new_title: str | None,
+    routed_model: str | None = None,
+    user_mid: int | None = None,
+    ai_mid: int | None = None,
+) -> HTMLResponse:
+    response = templates.TemplateResponse(
+        "partials/dual_messages.html",
+        {
+            "request": request,
+            "user_msg": {
+                "id": user_mid,
+                "role": "user",
+                "text": user_input,
+                "attachments": new_attachments,
+            },
+            "ai_msg": {
+                "id": ai_mid,
+                "role": "model",
+                "text": reply_text,
+                "model": routed_model,
+            },
+        },
+    )
+    if new_title:
+        response.headers["X-New-Conversation-Title"] = urllib.parse.quote(
+            new_title, safe=""
+        )
+    return response
+
+
+@app.post("/chat", response_class=HTMLResponse, dependencies=[Depends(chat_admission)])
 async def chat(
     request: Request,
     user_input: str = Form(...),
     model: str = Form(...),
     conversation_id: int = Form(None),
+    files: list[UploadFile] = File(default=[]),
 ):
     username = request.session.get("username")
     if not username:
         return HTMLResponse("請先登入", status_code=401)
 
-    session_cid = request.session.get("conversation_id")
-    if session_cid is not None:
-        conversation_id = int(session_cid)
+    conversation_id = _chat_conversation_id(request, conversation_id)
     if conversation_id is None:
         # 如果 session 和 Form 都沒有提供 conversation_id，則返回錯誤
         return HTMLResponse("缺少會話 ID", status_code=400)
+    if _owned_conversation(request, conversation_id) is None:
+        return HTMLResponse("找不到這個會話，可能已被刪除", status_code=404)
 
-    # ============ 修改開始 ============
+    try:
+        new_attachments = await _store_uploads(files)
+    except attachments.AttachmentError as e:
+        return HTMLResponse(str(e), status_code=e.status_code)
 
-    # 1. 從資料庫載入當前對話的所有歷史訊息
-    db_messages = load_messages(conversation_id)
+    try:
+        chat_thread, leaf_id = await _build_chat_thread(
+            request.session["user_id"], conversation_id, user_input, new_attachments
+        )
+        try:
+            reply_text, model, routed_model = await _generate_reply(
+                request, conversation_id, model, chat_thread
+            )
+            stopped = False
+        except generations.GenerationCancelled as e:
+            reply_text, routed_model, stopped = _kept_partial(e), None, True
+            if reply_text is None:
+                # 不保留：什麼都不存，輸入框的內容留給使用者修改後重送
+                return Response(status_code=204)
+
+        # 儲存使用者訊息和 AI 回覆到資料庫（接在建立 thread 時的分支末端）
+        user_mid = save_message(conversation_id, "user", user_input, parent_id=leaf_id, fork=True)
+        link_attachments(user_mid, new_attachments)
+        ai_mid = save_message(conversation_id, "model", reply_text, parent_id=user_mid, fork=True)
+
+        new_title = (
+            None if stopped else await _maybe_generate_title(conversation_id, model, user_input)
+        )
+        return _dual_messages_response(
+            request,
+            user_input,
+            new_attachments,
+            reply_text,
+            new_title,
+            routed_model,
+            user_mid,
+            ai_mid,
+        )
+    except ConversationDeleted:
+        # 生成期間會話在另一個分頁被刪除：不寫入（寫了也會被背景清理默默刪掉）
+        return HTMLResponse("找不到這個會話，可能已被刪除", status_code=404)
+    except Exception as e:
+        logging.error(f"Chat 端點錯誤：{e}")
+        # 這裡可以加入呼叫 switch_to_next_key() 的邏輯，但為了精簡，先省略
+        return HTMLResponse("伺服器錯誤", status_code=500)
 
-    # 2. 建立一個包含系統提示和所有歷史訊息的完整對話線程
-    #    這確保了每一次 API 呼叫都擁有完整的上下文
-    chat_thread: list[Content] = [
-        Content(role="user", parts=[Part(text=system_prompt)])
-    ]
 
-    for msg in db_messages:
-        chat_thread.append(Content(role=msg["role"], parts=[Part(text=msg["text"])]))
+@app.post("/chat/compare", response_class=HTMLResponse)
+async def chat_compare(
+    request: Request,
+    user_input: str = Form(...),
+    compare_models: list[str] = Form(default=[]),
+    conversation_id: int = Form(None),
+    files: list[UploadFile] = File(default=[]),
+):
+    """
+    比較模式：同一個 thread 同時送給多個模型，各自在並排的窗格中載入。
+    准入名額不在這裡取得：每個模型的呼叫各自排隊取得一個，呼叫結束才歸還。
+    """
+    username = request.session.get("username")
+    if not username:
+        return HTMLResponse("請先登入", status_code=401)
+
+    conversation_id = _chat_conversation_id(request, conversation_id)
+    if conversation_id is None:
+        return HTMLResponse("缺少會話 ID", status_code=400)
+    if _owned_conversation(request, conversation_id) is None:
+        return HTMLResponse("找不到這個會話，可能已被刪除", status_code=404)
 
-    # ============ 修改結束 ============
+    models = list(dict.fromkeys(compare_models))
+    if not 2 <= len(models) <= compare.MAX_MODELS:
+        return HTMLResponse(
+            f"比較模式請選擇 2～{compare.MAX_MODELS} 個模型", status_code=400
+        )
 
     try:
-        # 將使用者本次輸入新增到 thread 的末端，然後呼叫 Gemini API
-        chat_thread.append(Content(role="user", parts=[Part(text=user_input)]))
-        reply_text = client.models.generate_content(
-            model=model, contents=chat_thread
-        ).text
-
-        # 儲存使用者訊息和 AI 回覆到資料庫
-        save_message(conversation_id, "user", user_input)
-        save_message(conversation_id, "model", reply_text)
-
-        # 這裡的邏輯與你原本的程式碼保持一致
-        conv = get_conversation(conversation_id)
-        if conv and conv["title"] == "新的對話":
-            title_prompt = (
-                "請為以下對話內容提供一句話簡短扼要的標題，字數6字以內，風格不要太死板，直接給我標題就好：\n"
-                + user_input
-            )
-            title_res = client.models.generate_content(
-                model=model,
-                contents=[Content(role="user", parts=[Part(text=title_prompt)])],
-            )
-            new_title = title_res.text.strip()
-            update_conversation_title(conversation_id, new_title)
-            response = templates.TemplateResponse(
-                "partials/dual_messages.html",
-                {
-                    "request": request,
-                    "user_msg": {"role": "user", "text": user_input},
-                    "ai_msg": {"role": "model", "text": reply_text},
-                },
-            )
-            response.headers["X-New-Conversation-Title"] = urllib.parse.quote(
-                new_title, safe=""
-            )
-            return response
-
-        # 由於現在每次都從資料庫讀取，session 裡的 chat_states 不再需要複雜更新
-        # 這裡可以精簡為只返回 HTML，或者保持不變以避免其他潛在影響
-        return templates.TemplateResponse(
-            "partials/dual_messages.html",
-            {
-                "request": request,
-                "user_msg": {"role": "user", "text": user_input},
-                "ai_msg": {"role": "model", "text": reply_text},
+        new_attachments = await _store_uploads(files)
+    except attachments.AttachmentError as e:
+        return HTMLResponse(str(e), status_code=e.status_code)
+
+    try:
+        chat_thread, leaf_id = await _build_chat_thread(
+            request.session["user_id"], conversation_id, user_input, new_attachments
+        )
+    except Exception as e:
+        logging.error(f"比較模式建立對話內容失敗：{e}")
+        return HTMLResponse("伺服器錯誤", status_code=500)
+
+    run = compare.start_run(
+        client,
+        _admission_user(request),
+        request.session["user_id"],
+        conversation_id,
+        user_input,
+        new_attachments,
+        models,
+        chat_thread,
+        leaf_id,
+    )
+    return templates.TemplateResponse(
+        "partials/compare_grid.html",
+        {
+            "request": request,
+            "run": run,
+            "user_msg": {
+                "role": "user",
+                "text": user_input,
+                "attachments": new_attachments,
             },
+        },
+    )
+
+
+@app.get("/chat/compare/{run_id}/{index}", response_class=HTMLResponse)
+async def chat_compare_pane(request: Request, run_id: str, index: int):
+    """等待單一模型的結果（最多到截止時間）並回傳該窗格"""
+    run = compare.get_run(run_id, request.session.get("user_id"))
+    if run is None or not 0 <= index < len(run.models):
+        return HTMLResponse("比較結果已過期", status_code=404)
+    result = await compare.wait_result(run, index)
+    return templates.TemplateResponse(
+        "partials/compare_pane.html",
+        {"request": request, "run": run, "index": index, "result": result},
+    )
+
+
+@app.post("/chat/compare/{run_id}/{index}/adopt", response_class=HTMLResponse)
+async def chat_compare_adopt(request: Request, run_id: str, index: int):
+    """採用其中一個模型的回答：寫入會話，比較區塊換成一般的訊息"""
+    run = compare.get_run(run_id, request.session.get("user_id"))
+    if run is None or not 0 <= index < len(run.models):
+        return HTMLResponse("比較結果已過期", status_code=404)
+    result = await compare.wait_result(run, index)
+    if result["status"] != "ok":
+        return HTMLResponse("這個模型沒有可用的回答", status_code=409)
+    # 取出比較與寫入之間沒有 await：同時送出的兩次採用只有一次拿得到
+    if compare.discard_run(run_id) is None:
+        return HTMLResponse("這次比較已經採用過了", status_code=409)
+
+    try:
+        user_mid = save_message(
+            run.conversation_id, "user", run.user_input, parent_id=run.parent_id, fork=True
+        )
+    except ConversationDeleted:
+        return HTMLResponse("找不到這個會話，可能已被刪除", status_code=404)
+    link_attachments(user_mid, run.attachments)
+    ai_mid = save_message(
+        run.conversation_id, "model", result["text"], parent_id=user_mid, fork=True
+    )
+    try:
+        new_title = await _maybe_generate_title(
+            run.conversation_id, result["model"], run.user_input
         )
     except Exception as e:
-        logging.error(f"Chat 端點錯誤：{e}")
-        # 這裡可以加入呼叫 switch_to_next_key() 的邏輯，但為了精簡，先省略
+        logging.warning(f"標題產生失敗：{e}")
+        new_title = None
+    return _dual_messages_response(
+        request,
+        run.user_input,
+        run.attachments,
+        result["text"],
+        new_title,
+        user_mid=user_mid,
+        ai_mid=ai_mid,
+    )
+
+
+@app.post("/chat/abort")
+async def chat_abort(
+    request: Request,
+    generation_id: str | None = Form(None),
+    keep_partial: bool = Form(False),
+):
+    """
+    中止進行中的生成（未指定 generation_id 時中止該使用者全部的生成）。
+    原本的 /chat 請求會立刻結束並歸還名額；keep_partial 時已產生的內容會存成回覆。
+    """
+    user_id = request.session.get("user_id")
+    if not user_id:
+        return JSONResponse({"error": "請先登入"}, status_code=401)
+    return JSONResponse(
+        {"cancelled": generations.cancel(user_id, generation_id or None, keep_partial)}
+    )
+
+
+# ====================== 重新產生 / 編輯 / 切換分支 ======================
+# 訊息以 parent_id 串成樹：重新產生與編輯都從指定的那一輪分岔出新的兄弟訊息，
+# 舊的分支原封不動，之後可以切換回去。回傳整個訊息列表（目前分支）取代 #chat-box。
+
+
+def _message_list_response(request: Request, cid: int) -> HTMLResponse:
+    msgs, has_more = _load_history_page(cid, INITIAL_PAGE_SIZE)
+    request.session["conversation_id"] = cid
+    return templates.TemplateResponse(
+        "partials/message_list.html",
+        {
+            "request": request,
+            "chat_messages": msgs,
+            "has_more": has_more,
+            "conversation_id": cid,
+            "active_cid": cid,
+        },
+    )
+
+
+def _conversation_message(cid: int, mid: int, role: str) -> dict | None:
+    msg = get_message(mid)
+    if msg is None or msg["conversation_id"] != cid or msg["role"] != role:
+        return None
+    return msg
+
+
+@app.post(
+    "/conversation/{cid}/messages/{mid}/regenerate",
+    response_class=HTMLResponse,
+    dependencies=[Depends(chat_admission)],
+)
+async def regenerate_message(request: Request, cid: int, mid: int, model: str = Form(...)):
+    """對同一則使用者訊息重新產生回答，新回答成為原回答的兄弟分支"""
+    if not request.session.get("username"):
+        return HTMLResponse("請先登入", status_code=401)
+    target = _owned_conversation(request, cid) and _conversation_message(cid, mid, "model")
+    prompt = target and target["parent_id"] and get_message(target["parent_id"])
+    if not prompt:
+        return HTMLResponse("找不到要重新產生的訊息", status_code=404)
+
+    try:
+        prompt_attachments = load_message_attachments([prompt["id"]]).get(prompt["id"], [])
+        chat_thread, _leaf = await _build_chat_thread(
+            request.session["user_id"],
+            cid,
+            prompt["text"],
+            prompt_attachments,
+            before_id=prompt["id"],
+        )
+        try:
+            reply_text, _model, _routed = await _generate_reply(request, cid, model, chat_thread)
+        except generations.GenerationCancelled as e:
+            reply_text = _kept_partial(e)
+            if reply_text is None:
+                return Response(status_code=204)
+        save_message(cid, "model", reply_text, parent_id=prompt["id"], fork=True)
+    except ConversationDeleted:
+        return HTMLResponse("找不到這個會話，可能已被刪除", status_code=404)
+    except Exception as e:
+        logging.error(f"重新產生回答失敗：{e}")
+        return HTMLResponse("伺服器錯誤", status_code=500)
+    return _message_list_response(request, cid)
+
+
+@app.post(
+    "/conversation/{cid}/messages/{mid}/edit",
+    response_class=HTMLResponse,
+    dependencies=[Depends(chat_admission)],
+)
+async def edit_message(
+    request: Request,
+    cid: int,
+    mid: int,
+    user_input: str = Form(...),
+    model: str = Form(...),
+):
+    """改寫某一則使用者訊息：從它的前一輪分岔出新的提問與回答，附件沿用原訊息"""
+    if not request.session.get("username"):
+        return HTMLResponse("請先登入", status_code=401)
+    original = _owned_conversation(request, cid) and _conversation_message(cid, mid, "user")
+    if not original:
+        return HTMLResponse("找不到要編輯的訊息", status_code=404)
+
+    try:
+        original_attachments = load_message_attachments([mid]).get(mid, [])
+        chat_thread, _leaf = await _build_chat_thread(
+            request.session["user_id"], cid, user_input, original_attachments, before_id=mid
+        )
+        try:
+            reply_text, _model, _routed = await _generate_reply(request, cid, model, chat_thread)
+        except generations.GenerationCancelled as e:
+            reply_text = _kept_partial(e)
+            if reply_text is None:
+                return Response(status_code=204)
+        user_mid = save_message(
+            cid, "user", user_input, parent_id=original["parent_id"], fork=True
+        )
+        link_attachments(user_mid, original_attachments)
+        save_message(cid, "model", reply_text, parent_id=user_mid, fork=True)
+    except ConversationDeleted:
+        return HTMLResponse("找不到這個會話，可能已被刪除", status_code=404)
+    except Exception as e:
+        logging.error(f"編輯訊息失敗：{e}")
         return HTMLResponse("伺服器錯誤", status_code=500)
+    return _message_list_response(request, cid)
+
+
+@app.post("/conversation/{cid}/branch/{mid}", response_class=HTMLResponse)
+async def switch_branch(request: Request, cid: int, mid: int):
+    """切換到包含 mid 的分支（沿最新的回覆走到末端）"""
+    if not request.session.get("username"):
+        return HTMLResponse("請先登入", status_code=401)
+    if _owned_conversation(request, cid) is None or set_active_branch(cid, mid) is None:
+        return HTMLResponse("找不到這個分支", status_code=404)
+    return _message_list_response(request, cid)
+
+
+@app.get("/api/models/router")
+async def api_model_router(request: Request):
+    """自動路由目前的即時統計（最近時間視窗內的延遲、錯誤率與暫停狀態）"""
+    if not request.session.get("user_id"):
+        return JSONResponse({"detail": "請先登入"}, status_code=401)
+    return JSONResponse(model_router.snapshot())
+
+
+@app.get("/api/models/stats")
+async def api_model_stats(request: Request, hours: float = 24):
+    """各模型最近的呼叫次數、延遲與 token 用量"""
+    if not request.session.get("user_id"):
+        return JSONResponse({"detail": "請先登入"}, status_code=401)
+    return JSONResponse(model_call_summary(time.time() - hours * 3600))
 
 
 @app.get("/reset", response_class=HTMLResponse)
@@ -538,7 +1067,14 @@ async def api_rename_conv(cid: int, title: str = Form(...)):
 
 @app.get("/conversation/{cid}")
 async def api_conversation(request: Request, cid: int, before: str | None = None):
-    msgs = load_messages(cid, before)
+    if _owned_conversation(request, cid) is None:
+        return HTMLResponse("找不到這個會話，可能已被刪除", status_code=404)
+    if before:
+        # 舊版以時間戳分頁的參數，保留相容
+        msgs, has_more = load_messages(cid, before), True
+        _attach_to_messages(msgs)
+    else:
+        msgs, has_more = _load_history_page(cid, INITIAL_PAGE_SIZE)
     request.session["conversation_id"] = cid
 
     active_cid = cid
@@ -548,12 +1084,111 @@ async def api_conversation(request: Request, cid: int, before: str | None = None
         {
             "request": request,
             "chat_messages": msgs,
+            "has_more": has_more,
             "conversation_id": cid,
             "active_cid": active_cid,
         },
     )
 
 
+@app.get("/conversation/{cid}/messages")
+async def api_conversation_messages(
+    request: Request, cid: int, before_id: int, limit: int = HISTORY_PAGE_SIZE
+):
+    """往上捲動載入更舊的訊息：精簡 JSON，HTML 已在伺服器端轉好"""
+    if not request.session.get("user_id"):
+        return JSONResponse({"detail": "請先登入"}, status_code=401)
+    if _owned_conversation(request, cid) is None:
+        return JSONResponse({"detail": "找不到這個會話"}, status_code=404)
+    msgs, has_more = _load_history_page(
+        cid, max(1, min(limit, HISTORY_PAGE_MAX)), before_id
+    )
+    return JSONResponse(
+        {
+            "messages": [
+                {
+                    "id": m["id"],
+                    "role": m["role"],
+                    "html": str(message_html(m)),
+                    "attachments": [
+                        {k: a[k] for k in ("sha256", "filename", "mime_type")}
+                        for a in m["attachments"]
+                    ],
+                    "siblings": m["siblings"],
+                }
+                for m in msgs
+            ],
+            "has_more": has_more,
+        }
+    )
+
+
+def _attachment_for(request: Request, sha256: str) -> dict | None:
+    """只有連結在自己會話訊息上的附件才看得到；其餘一律當作不存在"""
+    uid = request.session.get("user_id")
+    if not uid or not user_can_access_attachment(uid, sha256):
+        return None
+    rec = get_attachment(sha256)
+    if not rec or not os.path.exists(attachments.blob_path(sha256)):
+        return None
+    return rec
+
+
+@app.get("/attachments/{sha256}")
+async def api_attachment(request: Request, sha256: str = Path(pattern="^[0-9a-f]{64}$")):
+    rec = await run_in_threadpool(_attachment_for, request, sha256)
+    if rec is None:
+        return PlainTextResponse("找不到附件", status_code=404)
+    media_type, disposition = attachments.serve_as(rec["mime_type"])
+    return FileResponse(
+        attachments.blob_path(sha256),
+        media_type=media_type,
+        filename=rec["filename"],
+        content_disposition_type=disposition,
+        headers=attachments.SERVE_HEADERS,
+    )
+
+
+@app.get("/attachments/{sha256}/thumb")
+async def api_attachment_thumb(request: Request, sha256: str = Path(pattern="^[0-9a-f]{64}$")):
+    """圖片縮圖；背景尚未產生完成時先回傳原圖"""
+    rec = await run_in_threadpool(_attachment_for, request, sha256)
+    if rec is None:
+        return PlainTextResponse("找不到附件", status_code=404)
+    thumb = attachments.thumb_path(sha256)
+    if os.path.exists(thumb):
+        return FileResponse(thumb, media_type="image/webp", headers=attachments.SERVE_HEADERS)
+    return await api_attachment(request, sha256)
+
+
+@app.get("/api/db/stats")
+async def api_db_stats(request: Request):
+    """資料庫大小、碎片比例與封存狀態"""
+    if not request.session.get("user_id"):
+        return JSONResponse({"detail": "請先登入"}, status_code=401)
+    return JSONResponse(await run_in_threadpool(maintenance.db_stats))
+
+
+@app.get("/api/archive")
+async def api_archive_list(request: Request):
+    uid = request.session.get("user_id")
+    if not uid:
+        return JSONResponse({"detail": "請先登入"}, status_code=401)
+    return JSONResponse(maintenance.list_archived_conversations(uid))
+
+
+@app.post("/api/archive/{archived_id}/restore")
+async def api_archive_restore(request: Request, archived_id: int):
+    uid = request.session.get("user_id")
+    if not uid:
+        return PlainTextResponse("請先登入", status_code=401)
+    # 可能要等背景封存釋放該使用者的封存檔鎖，不在事件迴圈中等待
+    cid = await run_in_threadpool(maintenance.restore_conversation, uid, archived_id)
+    if cid is None:
+        return PlainTextResponse("找不到封存的對話", status_code=404)
+    return PlainTextResponse(str(cid))
+
+
 if __name__ == "__main__":
     hostname = socket.gethostname()
     local_ip = socket.gethostbyname(hostname)
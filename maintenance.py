@@ -0,0 +1,419 @@
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable
+
+import attachments
+import message_codec
+import retrieval
+from database import (
+    APP_DIR,
+    DB_PATH,
+    add_zdict,
+    compress_plain_messages,
+    compression_stats,
+    embedding_stats,
+    delete_conversation,
+    export_conversation,
+    get_compression_progress,
+    get_connection,
+    has_zdict,
+    import_conversation,
+    list_stale_conversations,
+    pin_archived_attachments,
+    purge_deleted_conversations,
+    purge_deleted_messages,
+    purge_model_calls,
+    sample_message_texts,
+    unpin_archived_attachments,
+)
+
+# ================== 維護設定 ==================
+# 超過幾天沒有活動的會話要封存（0 = 不封存）
+RETENTION_DAYS = int(os.environ.get("GEMINICHAT_RETENTION_DAYS", "0"))
+# 完整維護（封存、vacuum、optimize、完整性檢查）的執行間隔（秒）
+MAINTENANCE_INTERVAL = int(os.environ.get("GEMINICHAT_MAINTENANCE_INTERVAL", "21600"))
+# 每次增量 vacuum 釋放的頁數與批次間隔，讓寫入者有空檔取得鎖
+VACUUM_PAGES_PER_STEP = 256
+VACUUM_STEP_PAUSE = 0.05
+ARCHIVE_BATCH = 20
+# 背景清理已刪除會話：執行間隔、每批筆數與批次間隔
+REAPER_INTERVAL = int(os.environ.get("GEMINICHAT_REAPER_INTERVAL", "30"))
+REAPER_BATCH = 500
+REAPER_PAUSE = 0.02
+# 舊訊息壓縮搬移：執行間隔、每批筆數；至少要有這麼多則長訊息才訓練共用字典
+COMPRESS_INTERVAL = int(os.environ.get("GEMINICHAT_COMPRESS_INTERVAL", "600"))
+COMPRESS_BATCH = 200
+ZDICT_MIN_SAMPLES = 50
+# 清除未被引用附件的間隔
+ATTACHMENT_GC_INTERVAL = 24 * 60 * 60
+# 模型呼叫統計保留天數
+MODEL_CALL_RETENTION_DAYS = 30
+
+# 封存檔目錄：每位使用者一個 gzip 壓縮的 JSONL
+ARCHIVE_DIR = os.path.join(APP_DIR, "archive")
+os.makedirs(ARCHIVE_DIR, exist_ok=True)
+# =================================================
+
+
+# ----------------- 封存與還原 -----------------
+
+
+# 同一位使用者的封存檔同時只能有一個寫入者：背景封存附加與還原時的重寫
+# 若交錯進行，重寫會蓋掉剛附加的紀錄，而那些會話已從資料庫刪除
+_archive_locks: dict[int, threading.Lock] = {}
+_archive_locks_guard = threading.Lock()
+
+
+def _archive_lock(user_id: int) -> threading.Lock:
+    with _archive_locks_guard:
+        return _archive_locks.setdefault(user_id, threading.Lock())
+
+
+def _archive_path(user_id: int) -> str:
+    return os.path.join(ARCHIVE_DIR, f"user_{user_id}.jsonl.gz")
+
+
+def _read_archive(user_id: int) -> list[dict]:
+    path = _archive_path(user_id)
+    if not os.path.exists(path):
+        return []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def archive_old_conversations(days: int = RETENTION_DAYS) -> int:
+    """將超過保留天數的會話寫入使用者封存檔後從資料庫刪除，回傳封存數量。"""
+    if days <= 0:
+        return 0
+    cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    archived = 0
+    while True:
+        stale = list_stale_conversations(cutoff, limit=ARCHIVE_BATCH)
+        if not stale:
+            break
+        for conv in stale:
+            data = export_conversation(conv["id"])
+            if data is None:
+                continue
+            data["archived_at"] = datetime.utcnow().isoformat()
+            # 每筆封存是一個獨立的 gzip member 附加在檔尾，讀取時自動串接
+            # 先寫入並落盤再刪除；中途當機最多留下重複的封存紀錄，不會遺失資料
+            line = json.dumps(data, ensure_ascii=False) + "\n"
+            with _archive_lock(data["user_id"]):
+                with open(_archive_path(data["user_id"]), "ab") as f:
+                    f.write(gzip.compress(line.encode("utf-8")))
+                    f.flush()
+                    os.fsync(f.fileno())
+            # 訊息刪除後附件就沒有引用了，先登記讓清理工作保留檔案到還原為止
+            pin_archived_attachments(
+                data["user_id"],
+                data["id"],
+                [a["sha256"] for m in data["messages"] for a in m.get("attachments", [])],
+            )
+            delete_conversation(conv["id"])
+            archived += 1
+    if archived:
+        logging.info(f"已封存 {archived} 個超過 {days} 天未活動的會話")
+    return archived
+
+
+def list_archived_conversations(user_id: int) -> list[dict]:
+    """列出使用者已封存的會話（不含訊息內容）"""
+    latest: dict[int, dict] = {}
+    for item in _read_archive(user_id):
+        latest[item["id"]] = item  # 重複紀錄以最後一筆為準
+    return [
+        {
+            "id": item["id"],
+            "title": item["title"],
+            "created_at": item["created_at"],
+            "archived_at": item.get("archived_at"),
+            "message_count": len(item["messages"]),
+        }
+        for item in latest.values()
+    ]
+
+
+def restore_conversation(user_id: int, archived_id: int) -> int | None:
+    """將封存的會話還原回資料庫並從封存檔移除，回傳新的會話 ID；找不到則回 None。"""
+    # 讀取到重寫完成之間都持有鎖，背景封存不會在中間附加而被覆蓋
+    with _archive_lock(user_id):
+        items = _read_archive(user_id)
+        matches = [item for item in items if item["id"] == archived_id]
+        if not matches:
+            return None
+
+        cid = import_conversation(user_id, matches[-1])
+        unpin_archived_attachments(user_id, archived_id)
+
+        # 重寫封存檔（先寫暫存檔再取代，避免寫到一半損毀）
+        path = _archive_path(user_id)
+        rest = [item for item in items if item["id"] != archived_id]
+        if rest:
+            tmp = path + ".tmp"
+            with gzip.open(tmp, "wt", encoding="utf-8") as f:
+                for item in rest:
+                    f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            os.replace(tmp, path)
+        else:
+            os.remove(path)
+        return cid
+
+
+# ----------------- 軟刪除清理 -----------------
+
+
+def reap_deleted(max_batches: int = 1000) -> int:
+    """分批刪除已標記會話的訊息，批次間短暫讓出寫入鎖，最後移除空的會話列。"""
+    purged = 0
+    for _ in range(max_batches):
+        deleted = purge_deleted_messages(REAPER_BATCH)
+        purged += deleted
+        if deleted < REAPER_BATCH:
+            break
+        time.sleep(REAPER_PAUSE)
+    conversations = purge_deleted_conversations()
+    if purged or conversations:
+        logging.info(f"背景清理：刪除 {conversations} 個會話、{purged} 則訊息")
+    return purged
+
+
+# ----------------- 訊息壓縮 -----------------
+
+
+def compress_messages(max_batches: int = 1000) -> int:
+    """
+    必要時訓練共用字典，再把尚未壓縮的舊訊息分批改存壓縮版本，回傳壓縮筆數。
+    新訊息寫入時就會壓縮，所以只需從資料庫記錄的進度往前推進，重新啟動也不會從頭掃描。
+    """
+    if not has_zdict():
+        samples = sample_message_texts()
+        if len(samples) >= ZDICT_MIN_SAMPLES:
+            zid = add_zdict(message_codec.train_dictionary(samples))
+            logging.info(f"已由 {len(samples)} 則訊息訓練壓縮字典 #{zid}")
+
+    compressed = 0
+    cursor = get_compression_progress()
+    for _ in range(max_batches):
+        last, n = compress_plain_messages(cursor, COMPRESS_BATCH)
+        compressed += n
+        if last == cursor:
+            break
+        cursor = last
+        time.sleep(REAPER_PAUSE)
+    if compressed:
+        logging.info(f"已壓縮 {compressed} 則舊訊息")
+    return compressed
+
+
+# ----------------- 資料庫整理 -----------------
+
+
+def incremental_vacuum(max_steps: int = 1000) -> int:
+    """分批釋放空閒頁並縮小檔案，每批都是短交易，回傳釋放的頁數。"""
+    conn = get_connection()
+    freed = 0
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # 舊資料庫尚未轉成增量模式，incremental_vacuum 不會有作用
+            logging.info("資料庫尚未啟用增量 vacuum，可執行 `python maintenance.py vacuum` 轉換")
+            max_steps = 0
+        for _ in range(max_steps):
+            before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if before == 0:
+                break
+            conn.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES_PER_STEP})")
+            conn.commit()
+            freed += before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+            time.sleep(VACUUM_STEP_PAUSE)
+        # 把 WAL 內容寫回主檔並截斷，檔案大小才會真正縮小
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+    return freed
+
+
+def enable_incremental_vacuum() -> bool:
+    """
+    將舊資料庫轉為增量 vacuum 模式。需要一次完整 VACUUM：會重寫整個檔案並持有
+    獨佔鎖，大型資料庫可能要數分鐘，因此只在手動執行時做（請先關閉伺服器）。
+    已是增量模式時回傳 False。
+    """
+    conn = get_connection()
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return True
+    finally:
+        conn.close()
+
+
+def optimize() -> None:
+    """更新查詢規劃器統計資料：第一次完整 ANALYZE，之後交給 PRAGMA optimize 判斷。"""
+    conn = get_connection()
+    try:
+        has_stats = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+        ).fetchone()
+        conn.execute("PRAGMA optimize" if has_stats else "ANALYZE")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def integrity_check() -> list[str]:
+    """快速完整性檢查，回傳問題清單（空清單代表正常）。"""
+    conn = get_connection()
+    try:
+        rows = [r[0] for r in conn.execute("PRAGMA quick_check").fetchall()]
+    finally:
+        conn.close()
+    problems = [r for r in rows if r != "ok"]
+    if problems:
+        logging.error(f"資料庫完整性檢查發現問題：{problems[:10]}")
+    return problems
+
+
+def db_stats() -> dict:
+    """回報資料庫大小、碎片比例與封存檔大小"""
+    conn = get_connection()
+    try:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        conversations = conn.execute(
+            "SELECT COUNT(*) FROM conversations WHERE deleted_at IS NULL"
+        ).fetchone()[0]
+        tombstoned = conn.execute(
+            "SELECT COUNT(*) FROM conversations WHERE deleted_at IS NOT NULL"
+        ).fetchone()[0]
+        messages = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+    finally:
+        conn.close()
+
+    def _size(path: str) -> int:
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    return {
+        "db_bytes": _size(DB_PATH),
+        "wal_bytes": _size(DB_PATH + "-wal"),
+        "page_size": page_size,
+        "page_count": page_count,
+        "freelist_count": freelist,
+        "fragmentation": round(freelist / page_count, 4) if page_count else 0.0,
+        "auto_vacuum": {0: "none", 1: "full", 2: "incremental"}.get(auto_vacuum),
+        "conversations": conversations,
+        "conversations_pending_purge": tombstoned,
+        "messages": messages,
+        "archive_bytes": sum(
+            _size(os.path.join(ARCHIVE_DIR, name)) for name in os.listdir(ARCHIVE_DIR)
+        ),
+        "compression": compression_stats(),
+        "embeddings": embedding_stats(),
+        "retention_days": RETENTION_DAYS,
+        "last_runs": dict(_last_runs),
+    }
+
+
+def run_maintenance() -> None:
+    """完整維護流程：封存 → 清理已刪除資料 → 釋放空間 → 更新統計 → 完整性檢查"""
+    archive_old_conversations()
+    reap_deleted()
+    purge_model_calls(time.time() - MODEL_CALL_RETENTION_DAYS * 86400)
+    freed = incremental_vacuum()
+    optimize()
+    integrity_check()
+    stats = db_stats()
+    logging.info(
+        f"資料庫維護完成：釋放 {freed} 頁，檔案 {stats['db_bytes']} bytes，"
+        f"碎片比例 {stats['fragmentation']:.2%}"
+    )
+
+
+# ----------------- 背景排程 -----------------
+
+_jobs: list[dict] = []
+_last_runs: dict[str, str] = {}
+_stop = threading.Event()
+_thread: threading.Thread | None = None
+
+
+def register_job(name: str, interval: float, fn: Callable[[], object]) -> None:
+    """註冊週期性背景工作；第一次在啟動後 interval 秒執行"""
+    _jobs.append({"name": name, "interval": interval, "fn": fn, "next": 0.0})
+
+
+def _loop() -> None:
+    now = time.monotonic()
+    for job in _jobs:
+        job["next"] = now + job["interval"]
+    while not _stop.is_set():
+        now = time.monotonic()
+        for job in _jobs:
+            if now < job["next"]:
+                continue
+            try:
+                job["fn"]()
+                _last_runs[job["name"]] = datetime.utcnow().isoformat() + "Z"
+            except Exception as e:
+                logging.warning(f"背景維護工作 {job['name']} 失敗：{e}")
+            job["next"] = time.monotonic() + job["interval"]
+        wait = min((job["next"] for job in _jobs), default=now + 60) - time.monotonic()
+        _stop.wait(max(1.0, wait))
+
+
+def start() -> None:
+    """啟動背景維護執行緒（daemon，不阻擋程式結束）"""
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_loop, name="db-maintenance", daemon=True)
+    _thread.start()
+
+
+def stop() -> None:
+    _stop.set()
+
+
+register_job("reaper", REAPER_INTERVAL, reap_deleted)
+register_job("compress", COMPRESS_INTERVAL, compress_messages)
+register_job("attachments", ATTACHMENT_GC_INTERVAL, attachments.purge_orphans)
+register_job("embeddings", retrieval.INDEX_INTERVAL, retrieval.index_pending)
+register_job("maintenance", MAINTENANCE_INTERVAL, run_maintenance)
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    from database import init_db
+
+    parser = argparse.ArgumentParser(description="GeminiChat 資料庫維護")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("vacuum", help="將舊資料庫轉為增量 vacuum 模式（完整 VACUUM，請先關閉伺服器）")
+    sub.add_parser("run", help="立即執行一次完整維護")
+    sub.add_parser("stats", help="顯示資料庫統計")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    init_db()
+
+    if args.command == "vacuum":
+        before = os.path.getsize(DB_PATH)
+        if enable_incremental_vacuum():
+            logging.info(f"已轉為增量 vacuum：{before} → {os.path.getsize(DB_PATH)} bytes")
+        else:
+            logging.info("資料庫已是增量 vacuum 模式")
+    elif args.command == "run":
+        run_maintenance()
+    else:
+        print(json.dumps(db_stats(), ensure_ascii=False, indent=2))
+    sys.exit(0)
@@ -0,0 +1,136 @@
+import zlib
+from collections import Counter
+
+# ================== 壓縮設定 ==================
+CODEC_PLAIN = 0  # 原文 TEXT
+CODEC_ZLIB = 1  # raw deflate（可搭配共用字典）的 BLOB
+
+# 小於此大小的訊息不壓縮（壓縮省下的空間不值得解壓成本）
+COMPRESS_MIN_BYTES = 512
+# 壓縮後至少要省下 10% 才改存壓縮版本
+MIN_SAVING_RATIO = 0.9
+COMPRESS_LEVEL = 6
+# 共用字典大小上限（deflate 視窗為 32KB，超過的部分不會被參照）
+DICT_SIZE = 32 * 1024
+# =================================================
+
+
+def encode(text: str, zdict: bytes | None = None) -> tuple[int, str | bytes]:
+    """壓縮訊息內容，回傳 (codec, 儲存值)；太短或壓不小的內容維持原文。"""
+    raw = text.encode("utf-8")
+    if len(raw) < COMPRESS_MIN_BYTES:
+        return CODEC_PLAIN, text
+    if zdict:
+        co = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        co = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15)
+    data = co.compress(raw) + co.flush()
+    if len(data) > len(raw) * MIN_SAVING_RATIO:
+        return CODEC_PLAIN, text
+    return CODEC_ZLIB, data
+
+
+def decode(codec: int, value: str | bytes, zdict: bytes | None = None) -> str:
+    """還原 encode() 的儲存值"""
+    if codec == CODEC_PLAIN:
+        return value
+    if zdict:
+        do = zlib.decompressobj(-15, zdict=zdict)
+    else:
+        do = zlib.decompressobj(-15)
+    return (do.decompress(value) + do.flush()).decode("utf-8")
+
+
+def train_dictionary(samples: list[str], size: int = DICT_SIZE) -> bytes:
+    """
+    由樣本訊息訓練共用字典：挑出在多則訊息中重複出現的行
+    （程式碼框、markdown 標記、常見句型），依「出現次數 × 長度」排序。
+    deflate 偏好距離較近的參照，所以價值最高的內容放在字典尾端。
+    """
+    counts: Counter[str] = Counter()
+    for text in samples:
+        # 每則訊息同一行只算一次，才能反映跨訊息的共通性
+        counts.update({line.strip() for line in text.splitlines() if len(line.strip()) >= 4})
+
+    picked: list[bytes] = []
+    total = 0
+    for line, n in sorted(counts.items(), key=lambda kv: kv[1] * len(kv[0]), reverse=True):
+        if n < 2:
+            break
+        chunk = (line + "\n").encode("utf-8")
+        if total + len(chunk) > size:
+            continue
+        picked.append(chunk)
+        total += len(chunk)
+    return b"".join(reversed(picked))
+
+
+if __name__ == "__main__":
+    # 基準測試：比較原文與壓縮（有 / 無共用字典）的磁碟用量、頁數與讀取延遲
+    # 用法：python message_codec.py [訊息數]
+    import os
+    import random
+    import sqlite3
+    import sys
+    import tempfile
+    import time
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rng = random.Random(42)
+    words = "模型 回覆 範例 資料 設定 函式 參數 結果 使用 說明 the data model value return config".split()
+    snippets = [
+        "```python\nimport os\nimport json\n\ndef main():\n    data = load()\n    return data\n```",
+        "## 步驟說明\n\n1. **安裝套件**：`pip install -r requirements.txt`\n2. **啟動服務**",
+        "| 欄位 | 說明 |\n| --- | --- |\n| id | 主鍵 |\n| name | 名稱 |",
+        "```javascript\nconst res = await fetch('/api');\nconsole.log(res);\n```",
+    ]
+
+    def _fake_reply() -> str:
+        parts = []
+        for _ in range(rng.randint(3, 12)):
+            parts.append(" ".join(rng.choice(words) for _ in range(rng.randint(20, 60))))
+            if rng.random() < 0.5:
+                parts.append(rng.choice(snippets))
+        return "\n\n".join(parts)
+
+    corpus = [_fake_reply() for _ in range(count)]
+    zdict = train_dictionary(corpus[:500])
+
+    def _build(path: str, mode: str) -> None:
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE m (id INTEGER PRIMARY KEY, codec INTEGER, text)")
+        rows = []
+        for text in corpus:
+            if mode == "plain":
+                rows.append((CODEC_PLAIN, text))
+            else:
+                rows.append(encode(text, zdict if mode == "zlib+dict" else None))
+        conn.executemany("INSERT INTO m (codec, text) VALUES (?, ?)", rows)
+        conn.commit()
+        conn.execute("VACUUM")
+        conn.close()
+
+    def _read_pages(path: str, mode: str, rounds: int = 200) -> float:
+        conn = sqlite3.connect(path)
+        d = zdict if mode == "zlib+dict" else None
+        start = time.perf_counter()
+        for _ in range(rounds):
+            top = rng.randint(50, count)
+            for codec, value in conn.execute(
+                "SELECT codec, text FROM m WHERE id <= ? ORDER BY id DESC LIMIT 50", (top,)
+            ):
+                decode(codec, value, d)
+        conn.close()
+        return (time.perf_counter() - start) / rounds * 1000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("plain", "zlib", "zlib+dict"):
+            path = os.path.join(tmp, f"{mode}.db")
+            _build(path, mode)
+            conn = sqlite3.connect(path)
+            pages = conn.execute("PRAGMA page_count").fetchone()[0]
+            conn.close()
+            print(
+                f"{mode:10s} 檔案 {os.path.getsize(path) / 1024:8.0f} KB，"
+                f"{pages:6d} 頁，讀取 50 則 {_read_pages(path, mode):6.2f} ms"
+            )
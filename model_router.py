@@ -0,0 +1,283 @@
+import logging
+import math
+import os
+import re
+import statistics
+import threading
+import time
+from collections import deque
+from typing import Any, Callable
+
+import httpx
+
+import completion_cache
+from database import load_model_calls, record_model_call
+from token_estimate import estimate_tokens
+
+# ================== 路由設定 ==================
+AUTO_MODEL = "auto"
+# 統計只看最近這段時間的呼叫（秒），每個模型最多保留的樣本數
+WINDOW_SECONDS = int(os.environ.get("GEMINICHAT_ROUTER_WINDOW", "900"))
+MAX_SAMPLES = 200
+# 依請求大小（估計 token 數）分組統計延遲：(上限, 名稱, 沒有該組樣本時的延遲倍率)
+SIZE_BUCKETS = ((2_000, "small", 1.0), (16_000, "medium", 1.5), (math.inf, "large", 3.0))
+# 錯誤率達門檻（且樣本數足夠）就暫停該模型 OPEN_SECONDS 秒
+ERROR_RATE_OPEN = 0.5
+MIN_SAMPLES_FOR_OPEN = 4
+OPEN_SECONDS = 60
+# 配額用盡（429）後的冷卻秒數，連續發生時加倍
+QUOTA_COOLDOWN = 60
+QUOTA_COOLDOWN_MAX = 15 * 60
+# auto 模式一次請求最多嘗試幾個模型
+MAX_FAILOVER = int(os.environ.get("GEMINICHAT_ROUTER_MAX_FAILOVER", "3"))
+# 還沒有任何樣本的模型，依名稱給一個先驗延遲（毫秒）
+PRIOR_LATENCY_MS = (("flash-lite", 1500), ("flash", 3000), ("pro", 9000))
+DEFAULT_PRIOR_MS = 5000
+# 附件等非文字 Part 粗估的 token 數
+NON_TEXT_PART_TOKENS = 1000
+# 不適合一般對話、auto 不會選用的模型
+AUTO_EXCLUDE = re.compile(r"tts|image|embedding|live|audio|aqa|learnlm", re.IGNORECASE)
+# 可用環境變數指定 auto 的候選模型（逗號分隔）
+AUTO_CANDIDATES = [
+    m.strip() for m in os.environ.get("GEMINICHAT_AUTO_MODELS", "").split(",") if m.strip()
+]
+# =================================================
+
+
+def bucket_for(prompt_tokens: int | None) -> str:
+    for limit, name, _factor in SIZE_BUCKETS:
+        if (prompt_tokens or 0) < limit:
+            return name
+    return SIZE_BUCKETS[-1][1]
+
+
+def thread_tokens(contents: list) -> int:
+    """估計整個 thread 的 token 數（用來決定請求大小分組）；Content 物件與 dict 皆可"""
+    total = 0
+    for content in contents:
+        parts = content.get("parts") if isinstance(content, dict) else content.parts
+        for part in parts or []:
+            text = part.get("text") if isinstance(part, dict) else part.text
+            total += estimate_tokens(text) if text else NON_TEXT_PART_TOKENS
+    return total
+
+
+def classify_error(err: BaseException) -> str:
+    if isinstance(err, (httpx.TimeoutException, TimeoutError)):
+        return "timeout"
+    if getattr(err, "code", None) == 429:
+        return "quota"
+    return "error"
+
+
+class _ModelHealth:
+    """單一模型最近的呼叫樣本與暫停狀態"""
+
+    def __init__(self):
+        # (時間, 大小分組, 延遲 ms, 是否成功)
+        self.samples: deque[tuple[float, str, int | None, bool]] = deque(maxlen=MAX_SAMPLES)
+        self.open_until = 0.0
+        self.quota_until = 0.0
+        self.quota_strikes = 0
+
+    def prune(self, now: float) -> None:
+        while self.samples and now - self.samples[0][0] > WINDOW_SECONDS:
+            self.samples.popleft()
+
+    def error_rate(self) -> float:
+        if not self.samples:
+            return 0.0
+        return sum(1 for s in self.samples if not s[3]) / len(self.samples)
+
+
+_health: dict[str, _ModelHealth] = {}
+_lock = threading.Lock()
+
+
+def _get(model: str) -> _ModelHealth:
+    h = _health.get(model)
+    if h is None:
+        h = _health[model] = _ModelHealth()
+    return h
+
+
+def _apply(model: str, status: str, latency_ms: int | None, prompt_tokens: int | None, ts: float) -> None:
+    """把一筆觀察併入記憶體中的統計（呼叫端需持有 _lock）"""
+    # 使用者中止的呼叫不代表模型好壞，只留在 model_calls 供統計
+    if status == "cancelled":
+        return
+    h = _get(model)
+    ok = status == "ok"
+    h.samples.append((ts, bucket_for(prompt_tokens), latency_ms if ok else None, ok))
+    h.prune(ts)
+    if status == "quota":
+        h.quota_strikes += 1
+        h.quota_until = ts + min(QUOTA_COOLDOWN * 2 ** (h.quota_strikes - 1), QUOTA_COOLDOWN_MAX)
+    elif ok:
+        h.quota_strikes = 0
+    if not ok and len(h.samples) >= MIN_SAMPLES_FOR_OPEN and h.error_rate() >= ERROR_RATE_OPEN:
+        h.open_until = ts + OPEN_SECONDS
+
+
+def observe(
+    model: str,
+    mode: str,
+    status: str,
+    latency_ms: int | None,
+    prompt_tokens: int | None = None,
+    output_tokens: int | None = None,
+) -> None:
+    """記錄一次模型呼叫：更新即時統計並寫入 model_calls"""
+    now = time.time()
+    with _lock:
+        _apply(model, status, latency_ms, prompt_tokens, now)
+    try:
+        record_model_call(model, mode, status, latency_ms, prompt_tokens, output_tokens)
+    except Exception as e:
+        logging.warning(f"模型呼叫統計寫入失敗：{e}")
+
+
+def load_history() -> None:
+    """啟動時以資料庫中最近的呼叫紀錄預熱統計"""
+    rows = load_model_calls(time.time() - WINDOW_SECONDS)
+    with _lock:
+        for model, status, latency_ms, prompt_tokens, _output, created_at in rows:
+            _apply(model, status, latency_ms, prompt_tokens, created_at)
+
+
+def _prior(model: str) -> float:
+    for marker, ms in PRIOR_LATENCY_MS:
+        if marker in model:
+            return ms
+    return DEFAULT_PRIOR_MS
+
+
+def _expected_latency(h: _ModelHealth | None, model: str, bucket: str) -> float:
+    factor = next(f for _limit, name, f in SIZE_BUCKETS if name == bucket)
+    if h is None:
+        return _prior(model) * factor
+    same = [s[2] for s in h.samples if s[3] and s[1] == bucket]
+    if same:
+        return statistics.median(same)
+    # 這個大小還沒有樣本：以 small 組的中位數按倍率推估
+    small = [s[2] for s in h.samples if s[3] and s[1] == SIZE_BUCKETS[0][1]]
+    if small:
+        return statistics.median(small) * factor
+    return _prior(model) * factor
+
+
+def is_healthy(model: str, now: float | None = None) -> bool:
+    now = now or time.time()
+    with _lock:
+        h = _health.get(model)
+        return h is None or (now >= h.open_until and now >= h.quota_until)
+
+
+def auto_candidates(available: list[str]) -> list[str]:
+    if AUTO_CANDIDATES:
+        return [m for m in AUTO_CANDIDATES if m in available] or AUTO_CANDIDATES
+    return [m for m in available if m.startswith("gemini") and not AUTO_EXCLUDE.search(m)]
+
+
+def rank(candidates: list[str], prompt_tokens: int) -> list[str]:
+    """
+    依「預期延遲 ×（1 + 2 × 錯誤率）」由好到壞排序；被暫停或配額冷卻中的模型排在最後，
+    全部都不健康時仍照分數排序，至少還有得試。
+    """
+    now = time.time()
+    bucket = bucket_for(prompt_tokens)
+    scored = []
+    with _lock:
+        for model in candidates:
+            h = _health.get(model)
+            if h is not None:
+                h.prune(now)
+            healthy = h is None or (now >= h.open_until and now >= h.quota_until)
+            error_rate = h.error_rate() if h else 0.0
+            score = _expected_latency(h, model, bucket) * (1 + 2 * error_rate)
+            scored.append((not healthy, score, model))
+    scored.sort()
+    return [model for _unhealthy, _score, model in scored]
+
+
+def call(
+    client,
+    model: str,
+    contents: list,
+    mode: str,
+    prompt_tokens: int | None = None,
+    cache_ttl: float | None = None,
+    config: Any = None,
+):
+    """呼叫模型（經過 completion_cache）並記錄延遲與結果；快取命中不算一次樣本"""
+    if prompt_tokens is None:
+        prompt_tokens = thread_tokens(contents)
+    if cache_ttl and completion_cache.is_cached(model, contents, config):
+        return completion_cache.generate_content(client, model, contents, cache_ttl=cache_ttl, config=config)
+
+    start = time.perf_counter()
+    try:
+        res = completion_cache.generate_content(
+            client, model, contents, cache_ttl=cache_ttl, config=config
+        )
+    except Exception as e:
+        observe(model, mode, classify_error(e), int((time.perf_counter() - start) * 1000), prompt_tokens)
+        raise
+    usage = getattr(res, "usage_metadata", None)
+    observe(
+        model,
+        mode,
+        "ok",
+        int((time.perf_counter() - start) * 1000),
+        (usage.prompt_token_count if usage else None) or prompt_tokens,
+        usage.candidates_token_count if usage else None,
+    )
+    return res
+
+
+def generate_auto(
+    client,
+    available: list[str],
+    contents: list,
+    prompt_tokens: int | None = None,
+    caller: Callable | None = None,
+):
+    """
+    auto 模式：依目前統計挑最適合的模型，失敗時換下一個候選（最多 MAX_FAILOVER 個）。
+    caller 預設為 call，簽名需相同（例如串流版本）。回傳 (caller 的結果, 實際使用的模型)。
+    """
+    if prompt_tokens is None:
+        prompt_tokens = thread_tokens(contents)
+    ranked = rank(auto_candidates(available), prompt_tokens)
+    if not ranked:
+        raise RuntimeError("沒有可供自動選擇的模型")
+    last_error: Exception | None = None
+    for model in ranked[:MAX_FAILOVER]:
+        try:
+            return (caller or call)(client, model, contents, AUTO_MODEL, prompt_tokens), model
+        except Exception as e:
+            last_error = e
+            logging.warning(f"自動路由：{model} 失敗（{classify_error(e)}），改用下一個模型：{e}")
+    raise last_error
+
+
+def snapshot() -> dict[str, dict]:
+    """目前的即時統計（給 /api/models/router）"""
+    now = time.time()
+    result = {}
+    with _lock:
+        for model, h in _health.items():
+            h.prune(now)
+            latencies: dict[str, int] = {}
+            for _limit, name, _f in SIZE_BUCKETS:
+                values = [s[2] for s in h.samples if s[3] and s[1] == name]
+                if values:
+                    latencies[name] = int(statistics.median(values))
+            result[model] = {
+                "samples": len(h.samples),
+                "error_rate": round(h.error_rate(), 3),
+                "latency_p50_ms": latencies,
+                "paused_for_s": max(0, int(h.open_until - now)),
+                "quota_cooldown_s": max(0, int(h.quota_until - now)),
+            }
+    return result
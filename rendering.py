@@ -0,0 +1,190 @@
+"""
+頁面渲染：Jinja 環境、markdown 轉換與訊息泡泡的片段快取。
+
+訊息寫入後內容就不會再變（編輯 / 重新產生都是新增另一則訊息），
+所以泡泡的 HTML 可以直接以訊息 id 快取，不必處理失效。
+
+渲染基準：
+    python rendering.py [訊息數] [重複次數]
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import jinja2
+import markdown2
+from fastapi.templating import Jinja2Templates
+from markupsafe import Markup, escape
+
+from database import APP_DIR
+
+# ================== 渲染設定 ==================
+TEMPLATE_DIR = "templates"
+# 編譯後的模板 bytecode 存放處；模板原始碼變更時會自動重新編譯
+BYTECODE_CACHE_DIR = os.path.join(APP_DIR, "jinja_cache")
+# 每次取模板都檢查檔案是否被修改（開發時才需要）
+TEMPLATE_AUTO_RELOAD = os.environ.get("GEMINICHAT_TEMPLATE_RELOAD", "0") == "1"
+# 訊息片段快取的筆數上限
+FRAGMENT_CACHE_SIZE = int(os.environ.get("GEMINICHAT_FRAGMENT_CACHE_SIZE", "2000"))
+MARKDOWN_EXTRAS = ["fenced-code-blocks", "code-friendly"]
+# =================================================
+
+os.makedirs(BYTECODE_CACHE_DIR, exist_ok=True)
+
+templates = Jinja2Templates(
+    env=jinja2.Environment(
+        loader=jinja2.FileSystemLoader(TEMPLATE_DIR),
+        autoescape=True,
+        auto_reload=TEMPLATE_AUTO_RELOAD,
+        bytecode_cache=jinja2.FileSystemBytecodeCache(BYTECODE_CACHE_DIR),
+    )
+)
+
+# markdown2.markdown() 每次都會建立新的 Markdown 物件；改為每個執行緒重用一個
+_markdown = threading.local()
+
+
+def render_markdown(text: str) -> Markup:
+    """將模型回覆的 markdown 轉成 HTML"""
+    md = getattr(_markdown, "converter", None)
+    if md is None:
+        md = _markdown.converter = markdown2.Markdown(extras=MARKDOWN_EXTRAS)
+    return Markup(md.convert(text))
+
+
+class _FragmentCache:
+    """
+    以 (種類, 訊息 id) 為鍵的 LRU 快取，存放已渲染好的 HTML 片段。
+    沒有失效機制，前提是同一個訊息 id 的內容永遠不變：
+    - 內文寫入後不再修改（編輯 / 重新產生都是新增訊息）
+    - 附件在寫入訊息的同一個請求中連結，之後不再增減
+    會變動的部分（例如分支切換的 siblings）放在 message_actions.html，不進快取。
+    若要支援就地修改訊息或附件，修改處必須同時清掉對應的快取項目。
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._data: OrderedDict[tuple[str, int], Markup] = OrderedDict()
+
+    def get(self, key: tuple[str, int]) -> Markup | None:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key: tuple[str, int], value: Markup) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+_fragments = _FragmentCache(FRAGMENT_CACHE_SIZE)
+
+
+def _cached(kind: str, msg: dict, render) -> Markup:
+    mid = msg.get("id")
+    if mid is None:
+        return render()
+    html = _fragments.get((kind, mid))
+    if html is None:
+        html = render()
+        _fragments.set((kind, mid), html)
+    return html
+
+
+def message_html(msg: dict) -> Markup:
+    """訊息內文的 HTML：使用者輸入只做跳脫，模型回覆轉 markdown"""
+    return _cached(
+        "html",
+        msg,
+        lambda: escape(msg["text"]) if msg["role"] == "user" else render_markdown(msg["text"]),
+    )
+
+
+def message_bubble(msg: dict) -> Markup:
+    """訊息泡泡的內容（附件、內文、複製按鈕）；命中快取時連訊息內文都不必解壓縮"""
+    return _cached(
+        "bubble",
+        msg,
+        lambda: Markup(templates.get_template("partials/message_bubble.html").render(msg=msg)),
+    )
+
+
+def clear_fragments() -> None:
+    _fragments.clear()
+
+
+templates.env.filters["markdown"] = render_markdown
+templates.env.globals["message_html"] = message_html
+templates.env.globals["message_bubble"] = message_bubble
+
+
+if __name__ == "__main__":
+    # 基準：50 則長訊息的 message_list.html，比較片段快取冷 / 熱與模板冷啟動編譯
+    import statistics
+    import sys
+    import time
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+
+    def _reply(i: int) -> str:
+        prose = "這是一段很長的回覆內容，包含 **粗體**、`inline code` 與[連結](https://example.com)。" * 8
+        code = "\n".join(f"def f{j}(x):\n    return x * {j}" for j in range(15))
+        items = "\n".join(f"- 項目 {j}：說明文字說明文字" for j in range(12))
+        return f"## 第 {i} 節\n\n{prose}\n\n```python\n{code}\n```\n\n{items}"
+
+    messages = [
+        {
+            "id": i + 1,
+            "role": "user" if i % 2 == 0 else "model",
+            "text": "使用者的提問 " * 40 if i % 2 == 0 else _reply(i),
+            "attachments": [],
+            "siblings": [],
+        }
+        for i in range(count)
+    ]
+    context = {"chat_messages": messages, "has_more": True, "conversation_id": 1}
+    template = templates.get_template("partials/message_list.html")
+
+    def _median_ms(fn) -> float:
+        samples = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            fn()
+            samples.append((time.perf_counter() - start) * 1000)
+        return statistics.median(samples)
+
+    def _cold() -> None:
+        clear_fragments()
+        template.render(context)
+
+    html = template.render(context)
+    print(f"message_list.html：{count} 則訊息，{len(html) / 1024:.0f} KiB")
+    print(f"  片段快取冷：{_median_ms(_cold):.1f} ms")
+    print(f"  片段快取熱：{_median_ms(lambda: template.render(context)):.2f} ms")
+
+    def _compile(bytecode_cache) -> None:
+        env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(TEMPLATE_DIR),
+            autoescape=True,
+            bytecode_cache=bytecode_cache,
+        )
+        env.globals.update(templates.env.globals)
+        for name in env.list_templates(extensions=["html"]):
+            env.get_template(name)
+
+    print(f"  模板冷啟動編譯（無 bytecode 快取）：{_median_ms(lambda: _compile(None)):.1f} ms")
+    print(
+        "  模板冷啟動編譯（bytecode 快取）："
+        f"{_median_ms(lambda: _compile(templates.env.bytecode_cache)):.1f} ms"
+    )
@@ -0,0 +1,298 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from google.genai import types
+
+import gemini_client
+from database import (
+    get_embedding_progress,
+    load_messages_by_ids,
+    load_unindexed_messages,
+    load_user_embeddings,
+    save_embeddings,
+)
+from token_estimate import CJK_RE as _CJK_RE
+from token_estimate import estimate_tokens
+
+# ================== 檢索設定 ==================
+RETRIEVAL_ENABLED = os.environ.get("GEMINICHAT_RETRIEVAL", "1") != "0"
+# hash：本機、可重現的雜湊向量（預設，不連網路）；
+# gemini：Gemini 嵌入模型，語意較準，但每次對話多一次 API 往返，歷史訊息也會送去建索引
+EMBEDDER = os.environ.get("GEMINICHAT_EMBEDDER", "hash")
+EMBED_MODEL = os.environ.get("GEMINICHAT_EMBED_MODEL", "text-embedding-004")
+EMBED_DIM = int(os.environ.get("GEMINICHAT_EMBED_DIM", "256"))
+EMBED_BATCH = 100  # embed_content 單次上限
+# 帶入的過往片段：最多幾則、總 token 預算、單則上限
+TOP_K = int(os.environ.get("GEMINICHAT_RETRIEVAL_TOP_K", "8"))
+TOKEN_BUDGET = int(os.environ.get("GEMINICHAT_RETRIEVAL_TOKEN_BUDGET", "1500"))
+SNIPPET_MAX_TOKENS = 400
+# 最低相似度；未設定時使用各嵌入方式的預設值（兩者的分數分布差很多）
+MIN_SCORE = os.environ.get("GEMINICHAT_RETRIEVAL_MIN_SCORE")
+# 常駐記憶體的使用者向量矩陣數量
+INDEX_CACHE_USERS = 4
+# 背景建索引的間隔（秒）與每輪筆數
+INDEX_INTERVAL = int(os.environ.get("GEMINICHAT_INDEX_INTERVAL", "60"))
+INDEX_BATCH = 256
+# =================================================
+
+_TOKEN_RE = re.compile(r"[぀-ヿ㐀-鿿가-힯]|[^\W_]+", re.UNICODE)
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+class HashingEmbedder:
+    """
+    本機的確定性嵌入：英數字詞與中日韓單字 / 雙字組雜湊到固定維度（帶正負號），
+    再做 L2 正規化。不需網路、同樣輸入永遠得到同樣向量，適合離線與測試。
+    """
+
+    min_score = 0.2
+
+    def __init__(self, dim: int = EMBED_DIM):
+        self.dim = dim
+        self.name = f"hash-{dim}"
+
+    def _features(self, text: str) -> list[str]:
+        tokens = [t.lower() for t in _TOKEN_RE.findall(text)]
+        bigrams = [
+            a + b for a, b in zip(tokens, tokens[1:]) if _CJK_RE.match(a) and _CJK_RE.match(b)
+        ]
+        return tokens + bigrams
+
+    def embed(self, texts: list[str], query: bool = False) -> np.ndarray:
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feat in self._features(text):
+                h = int.from_bytes(hashlib.blake2b(feat.encode("utf-8"), digest_size=8).digest(), "little")
+                out[row, h % self.dim] += 1.0 if (h >> 63) else -1.0
+        return _normalize(out)
+
+
+class GeminiEmbedder:
+    """以 Gemini 嵌入模型計算向量（降維到 dim 後重新正規化）"""
+
+    # 語意向量彼此的基準相似度偏高，門檻要比雜湊向量高
+    min_score = 0.6
+
+    def __init__(self, model: str = EMBED_MODEL, dim: int = EMBED_DIM):
+        self.model = model
+        self.dim = dim
+        self.name = f"gemini:{model}:{dim}"
+
+    def embed(self, texts: list[str], query: bool = False) -> np.ndarray:
+        client = gemini_client.get_client()
+        vectors = []
+        for i in range(0, len(texts), EMBED_BATCH):
+            res = client.models.embed_content(
+                model=self.model,
+                contents=[t or " " for t in texts[i : i + EMBED_BATCH]],
+                config=types.EmbedContentConfig(
+                    task_type="RETRIEVAL_QUERY" if query else "RETRIEVAL_DOCUMENT",
+                    output_dimensionality=self.dim,
+                ),
+            )
+            vectors.extend(e.values for e in res.embeddings)
+        return _normalize(np.asarray(vectors, dtype=np.float32).reshape(len(texts), self.dim))
+
+
+def _make_embedder():
+    if EMBEDDER == "hash":
+        return HashingEmbedder()
+    return GeminiEmbedder()
+
+
+embedder = _make_embedder()
+min_score = float(MIN_SCORE) if MIN_SCORE else embedder.min_score
+
+
+# ----------------- 向量索引 -----------------
+
+
+class _UserIndex:
+    """某使用者所有訊息向量的矩陣快取；只增量載入新的列"""
+
+    def __init__(self):
+        self.ids = np.empty(0, dtype=np.int64)
+        self.conv_ids = np.empty(0, dtype=np.int64)
+        self.matrix = np.empty((0, embedder.dim), dtype=np.float32)
+        self.lock = threading.Lock()
+
+    def refresh(self, user_id: int) -> None:
+        last = int(self.ids[-1]) if len(self.ids) else 0
+        rows = load_user_embeddings(user_id, embedder.name, last)
+        if not rows:
+            return
+        ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+        conv_ids = np.fromiter((r[1] for r in rows), dtype=np.int64, count=len(rows))
+        # 所有 BLOB 串起來一次轉成 (n, dim) 矩陣，不逐列建立陣列
+        block = np.frombuffer(b"".join(r[2] for r in rows), dtype="<f4").reshape(len(rows), embedder.dim)
+        self.ids = np.concatenate([self.ids, ids])
+        self.conv_ids = np.concatenate([self.conv_ids, conv_ids])
+        self.matrix = np.concatenate([self.matrix, block])
+
+
+_indexes: OrderedDict[int, _UserIndex] = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def _user_index(user_id: int) -> _UserIndex:
+    with _indexes_lock:
+        idx = _indexes.get(user_id)
+        if idx is None:
+            idx = _indexes[user_id] = _UserIndex()
+        _indexes.move_to_end(user_id)
+        while len(_indexes) > INDEX_CACHE_USERS:
+            _indexes.popitem(last=False)
+    with idx.lock:
+        idx.refresh(user_id)
+    return idx
+
+
+def top_k(
+    matrix: np.ndarray, query: np.ndarray, k: int, exclude: np.ndarray | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    向量化的 top-k：一次矩陣乘法算出所有餘弦相似度（向量皆已正規化），
+    argpartition 以 O(n) 選出前 k 名後只排序這 k 個。回傳 (列索引, 分數)。
+    """
+    if len(matrix) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    scores = matrix @ query
+    if exclude is not None:
+        scores[exclude] = -np.inf
+    k = min(k, len(scores))
+    picked = np.argpartition(-scores, k - 1)[:k]
+    order = picked[np.argsort(-scores[picked])]
+    return order, scores[order]
+
+
+def search(user_id: int, query_text: str, exclude_conversation: int | None = None, k: int = TOP_K):
+    """回傳 [(message_id, 分數)]，只含其他會話、相似度不低於 min_score 的訊息"""
+    idx = _user_index(user_id)
+    if len(idx.ids) == 0:
+        return []
+    q = embedder.embed([query_text], query=True)[0]
+    exclude = idx.conv_ids == exclude_conversation if exclude_conversation is not None else None
+    rows, scores = top_k(idx.matrix, q, k, exclude)
+    return [(int(idx.ids[r]), float(s)) for r, s in zip(rows, scores) if s >= min_score]
+
+
+# ----------------- 帶入對話的上下文 -----------------
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    lo, hi = 0, len(text)
+    while lo < hi:  # 二分搜尋不超過上限的最長前綴
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo].rstrip() + "…"
+
+
+def build_context(
+    user_id: int, conversation_id: int, query_text: str, budget: int = TOKEN_BUDGET
+) -> str | None:
+    """
+    檢索其他會話中與本次輸入最相關的訊息，在 token 預算內組成一段參考資料；
+    沒有相關內容或檢索失敗時回傳 None（不影響正常對話）。
+    """
+    if not RETRIEVAL_ENABLED or not query_text.strip():
+        return None
+    try:
+        hits = search(user_id, query_text, exclude_conversation=conversation_id)
+    except Exception as e:
+        logging.warning(f"語意檢索失敗，略過：{e}")
+        return None
+    found = load_messages_by_ids([mid for mid, _ in hits])
+
+    header = "以下是與使用者目前問題相關的過往對話片段，僅供參考；若無關請忽略：\n"
+    used = estimate_tokens(header)
+    snippets, seen = [], set()
+    for mid, _score in hits:
+        msg = found.get(mid)
+        if msg is None or msg["text"] in seen:
+            continue
+        text = _truncate(msg["text"], SNIPPET_MAX_TOKENS)
+        who = "使用者" if msg["role"] == "user" else "AI"
+        snippet = f"\n[「{msg['title']}」{msg['timestamp'][:10]}] {who}：{text}\n"
+        cost = estimate_tokens(snippet)
+        if used + cost > budget:
+            continue
+        snippets.append(snippet)
+        seen.add(msg["text"])
+        used += cost
+    return header + "".join(snippets) if snippets else None
+
+
+# ----------------- 背景建索引 -----------------
+
+
+def index_pending(max_batches: int = 100) -> int:
+    """
+    為尚未建立向量的訊息計算嵌入並寫入 message_embeddings，回傳本輪筆數。
+    從資料庫記錄的進度往後掃描，每一輪只處理新訊息，不會從頭重掃整個歷史。
+    """
+    total, after_id = 0, get_embedding_progress(embedder.name)
+    for _ in range(max_batches):
+        rows = load_unindexed_messages(embedder.name, after_id, INDEX_BATCH)
+        if not rows:
+            break
+        vectors = embedder.embed([r["text"] for r in rows])
+        save_embeddings(
+            embedder.name,
+            [
+                (r["id"], r["user_id"], r["conversation_id"], vec.astype("<f4").tobytes())
+                for r, vec in zip(rows, vectors)
+            ],
+        )
+        after_id = rows[-1]["id"]
+        total += len(rows)
+    if total:
+        logging.info(f"已為 {total} 則訊息建立語意索引（{embedder.name}）")
+    return total
+
+
+if __name__ == "__main__":
+    # 基準測試：10 萬則訊息的向量載入與 top-k 查詢延遲
+    # 用法：python retrieval.py [訊息數]
+    import sys
+    import time
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    rng = np.random.default_rng(42)
+    matrix = _normalize(rng.standard_normal((n, EMBED_DIM), dtype=np.float32))
+    blobs = [row.astype("<f4").tobytes() for row in matrix]
+    conv_ids = rng.integers(0, 2000, n)
+
+    start = time.perf_counter()
+    loaded = np.frombuffer(b"".join(blobs), dtype="<f4").reshape(n, EMBED_DIM)
+    load_ms = (time.perf_counter() - start) * 1000
+
+    query = matrix[123]
+    rounds = 50
+    start = time.perf_counter()
+    for _ in range(rounds):
+        rows, scores = top_k(loaded, query, TOP_K, conv_ids == 7)
+    search_ms = (time.perf_counter() - start) / rounds * 1000
+
+    start = time.perf_counter()
+    for _ in range(3):
+        sorted(((float(np.dot(v, query)), i) for i, v in enumerate(loaded)), reverse=True)[:TOP_K]
+    naive_ms = (time.perf_counter() - start) / 3 * 1000
+
+    print(f"{n} 則 × {EMBED_DIM} 維（{loaded.nbytes / 1024 / 1024:.0f} MB）")
+    print(f"BLOB 轉矩陣 {load_ms:.1f} ms；top-{TOP_K} 查詢 {search_ms:.2f} ms；逐列 Python 迴圈 {naive_ms:.0f} ms")
+    print(f"第一名為查詢本身：{rows[0] == 123}，分數 {scores[0]:.3f}")
@@ -0,0 +1,112 @@
+import json
+import secrets
+import time
+
+from starlette.datastructures import MutableHeaders
+from starlette.requests import HTTPConnection
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from database import delete_session, load_session, purge_expired_sessions, save_session
+
+# 過期 session 的清理間隔（秒）
+PURGE_INTERVAL = 3600
+
+
+class ServerSideSessionMiddleware:
+    """
+    以伺服器端 SQLite 儲存 session 內容，cookie 只放隨機的 session id。
+    介面與 starlette 的 SessionMiddleware 相同（request.session 為 dict），
+    但 cookie 只有約 30 bytes，也不必每次請求都簽章與 base64 編碼整包資料。
+    登入身分（user_id）改變時一律換發新的 session id，防止 session fixation。
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        session_cookie: str = "session",
+        max_age: int = 14 * 24 * 60 * 60,  # 14 天
+        path: str = "/",
+        same_site: str = "lax",
+        https_only: bool = False,
+    ) -> None:
+        self.app = app
+        self.session_cookie = session_cookie
+        self.max_age = max_age
+        self.security_flags = f"httponly; samesite={same_site}"
+        if https_only:
+            self.security_flags += "; secure"
+        self.path = path
+        self._last_purge = 0.0
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        connection = HTTPConnection(scope)
+        sid = connection.cookies.get(self.session_cookie)
+        loaded = load_session(sid) if sid else None
+        if loaded:
+            data, expires_at = loaded
+        else:
+            sid, data, expires_at = None, {}, 0.0
+
+        scope["session"] = data
+        # 以序列化結果比對是否變更，巢狀 dict 的修改也偵測得到
+        original = json.dumps(data, sort_keys=True, ensure_ascii=False)
+        original_user = data.get("user_id")
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                self._on_response_start(
+                    message, sid, original, original_user, expires_at, scope
+                )
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    def _on_response_start(
+        self,
+        message: Message,
+        sid: str | None,
+        original: str,
+        original_user,
+        expires_at: float,
+        scope: Scope,
+    ) -> None:
+        session = scope["session"]
+        headers = MutableHeaders(scope=message)
+        now = time.time()
+
+        if not session:
+            # session 被清空（登出）：刪除伺服器端資料並讓 cookie 失效
+            if sid:
+                delete_session(sid)
+                headers.append("Set-Cookie", self._cookie("null", expires=True))
+            return
+
+        changed = json.dumps(session, sort_keys=True, ensure_ascii=False) != original
+        # 沒有變更時只在剩餘壽命過半才延長，避免每個請求都寫入
+        if not changed and sid and expires_at - now > self.max_age / 2:
+            return
+
+        if sid and session.get("user_id") != original_user:
+            # 登入（或切換使用者）：舊 id 可能是攻擊者預先塞給受害者的，作廢後換發新的
+            delete_session(sid)
+            sid = None
+        if sid is None:
+            sid = secrets.token_urlsafe(16)
+        save_session(sid, session, now + self.max_age)
+        headers.append("Set-Cookie", self._cookie(sid))
+
+        if now - self._last_purge > PURGE_INTERVAL:
+            self._last_purge = now
+            purge_expired_sessions()
+
+    def _cookie(self, value: str, expires: bool = False) -> str:
+        cookie = f"{self.session_cookie}={value}; path={self.path}; "
+        if expires:
+            cookie += "expires=Thu, 01 Jan 1970 00:00:00 GMT; "
+        else:
+            cookie += f"Max-Age={self.max_age}; "
+        return cookie + self.security_flags
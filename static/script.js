@@ -188,6 +188,9 @@ if (userInput) {
 }
 
 // ====================== Code block copy buttons ======================
+// 引用 index.html 中的共用 sprite（#icon-copy）
+const COPY_ICON_SVG = `<svg xmlns="http://www.w3.org/2000/svg" fill="none" viewBox="0 0 24 24" stroke-width="1.5" stroke="currentColor" class="copy-button-icon"><use href="#icon-copy"></use></svg>`;
+
 function addCodeBlockCopyButtons() {
     document.querySelectorAll('pre code').forEach(codeBlock => {
         if (codeBlock.querySelector('.copy-button.code-block-copy-button')) return;
@@ -195,19 +198,172 @@ function addCodeBlockCopyButtons() {
         const button = document.createElement('button');
         button.className = 'copy-button code-block-copy-button';
         button.setAttribute('aria-label', '複製程式碼');
-        button.innerHTML = `
-            <svg xmlns="http://www.w3.org/2000/svg" fill="none" viewBox="0 0 24 24" stroke-width="1.5" stroke="currentColor" class="copy-button-icon">
-                <path stroke-linecap="round" stroke-linejoin="round" d="M15.75 17.25v3.375c0 .621-.504 1.125-1.125 1.125h-9.75a1.125 1.125 0 0 1-1.125-1.125V7.875c0-.621.504-1.125 1.125-1.125H6.75a9.06 9.06 0 0 1 1.5.124m7.5 10.376h3.375c.621 0 1.125-.504 1.125-1.125V11.25c0-4.46-3.243-8.161-7.5-8.876a9.06 9.06 0 0 0-1.5-.124H9.375c-.621 0-1.125.504-1.125 1.125v3.5m7.5 10.375H9.375a1.125 1.125 0 0 1-1.125-1.125v-9.25m12 6.625v-1.875a3.375 3.375 0 0 0-3.375-3.375h-1.5a1.125 1.125 0 0 1-1.125-1.125v-1.5a3.375 3.375 0 0 0-3.375-3.375H9.75" />
-            </svg>`;
-        button.addEventListener('click', () => copyMessage(button));
+        // 用 onclick 屬性而非 addEventListener：訊息被虛擬化收合再還原後仍可使用
+        button.setAttribute('onclick', 'copyMessage(this)');
+        button.innerHTML = COPY_ICON_SVG;
         codeBlock.appendChild(button);
     });
 }
 
+// ====================== 歷史訊息分頁載入 ======================
+// 往上捲動接近頂端時，以最舊一則訊息的 id 為游標載入更舊的一頁
+let historyLoading = false;
+let lastChatScrollTop = 0;
+
+function currentConversationId() {
+    return document.getElementById('conversationIdInput')?.value;
+}
+
+function buildAttachmentChips(list) {
+    if (!list || !list.length) return '';
+    const escapeAttr = s => s.replace(/[&<>"']/g, c => `&#${c.charCodeAt(0)};`);
+    const chips = list.map(a => {
+        const name = escapeAttr(a.filename);
+        const inner = a.mime_type.startsWith('image/')
+            ? `<img src="/attachments/${a.sha256}/thumb" alt="${name}" loading="lazy" class="attachment-thumb">`
+            : `<span class="attachment-name">📎 ${name}</span>`;
+        return `<a class="attachment-chip" href="/attachments/${a.sha256}" target="_blank" rel="noopener" title="${name}">${inner}</a>`;
+    });
+    return `<div class="message-attachments">${chips.join('')}</div>`;
+}
+
+function buildMessageActions(msg) {
+    let nav = '';
+    const siblings = msg.siblings || [];
+    if (siblings.length > 1) {
+        const pos = siblings.indexOf(msg.id);
+        const prev = siblings[pos - 1], next = siblings[pos + 1];
+        nav = `<span class="branch-nav">
+            <button type="button" class="message-action-button" data-action="branch" data-target="${prev ?? msg.id}" ${prev ? '' : 'disabled'} aria-label="上一個版本">‹</button>
+            <span class="branch-position">${pos + 1}/${siblings.length}</span>
+            <button type="button" class="message-action-button" data-action="branch" data-target="${next ?? msg.id}" ${next ? '' : 'disabled'} aria-label="下一個版本">›</button>
+        </span>`;
+    }
+    const action = msg.role === 'user'
+        ? '<button type="button" class="message-action-button" data-action="edit" aria-label="編輯並重新送出">✎</button>'
+        : '<button type="button" class="message-action-button" data-action="regenerate" aria-label="重新產生回答">↻</button>';
+    return `<div class="message-actions">${nav}${action}</div>`;
+}
+
+function buildMessageElement(msg) {
+    const wrapper = document.createElement('div');
+    wrapper.className = `message-wrapper ${msg.role === 'user' ? 'user-message' : 'model-message'}`;
+    wrapper.dataset.initialized = 'true';
+    wrapper.dataset.mid = msg.id;
+    wrapper.innerHTML = `
+        <div class="message-bubble">
+            ${buildAttachmentChips(msg.attachments)}
+            <div class="message-content">${msg.html}</div>
+            <button onclick="copyMessage(this)" class="copy-button message-copy-button" aria-label="複製訊息">${COPY_ICON_SVG}</button>
+        </div>
+        ${buildMessageActions(msg)}`;
+    return wrapper;
+}
+
+async function loadOlderMessages() {
+    const sentinel = chatBox?.querySelector('.history-sentinel');
+    const oldest = chatBox?.querySelector('.message-wrapper[data-mid]');
+    const cid = currentConversationId();
+    if (!sentinel || !oldest || !cid || historyLoading) return;
+
+    historyLoading = true;
+    try {
+        const res = await fetch(`/conversation/${cid}/messages?before_id=${oldest.dataset.mid}`);
+        if (!res.ok) throw new Error(`HTTP ${res.status}`);
+        const { messages, has_more } = await res.json();
+        if (currentConversationId() !== cid) return; // 期間已切換對話
+
+        const elements = messages.map(buildMessageElement);
+        const fragment = document.createDocumentFragment();
+        elements.forEach(el => fragment.appendChild(el));
+
+        // 插入前後的高度差補回 scrollTop，讓畫面停在原本閱讀的位置
+        const prevHeight = chatBox.scrollHeight;
+        sentinel.after(fragment);
+        chatBox.scrollTop += chatBox.scrollHeight - prevHeight;
+        lastChatScrollTop = chatBox.scrollTop;
+        if (!has_more) sentinel.remove();
+
+        elements.forEach(el => el.querySelectorAll('pre code').forEach(block => hljs.highlightElement(block)));
+        addCodeBlockCopyButtons();
+        observeMessages();
+        if (typeof updateScrollbar === 'function') updateScrollbar();
+    } catch (err) {
+        console.error('載入更早的訊息失敗:', err);
+    } finally {
+        historyLoading = false;
+    }
+    fillViewportWithHistory();
+}
+
+// 內容不足一個畫面時無法往上捲動，直接補載
+function fillViewportWithHistory() {
+    if (chatBox && chatBox.scrollHeight <= chatBox.clientHeight) loadOlderMessages();
+}
+
+chatBox?.addEventListener('scroll', () => {
+    const scrollingUp = chatBox.scrollTop < lastChatScrollTop;
+    lastChatScrollTop = chatBox.scrollTop;
+    if (scrollingUp && chatBox.scrollTop < 400) loadOlderMessages();
+}, { passive: true });
+
+// ====================== 訊息虛擬化 ======================
+// 離開可視範圍很遠的訊息只保留一個等高的空殼，HTML 暫存為字串；
+// 捲回來時再還原。長對話的 DOM 節點數與排版成本因此維持固定。
+const virtualStash = new WeakMap();
+const observedMessages = new Set();
+const messageObserver = chatBox && 'IntersectionObserver' in window
+    ? new IntersectionObserver(entries => {
+        entries.forEach(({ target, isIntersecting }) => {
+            if (isIntersecting) restoreMessage(target);
+            else collapseMessage(target);
+        });
+    }, { root: chatBox, rootMargin: '2000px 0px' })
+    : null;
+
+function collapseMessage(el) {
+    if (virtualStash.has(el) || !el.isConnected) return;
+    const height = el.offsetHeight;
+    if (!height) return;
+    // 進場動畫已播完，移除後還原時才不會重播
+    el.querySelector('.message-bubble')?.classList.remove('animate-slide-in-right', 'animate-slide-in-left');
+    virtualStash.set(el, el.innerHTML);
+    el.style.height = `${height}px`;
+    el.textContent = '';
+}
+
+function restoreMessage(el) {
+    const html = virtualStash.get(el);
+    if (html === undefined) return;
+    virtualStash.delete(el);
+    el.innerHTML = html;
+    el.style.height = '';
+}
+
+function observeMessages() {
+    if (!messageObserver) return;
+    observedMessages.forEach(el => {
+        if (!el.isConnected) {
+            messageObserver.unobserve(el);
+            observedMessages.delete(el);
+        }
+    });
+    chatBox.querySelectorAll('.message-wrapper').forEach(el => {
+        if (observedMessages.has(el)) return;
+        observedMessages.add(el);
+        messageObserver.observe(el);
+    });
+}
+
 // ====================== HTMX 事件處理 ======================
 document.body.addEventListener('htmx:afterSwap', () => {
     initMessageEffects(chatBox);
-    if (chatBox) chatBox.scrollTo({ top: chatBox.scrollHeight, behavior: 'smooth' });
+    observeMessages();
+    if (chatBox) {
+        lastChatScrollTop = chatBox.scrollTop; // 換對話時 scrollTop 被截短，不算使用者往上捲
+        chatBox.scrollTo({ top: chatBox.scrollHeight, behavior: 'smooth' });
+        fillViewportWithHistory();
+    }
     if (typeof updateScrollbar === 'function') updateScrollbar();
     hljs.highlightAll();
     addCodeBlockCopyButtons();
@@ -223,14 +379,175 @@ document.body.addEventListener('htmx:afterSwap', () => {
 document.body.addEventListener('htmx:beforeRequest', e => {
     if (e.target.id === 'chat-form') aiGenerating = true;
 });
+
+// ====================== 比較模式 ======================
+// 比較模式展開且勾選了模型時，表單改送到 /chat/compare
+const compareToggle = document.getElementById('compareToggle');
+document.body.addEventListener('htmx:configRequest', e => {
+    if (e.target.id !== 'chat-form' || !compareToggle?.open) return;
+    if (compareToggle.querySelectorAll('input[name="compare_models"]:checked').length) {
+        e.detail.path = '/chat/compare';
+    }
+});
+
+// ====================== 重新產生 / 編輯 / 切換分支 ======================
+// 三者都回傳目前分支的完整訊息列表，直接取代 #chat-box
+document.body.addEventListener('click', e => {
+    const button = e.target.closest('.message-actions [data-action]');
+    const wrapper = button?.closest('.message-wrapper[data-mid]');
+    const cid = currentConversationId();
+    if (!wrapper || !cid || button.disabled || aiGenerating) return;
+
+    const mid = wrapper.dataset.mid;
+    const model = document.querySelector('#chat-form select[name="model"]')?.value;
+    let path, values;
+    if (button.dataset.action === 'branch') {
+        path = `/conversation/${cid}/branch/${button.dataset.target}`;
+    } else if (button.dataset.action === 'regenerate') {
+        path = `/conversation/${cid}/messages/${mid}/regenerate`;
+        values = { model };
+    } else {
+        const original = wrapper.querySelector('.message-content')?.textContent.trim() ?? '';
+        const edited = prompt('編輯訊息後重新送出：', original);
+        if (!edited || !edited.trim() || edited.trim() === original) return;
+        path = `/conversation/${cid}/messages/${mid}/edit`;
+        values = { user_input: edited.trim(), model };
+    }
+    if (button.dataset.action !== 'branch') {
+        aiGenerating = true;
+        loadingIndicator?.classList.add('htmx-request');
+    }
+    htmx.ajax('POST', path, { target: '#chat-box', values });
+});
+
+document.body.addEventListener('htmx:afterRequest', e => {
+    if (e.target.id !== 'chat-box') return;
+    loadingIndicator?.classList.remove('htmx-request');
+    // 204 = 生成被中止且不保留，沒有內容可換上
+    if (e.detail.successful && e.detail.xhr.status !== 204) return;
+    aiGenerating = false;
+    const status = e.detail.xhr.status;
+    if (status === 404 || status === 500) alert(e.detail.xhr.responseText);
+});
+
+// ====================== 附件 ======================
+const attachmentInput = document.getElementById('attachmentInput');
+const attachCount = document.getElementById('attachCount');
+
+function updateAttachCount() {
+    if (!attachmentInput || !attachCount) return;
+    const n = attachmentInput.files.length;
+    attachCount.textContent = n;
+    attachCount.hidden = n === 0;
+}
+attachmentInput?.addEventListener('change', updateAttachCount);
+
+document.body.addEventListener('htmx:afterRequest', e => {
+    if (e.target.id !== 'chat-form' || !e.detail.successful || !attachmentInput) return;
+    attachmentInput.value = '';
+    updateAttachCount();
+});
+
+document.body.addEventListener('htmx:responseError', e => {
+    const status = e.detail.xhr.status;
+    if (e.target.id !== 'chat-form' || ![400, 413, 415].includes(status)) return;
+    alert(e.detail.xhr.responseText);
+});
 document.body.addEventListener('htmx:afterSwap', e => {
     if (e.target.id === 'chat-box') aiGenerating = false;
 });
 
+// ====================== 排隊位置與伺服器忙碌提示 ======================
+const loadingIndicator = document.getElementById('loading-indicator-wrapper');
+const loadingText = document.getElementById('loadingText');
+const LOADING_TEXT = 'AI 正在回覆中...';
+let queuePollTimer = null;
+
+async function pollQueuePosition() {
+    try {
+        const { position } = await (await fetch('/api/queue')).json();
+        if (loadingText) {
+            loadingText.textContent = position > 0
+                ? `排隊中，前面還有 ${position - 1} 位...`
+                : LOADING_TEXT;
+        }
+    } catch (err) {
+        console.warn('查詢排隊位置失敗:', err);
+    }
+}
+
+document.body.addEventListener('htmx:beforeRequest', e => {
+    if (e.target.id !== 'chat-form') return;
+    clearInterval(queuePollTimer);
+    queuePollTimer = setInterval(pollQueuePosition, 1000);
+});
+
+document.body.addEventListener('htmx:afterRequest', e => {
+    if (e.target.id !== 'chat-form') return;
+    clearInterval(queuePollTimer);
+    queuePollTimer = null;
+    if (loadingText) loadingText.textContent = LOADING_TEXT;
+    // 請求失敗或被中止（204，沒有內容）時不會觸發 afterSwap，這裡也要解除鎖定
+    if (!e.detail.successful || e.detail.xhr.status === 204) aiGenerating = false;
+});
+
+document.body.addEventListener('htmx:responseError', e => {
+    const xhr = e.detail.xhr;
+    if (xhr.status !== 429) return;
+    const retryAfter = xhr.getResponseHeader('Retry-After') || '數';
+    alert(`伺服器忙碌中，請於 ${retryAfter} 秒後再試。`);
+});
+
+// ====================== 停止生成 ======================
+// 每次生成帶一個 X-Generation-Id，停止時以它通知伺服器中止模型呼叫
+let currentGenerationId = null;
+const keepPartialInput = document.getElementById('keepPartialInput');
+
+if (keepPartialInput) {
+    keepPartialInput.checked = localStorage.getItem('keepPartial') !== '0';
+    keepPartialInput.addEventListener('change', () => {
+        localStorage.setItem('keepPartial', keepPartialInput.checked ? '1' : '0');
+    });
+}
+
+document.body.addEventListener('htmx:configRequest', e => {
+    const path = e.detail.path;
+    if (path !== '/chat' && !/\/messages\/\d+\/(regenerate|edit)$/.test(path)) return;
+    currentGenerationId = `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 10)}`;
+    e.detail.headers['X-Generation-Id'] = currentGenerationId;
+});
+
+function abortGeneration(keepPartial, useBeacon = false) {
+    if (!aiGenerating || !currentGenerationId) return;
+    const body = new FormData();
+    body.append('generation_id', currentGenerationId);
+    body.append('keep_partial', keepPartial ? 'true' : 'false');
+    // 關閉或重新整理頁面時一般請求可能來不及送出，改用 sendBeacon
+    if (useBeacon) navigator.sendBeacon('/chat/abort', body);
+    else fetch('/chat/abort', { method: 'POST', body }).catch(err => console.warn('中止生成失敗:', err));
+}
+
+document.getElementById('stopGenerationBtn')?.addEventListener('click', () => {
+    abortGeneration(keepPartialInput?.checked ?? true);
+});
+
+// 生成途中切換對話：中止生成且不保留，也不讓舊請求的回應插進新的對話畫面
+document.body.addEventListener('htmx:beforeRequest', e => {
+    const config = e.detail.requestConfig;
+    if (!aiGenerating || config?.verb !== 'get' || !/^\/conversation\/\d+$/.test(config.path)) return;
+    abortGeneration(false);
+    if (chatForm) htmx.trigger(chatForm, 'htmx:abort');
+});
+
+window.addEventListener('pagehide', () => abortGeneration(false, true));
+
 // ====================== 初始載入 ======================
 window.onload = () => {
     if (chatBox) chatBox.scrollTop = chatBox.scrollHeight;
+    lastChatScrollTop = chatBox ? chatBox.scrollTop : 0;
     initMessageEffects();
+    observeMessages();
+    fillViewportWithHistory();
     if (typeof updateScrollbar === 'function') updateScrollbar();
     if (userInput) adjustTextareaHeight();
     hljs.highlightAll();
@@ -450,7 +767,8 @@ initSidebarActiveState();
 
 // --- 新增：HTMX 請求後更新對話標題 ---
 document.body.addEventListener('htmx:afterRequest', (e) => {
-    if (e.detail.requestConfig.path === '/chat') {
+    const path = e.detail.requestConfig.path;
+    if (path === '/chat' || path.endsWith('/adopt')) {
         const raw = e.detail.xhr.getResponseHeader('X-New-Conversation-Title');
         if (raw) {
             // decode percent‑encoded 標題
@@ -0,0 +1,76 @@
+"""
+測試共用設定：把家目錄指到暫存資料夾，資料庫、附件、封存檔都寫在那裡，
+不會碰到使用者真正的 ~/GeminiChat。必須在匯入任何專案模組之前設定。
+"""
+
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+_HOME = tempfile.mkdtemp(prefix="geminichat-test-")
+os.environ["HOME"] = _HOME
+os.environ["USERPROFILE"] = _HOME
+# 一律以預設設定執行（預設的本機雜湊嵌入不會連到 API）
+for _name in [n for n in os.environ if n.startswith("GEMINICHAT_")]:
+    del os.environ[_name]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# 模板與靜態檔以相對路徑載入
+os.chdir(ROOT)
+
+import pytest  # noqa: E402
+
+import database  # noqa: E402
+
+database.init_db()
+
+
+@pytest.fixture
+def user_id():
+    """每個測試一個新使用者，資料彼此不干擾"""
+    return database.get_or_create_user(f"user-{os.urandom(6).hex()}")
+
+
+@pytest.fixture
+def slow_server():
+    """
+    /fast 立即回覆（連線保持 keep-alive）；其他路徑的回應標頭在 headers_delay 秒後送出，
+    之後的內容永遠不來（模擬模型還在思考）。
+    """
+    srv = socket.socket()
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind(("127.0.0.1", 0))
+    srv.listen(8)
+    settings = {"headers_delay": 0.0}
+
+    def handle(conn):
+        with conn:
+            try:
+                while request := conn.recv(65536):
+                    if request.startswith(b"GET /fast "):
+                        conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+                        continue
+                    time.sleep(settings["headers_delay"])
+                    conn.sendall(
+                        b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                        b"Transfer-Encoding: chunked\r\n\r\n"
+                    )
+                    time.sleep(30)
+            except OSError:
+                pass
+
+    def serve():
+        while True:
+            try:
+                conn, _ = srv.accept()
+            except OSError:
+                return
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    yield f"http://127.0.0.1:{srv.getsockname()[1]}/", settings
+    srv.close()
@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected
+
+
+def _controller(**overrides) -> AdmissionController:
+    settings = dict(per_user_limit=1, rate_per_sec=1000, burst=100, max_queue=10, queue_timeout=5)
+    settings.update(overrides)
+    return AdmissionController(**settings)
+
+
+def test_per_user_limit_queues_until_release():
+    gate = _controller()
+
+    async def scenario():
+        await gate.acquire("alice")
+        waiter = asyncio.ensure_future(gate.acquire("alice"))
+        await asyncio.sleep(0.01)
+        assert not waiter.done() and gate.queue_position("alice") == 1
+        gate.release("alice")
+        await asyncio.wait_for(waiter, 1)
+        assert gate.inflight("alice") == 1
+
+    asyncio.run(scenario())
+
+
+def test_round_robin_between_users():
+    gate = _controller(per_user_limit=10, rate_per_sec=0.001, burst=1)
+    order = []
+
+    async def take(user):
+        await gate.acquire(user)
+        order.append(user)
+
+    async def scenario():
+        await gate.acquire("holder")  # 用掉唯一的 token，其他人都得排隊
+        tasks = [asyncio.ensure_future(take(u)) for u in ("a", "a", "a", "b")]
+        await asyncio.sleep(0.01)
+        for _ in tasks:
+            gate._tokens += 1
+            gate._pump()
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+    # b 排在 a 的第二筆之前，不會被同一位使用者的大量請求擋住
+    assert order[:2] == ["a", "b"]
+
+
+def test_full_queue_and_timeout_are_rejected():
+    gate = _controller(max_queue=1, queue_timeout=0.05)
+
+    async def scenario():
+        await gate.acquire("u")
+        waiter = asyncio.ensure_future(gate.acquire("u"))
+        await asyncio.sleep(0.01)
+        with pytest.raises(AdmissionRejected) as full:
+            await gate.acquire("u")
+        assert full.value.retry_after >= 1
+        with pytest.raises(AdmissionRejected):
+            await waiter
+        assert gate.queued() == 0
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    gate = _controller()
+
+    async def scenario():
+        await gate.acquire("u")
+        waiter = asyncio.ensure_future(gate.acquire("u"))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        assert gate.queued() == 0
+        gate.release("u")
+        assert gate.inflight() == 0
+
+    asyncio.run(scenario())
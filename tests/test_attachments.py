@@ -0,0 +1,128 @@
+import io
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from starlette.testclient import TestClient
+
+import attachments
+import database
+import maintenance
+
+
+def _store(data: bytes, filename: str, content_type: str) -> dict:
+    return attachments.store_upload(io.BytesIO(data), filename, content_type)
+
+
+def _message_with(user_id: int, record: dict) -> tuple[int, int]:
+    cid = database.create_conversation(user_id, "附件")
+    mid = database.save_message(cid, "user", "看這個")
+    database.link_attachments(mid, [record])
+    return cid, mid
+
+
+def _age(sha: str, days: int) -> None:
+    """把附件的時間往前調，模擬早已過了清理寬限期"""
+    ts = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    conn = database.get_connection()
+    conn.execute(
+        "UPDATE attachments SET created_at = ?, last_stored_at = ? WHERE sha256 = ?",
+        (ts, ts, sha),
+    )
+    conn.commit()
+    conn.close()
+
+
+def _login(username: str) -> tuple[TestClient, int]:
+    import main
+
+    client = TestClient(main.app)
+    client.post("/login", data={"username": username}, follow_redirects=False)
+    return client, database.get_or_create_user(username)
+
+
+def test_svg_upload_is_rejected():
+    with pytest.raises(attachments.AttachmentError) as e:
+        _store(b"<svg onload='alert(1)'/>", "x.svg", "image/svg+xml")
+    assert e.value.status_code == 415
+
+
+def test_identical_uploads_share_one_blob():
+    a = _store(b"same bytes", "a.txt", "text/plain")
+    b = _store(b"same bytes", "b.txt", "text/plain")
+    assert a["sha256"] == b["sha256"]
+    assert os.path.exists(attachments.blob_path(a["sha256"]))
+
+
+def test_html_is_served_as_plain_text_with_nosniff():
+    client, uid = _login("html-owner")
+    rec = _store(b"<script>alert(1)</script>", "page.html", "text/html")
+    _message_with(uid, rec)
+
+    resp = client.get(f"/attachments/{rec['sha256']}")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain")
+    assert resp.headers["x-content-type-options"] == "nosniff"
+    assert "sandbox" in resp.headers["content-security-policy"]
+
+
+def test_non_inline_types_are_downloads():
+    assert attachments.serve_as("application/pdf") == ("application/pdf", "attachment")
+    assert attachments.serve_as("image/svg+xml")[1] == "attachment"
+    assert attachments.serve_as("image/png") == ("image/png", "inline")
+
+
+def test_attachment_is_private_to_its_owner():
+    owner, uid = _login("attachment-owner")
+    stranger, _ = _login("attachment-stranger")
+    rec = _store(os.urandom(32), "secret.txt", "text/plain")
+    url = f"/attachments/{rec['sha256']}"
+
+    # 上傳了但還沒連結到訊息：誰都看不到
+    assert owner.get(url).status_code == 404
+    _message_with(uid, rec)
+    assert owner.get(url).status_code == 200
+    assert stranger.get(url).status_code == 404
+    assert TestClient(owner.app).get(url).status_code == 404
+
+
+def test_reupload_of_orphan_survives_gc():
+    rec = _store(os.urandom(32), "orphan.txt", "text/plain")
+    _age(rec["sha256"], days=3)
+
+    # 同內容再上傳一次（去重沿用），還沒連結到訊息前清理工作剛好執行
+    _store(open(attachments.blob_path(rec["sha256"]), "rb").read(), "again.txt", "text/plain")
+    attachments.purge_orphans()
+
+    assert database.get_attachment(rec["sha256"]) is not None
+    assert os.path.exists(attachments.blob_path(rec["sha256"]))
+
+
+def test_old_orphans_are_purged():
+    rec = _store(os.urandom(32), "gone.txt", "text/plain")
+    _age(rec["sha256"], days=3)
+    attachments.purge_orphans()
+    assert database.get_attachment(rec["sha256"]) is None
+    assert not os.path.exists(attachments.blob_path(rec["sha256"]))
+
+
+def test_archive_round_trip_keeps_attachments(user_id):
+    rec = _store(os.urandom(32), "kept.txt", "text/plain")
+    cid, mid = _message_with(user_id, rec)
+    data = database.export_conversation(cid)
+    assert data["messages"][0]["attachments"][0]["sha256"] == rec["sha256"]
+
+    # 封存：訊息列刪除，附件由 archived_attachments 保留
+    maintenance.pin_archived_attachments(user_id, cid, [rec["sha256"]])
+    database.delete_conversation(cid)
+    maintenance.reap_deleted()
+    _age(rec["sha256"], days=3)
+    attachments.purge_orphans()
+    assert os.path.exists(attachments.blob_path(rec["sha256"]))
+
+    new_cid = database.import_conversation(user_id, data)
+    maintenance.unpin_archived_attachments(user_id, cid)
+    (msg,) = database.load_messages(new_cid)
+    assert [a["sha256"] for a in database.load_message_attachments([msg["id"]])[msg["id"]]] == [
+        rec["sha256"]
+    ]
@@ -0,0 +1,115 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import batch
+import database
+import gemini_client
+
+
+class StubClient:
+    """generate_content 交給 respond(api_key, contents) 決定結果，並記錄每次呼叫"""
+
+    def __init__(self, api_key: str, respond):
+        self.api_key = api_key
+        self.respond = respond
+        self.calls = 0
+        self.models = self
+
+    def generate_content(self, model, contents, config=None):
+        self.calls += 1
+        return self.respond(self.api_key, contents)
+
+
+def _stub_clients(monkeypatch, respond) -> dict[str, StubClient]:
+    clients: dict[str, StubClient] = {}
+    lock = threading.Lock()
+
+    def client_for(api_key, pool):
+        with lock:
+            return clients.setdefault(api_key, StubClient(api_key, respond))
+
+    monkeypatch.setattr(gemini_client, "client_for", client_for)
+    return clients
+
+
+def _job(tmp_path, prompts: list[str]) -> int:
+    out = tmp_path / "out.jsonl"
+    return database.create_batch_job(
+        str(tmp_path / "in.jsonl"),
+        str(out),
+        "test-model",
+        [(str(i), None, None, p) for i, p in enumerate(prompts)],
+    )
+
+
+def _text(contents) -> str:
+    return contents[-1].parts[0].text
+
+
+def test_batch_uses_its_own_pool(tmp_path, monkeypatch):
+    pools = []
+    real_open_pool = gemini_client.open_pool
+
+    def spy(max_connections):
+        pool = real_open_pool(max_connections)
+        pools.append((max_connections, pool))
+        return pool
+
+    monkeypatch.setattr(gemini_client, "open_pool", spy)
+    _stub_clients(monkeypatch, lambda key, contents: SimpleNamespace(text=_text(contents).upper()))
+    before = gemini_client.MAX_CONNECTIONS
+    job_id = _job(tmp_path, [f"prompt {i}" for i in range(10)])
+
+    assert batch.execute(job_id, per_key=3)
+
+    # 連線池上限只套用在批次自己的池，模組常數與共用池不受影響
+    assert gemini_client.MAX_CONNECTIONS == before
+    assert pools[0][0] == max(before, len(batch.API_KEYS) * 3)
+    assert pools[0][1]._pool._max_connections == pools[0][0]
+    lines = [json.loads(line) for line in open(tmp_path / "out.jsonl", encoding="utf-8")]
+    assert sorted(line["text"] for line in lines) == sorted(f"PROMPT {i}" for i in range(10))
+
+
+def test_failed_items_can_be_retried(tmp_path, monkeypatch):
+    calls = []
+
+    def flaky(key, contents):
+        calls.append(contents)
+        if len(calls) == 1:
+            raise ValueError("bad prompt")  # 沒有 code：視為可重試
+        return SimpleNamespace(text="ok")
+
+    monkeypatch.setattr(batch, "MAX_ATTEMPTS", 1)
+    _stub_clients(monkeypatch, flaky)
+    job_id = _job(tmp_path, ["only"])
+
+    assert batch.execute(job_id, per_key=1)
+    assert database.load_batch_items(job_id, ("failed",))
+    database.reset_failed_batch_items(job_id)
+    assert batch.execute(job_id, per_key=1)
+    assert [i["result"] for i in database.load_batch_items(job_id, ("done",))] == ["ok"]
+
+
+class AuthError(Exception):
+    code = 401
+
+
+def test_bad_key_does_not_disable_a_working_key(tmp_path, monkeypatch):
+    def respond(key, contents):
+        time.sleep(0.05)  # 讓兩把 Key 的重複提示同時在進行中
+        if key == "bad-key":
+            raise AuthError("API key not valid")
+        return SimpleNamespace(text=f"{key}:{_text(contents)}")
+
+    monkeypatch.setattr(batch, "API_KEYS", ["bad-key", "good-key"])
+    clients = _stub_clients(monkeypatch, respond)
+    job_id = _job(tmp_path, ["同一個提示"] * 8)
+
+    assert batch.execute(job_id, per_key=2)
+
+    done = database.load_batch_items(job_id, ("done",))
+    assert len(done) == 8
+    assert {i["result"] for i in done} == {"good-key:同一個提示"}
+    assert clients["bad-key"].calls >= 1
@@ -0,0 +1,105 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import httpx
+from google.genai.types import Content, Part
+
+import compare
+import database
+from admission import AdmissionController
+
+THREAD = [Content(role="user", parts=[Part(text="比較一下")])]
+
+
+class StubClient:
+    """generate_content 花 delay 秒，記錄同時進行中的最大呼叫數"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.active = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+        self.models = self
+
+    def generate_content(self, model, contents, config=None):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+        return SimpleNamespace(text=f"{model} 的回答", usage_metadata=None)
+
+
+def _controller(per_user_limit: int) -> AdmissionController:
+    return AdmissionController(
+        per_user_limit=per_user_limit, rate_per_sec=100, burst=10, max_queue=10, queue_timeout=5
+    )
+
+
+def test_each_model_holds_an_admission_slot_until_it_finishes(monkeypatch):
+    gate = _controller(per_user_limit=2)
+    monkeypatch.setattr(compare, "admission", gate)
+    stub = StubClient(delay=0.2)
+
+    async def scenario():
+        run = compare.start_run(stub, "user:cmp", 1, 1, "問", [], ["a", "b", "c"], THREAD)
+        await asyncio.sleep(0.05)
+        # 三個模型、每位使用者上限 2：第三個在排隊，而不是繞過限制
+        assert gate.inflight("user:cmp") == 2
+        results = [await compare.wait_result(run, i) for i in range(3)]
+        compare.discard_run(run.id)
+        return results
+
+    results = asyncio.run(scenario())
+    assert [r["status"] for r in results] == ["ok", "ok", "ok"]
+    assert stub.peak == 2
+    assert gate.inflight() == 0
+
+
+def test_discard_releases_slots_and_reports_cancelled(monkeypatch):
+    gate = _controller(per_user_limit=4)
+    monkeypatch.setattr(compare, "admission", gate)
+
+    async def scenario():
+        run = compare.start_run(StubClient(delay=0.3), "user:d", 1, 1, "問", [], ["a", "b"], THREAD)
+        await asyncio.sleep(0.05)
+        assert compare.discard_run(run.id) is run
+        assert compare.discard_run(run.id) is None
+        result = await compare.wait_result(run, 0)
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(scenario())["status"] == "cancelled"
+    assert gate.inflight() == 0
+
+
+def test_concurrent_adopts_save_once(monkeypatch):
+    import main
+
+    async def no_title(*args):
+        return None
+
+    monkeypatch.setattr(main, "_maybe_generate_title", no_title)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            await client.post("/login", data={"username": "adopter"})
+            uid = database.get_or_create_user("adopter")
+            cid = database.create_conversation(uid, "比較")
+            run = compare.start_run(
+                StubClient(delay=0.1), "user:adopter", uid, cid, "問", [], ["a", "b"], THREAD
+            )
+            # 連點兩下：兩個請求都在等同一個模型的結果，結果出來後依序恢復執行
+            responses = await asyncio.gather(
+                client.post(f"/chat/compare/{run.id}/0/adopt"),
+                client.post(f"/chat/compare/{run.id}/0/adopt"),
+            )
+            return cid, sorted(r.status_code for r in responses)
+
+    cid, statuses = asyncio.run(scenario())
+    assert statuses == [200, 409]
+    assert len(database.load_messages(cid)) == 2
@@ -0,0 +1,98 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import completion_cache
+from completion_cache import SingleFlight, TTLCache
+
+
+class CountingClient:
+    def __init__(self, delay: float = 0.0, error: Exception | None = None):
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+        self.models = self
+
+    def generate_content(self, model, contents, config=None):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return SimpleNamespace(text=f"{model}:{self.calls}")
+
+
+def test_single_flight_shares_result_and_exception():
+    flight = SingleFlight()
+    started = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        time.sleep(0.1)
+        raise ValueError("boom")
+
+    errors = []
+
+    def worker():
+        try:
+            flight.do("k", slow)
+        except ValueError as e:
+            errors.append(e)
+
+    first = threading.Thread(target=worker)
+    first.start()
+    started.wait()
+    second = threading.Thread(target=worker)
+    second.start()
+    first.join()
+    second.join()
+    assert len(calls) == 1 and len(errors) == 2
+    # 結束後不再合併：下一次呼叫重新執行
+    assert flight.do("k", lambda: "again") == "again"
+
+
+def test_ttl_cache_expires_and_evicts_lru():
+    cache = TTLCache(max_entries=2)
+    cache.set("a", 1, ttl=60)
+    cache.set("b", 2, ttl=60)
+    cache.get("a")
+    cache.set("c", 3, ttl=60)
+    assert cache.get("b") is None and cache.get("a") == 1
+    cache.set("short", 4, ttl=0.01)
+    time.sleep(0.02)
+    assert cache.get("short") is None
+
+
+def test_generate_content_caches_only_with_ttl():
+    client = CountingClient()
+    contents = [{"role": "user", "parts": [{"text": f"標題 {time.monotonic_ns()}"}]}]
+
+    completion_cache.generate_content(client, "m", contents)
+    completion_cache.generate_content(client, "m", contents)
+    assert client.calls == 2
+
+    first = completion_cache.generate_content(client, "m", contents, cache_ttl=60)
+    assert completion_cache.is_cached("m", contents)
+    assert completion_cache.generate_content(client, "m", contents, cache_ttl=60) is first
+    assert client.calls == 3
+    assert not completion_cache.is_cached("other", contents)
+
+
+def test_errors_are_not_cached():
+    contents = [{"role": "user", "parts": [{"text": f"錯誤 {time.monotonic_ns()}"}]}]
+    with pytest.raises(RuntimeError):
+        completion_cache.generate_content(
+            CountingClient(error=RuntimeError("quota")), "m", contents, cache_ttl=60
+        )
+    assert not completion_cache.is_cached("m", contents)
+
+
+def test_request_key_depends_on_model_contents_and_config():
+    contents = [{"role": "user", "parts": [{"text": "hi"}]}]
+    key = completion_cache.request_key("m", contents)
+    assert key == completion_cache.request_key("m", [dict(contents[0])])
+    assert key != completion_cache.request_key("n", contents)
+    assert key != completion_cache.request_key("m", contents, {"stream": True})
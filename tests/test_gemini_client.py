@@ -0,0 +1,73 @@
+import threading
+import time
+
+import httpx
+import pytest
+
+import gemini_client
+
+
+def _read_in_thread(client: httpx.Client, url: str, tracker) -> tuple[threading.Thread, dict]:
+    outcome = {}
+
+    def reader():
+        start = time.monotonic()
+        try:
+            with gemini_client.closing_responses(tracker):
+                with client.stream("GET", url) as r:
+                    for _ in r.iter_bytes():
+                        pass
+        except httpx.HTTPError as e:
+            outcome["error"] = e
+        outcome["seconds"] = time.monotonic() - start
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    return thread, outcome
+
+
+@pytest.mark.parametrize("headers_delay", [0.0, 5.0])
+def test_cancel_interrupts_a_blocked_read(slow_server, headers_delay):
+    url, settings = slow_server
+    settings["headers_delay"] = headers_delay
+    pool = gemini_client.open_pool(4)
+    client = httpx.Client(transport=pool)
+    tracker = gemini_client.RequestTracker()
+
+    thread, outcome = _read_in_thread(client, url, tracker)
+    time.sleep(0.3)
+    # 不論是在等回應標頭還是等第一個片段，中止都要立即生效
+    tracker.cancel()
+    thread.join(3)
+    assert not thread.is_alive()
+    assert outcome["seconds"] < 2
+    assert "error" in outcome
+    pool.shutdown()
+
+
+def test_late_cancel_does_not_abort_a_reused_connection(slow_server):
+    url, _ = slow_server
+    pool = gemini_client.open_pool(1)  # 只有一條連線，第二個請求一定沿用它
+    client = httpx.Client(transport=pool)
+    tracker = gemini_client.RequestTracker()
+    with gemini_client.closing_responses(tracker):
+        assert client.get(url + "fast").text == "ok"
+
+    other, outcome = _read_in_thread(client, url + "slow", None)
+    time.sleep(0.3)
+    # 前一個請求早已結束：它的 cancel 不能中斷正在使用同一條連線的其他請求
+    tracker.cancel()
+    other.join(1)
+    assert other.is_alive()
+
+
+def test_cancelled_tracker_refuses_new_requests(slow_server):
+    url, _ = slow_server
+    pool = gemini_client.open_pool(4)
+    client = httpx.Client(transport=pool)
+    tracker = gemini_client.RequestTracker()
+    tracker.cancel()
+    with pytest.raises(httpx.HTTPError):
+        with gemini_client.closing_responses(tracker):
+            client.get(url)
+    pool.shutdown()
@@ -0,0 +1,138 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+import gemini_client
+import generations
+
+CONTENTS = [{"role": "user", "parts": [{"text": "寫一首詩"}]}]
+
+
+class FakeRequest:
+    async def is_disconnected(self) -> bool:
+        return False
+
+
+class ChunkClient:
+    """generate_content_stream 每隔 delay 秒送出一個片段，記錄實際呼叫次數"""
+
+    def __init__(self, chunks: list[str], delay: float):
+        self.chunks = chunks
+        self.delay = delay
+        self.calls = 0
+        self.started = threading.Event()
+        self.models = self
+
+    def generate_content_stream(self, model, contents):
+        self.calls += 1
+        self.started.set()
+        for text in self.chunks:
+            time.sleep(self.delay)
+            yield SimpleNamespace(text=text, usage_metadata=None)
+
+
+class HangingClient:
+    """透過受追蹤的連線池送出請求，伺服器遲遲不回第一個片段"""
+
+    def __init__(self, url: str):
+        self.http = httpx.Client(transport=gemini_client.open_pool(2))
+        self.url = url
+        self.finished = threading.Event()
+        self.models = self
+
+    def generate_content_stream(self, model, contents):
+        try:
+            with self.http.stream("GET", self.url) as r:
+                for _ in r.iter_bytes():
+                    yield SimpleNamespace(text="x", usage_metadata=None)
+        finally:
+            self.finished.set()
+
+
+def _gen(name: str) -> generations.Generation:
+    return generations.register(f"{name}-{time.monotonic_ns()}", 1, 1)
+
+
+def _run(gen, client):
+    return generations.run(FakeRequest(), gen, generations.stream, gen, client, "m", CONTENTS, "chat")
+
+
+def test_identical_streams_share_one_call():
+    client = ChunkClient(["床前", "明月光"], delay=0.1)
+
+    async def scenario():
+        return await asyncio.gather(_run(_gen("a"), client), _run(_gen("b"), client))
+
+    assert asyncio.run(scenario()) == ["床前明月光", "床前明月光"]
+    assert client.calls == 1
+
+
+def test_follower_retries_when_leader_is_cancelled():
+    client = ChunkClient(["床前", "明月光"], delay=0.2)
+    leader, follower = _gen("leader"), _gen("follower")
+
+    async def scenario():
+        first = asyncio.ensure_future(_run(leader, client))
+        await asyncio.to_thread(client.started.wait)
+        second = asyncio.ensure_future(_run(follower, client))
+        await asyncio.sleep(0.05)
+        leader.cancel("stopped", keep_partial=True)
+        with pytest.raises(generations.GenerationCancelled):
+            await first
+        return await second
+
+    # 不沿用帶頭者被中止時的部分內容，而是重新完整產生
+    assert asyncio.run(scenario()) == "床前明月光"
+    assert client.calls == 2
+
+
+def test_cancel_before_first_chunk_closes_the_upstream_request(slow_server):
+    url, settings = slow_server
+    settings["headers_delay"] = 5.0
+    client = HangingClient(url + "slow")
+    gen = _gen("ttft")
+
+    async def scenario():
+        task = asyncio.ensure_future(_run(gen, client))
+        await asyncio.sleep(0.3)
+        start = time.monotonic()
+        gen.cancel("stopped")
+        with pytest.raises(generations.GenerationCancelled):
+            await task
+        return time.monotonic() - start
+
+    elapsed = asyncio.run(scenario())
+    # 中止的一方直接中斷連線：不必等第一個片段，也不是等寬限時間用完才放手
+    assert client.finished.is_set()
+    assert elapsed < generations.CANCEL_GRACE
+    assert gen.id not in generations._active
+
+
+def test_cancelled_follower_stops_waiting_for_the_leader():
+    client = ChunkClient(["很", "慢", "的", "回答"], delay=0.5)
+    leader, follower = _gen("leader"), _gen("follower")
+    follower_done = threading.Event()
+
+    def follow():
+        generations.stream(follower, client, "m", CONTENTS, "chat")
+        follower_done.set()
+
+    async def scenario():
+        first = asyncio.ensure_future(_run(leader, client))
+        await asyncio.to_thread(client.started.wait)
+        threading.Thread(target=follow, daemon=True).start()
+        await asyncio.sleep(0.1)
+        start = time.monotonic()
+        follower.cancel("stopped")
+        # 跟隨者的工作執行緒很快就結束，不必等帶頭的請求跑完（約 2 秒）
+        assert await asyncio.to_thread(follower_done.wait, 1)
+        elapsed = time.monotonic() - start
+        assert await first == "很慢的回答"
+        return elapsed
+
+    assert asyncio.run(scenario()) < 0.5
+    assert client.calls == 1
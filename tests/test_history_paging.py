@@ -0,0 +1,66 @@
+from starlette.testclient import TestClient
+
+import database
+
+
+def _line(user_id: int, count: int) -> tuple[int, list[int]]:
+    cid = database.create_conversation(user_id, "分頁")
+    return cid, [database.save_message(cid, "user", f"第 {i} 則") for i in range(count)]
+
+
+def _page(client: TestClient, cid: int, before_id: int, limit: int):
+    return client.get(f"/conversation/{cid}/messages", params={"before_id": before_id, "limit": limit})
+
+
+def _login(username: str) -> tuple[TestClient, int]:
+    import main
+
+    client = TestClient(main.app)
+    client.post("/login", data={"username": username}, follow_redirects=False)
+    return client, database.get_or_create_user(username)
+
+
+def test_before_id_pages_walk_back_without_gaps_or_overlap(user_id):
+    cid, ids = _line(user_id, 7)
+    assert [m["id"] for m in database.load_messages(cid, limit=3)] == ids[4:]
+    assert [m["id"] for m in database.load_messages(cid, limit=3, before_id=ids[4])] == ids[1:4]
+    assert [m["id"] for m in database.load_messages(cid, limit=3, before_id=ids[1])] == ids[:1]
+    assert database.load_messages(cid, limit=3, before_id=ids[0]) == []
+
+
+def test_before_id_from_another_conversation_returns_nothing(user_id):
+    cid, _ids = _line(user_id, 3)
+    _other, other_ids = _line(user_id, 3)
+    assert database.load_messages(cid, before_id=other_ids[-1]) == []
+
+
+def test_before_id_on_another_branch_follows_that_branch(user_id):
+    cid = database.create_conversation(user_id, "分支分頁")
+    q = database.save_message(cid, "user", "問")
+    a1 = database.save_message(cid, "model", "答一")
+    follow = database.save_message(cid, "user", "追問")
+    a2 = database.save_message(cid, "model", "答二", parent_id=q, fork=True)
+
+    # 游標只沿 parent_id 往上走，不會混入目前分支（a2）以外的訊息
+    assert [m["id"] for m in database.load_messages(cid, before_id=follow)] == [q, a1]
+    assert [m["id"] for m in database.load_messages(cid)] == [q, a2]
+
+
+def test_messages_endpoint_reports_has_more():
+    client, uid = _login("pager")
+    cid, ids = _line(uid, 5)
+
+    first = _page(client, cid, ids[-1], 2).json()
+    assert [m["id"] for m in first["messages"]] == ids[2:4] and first["has_more"]
+    last = _page(client, cid, ids[2], 2).json()
+    assert [m["id"] for m in last["messages"]] == ids[:2] and not last["has_more"]
+
+
+def test_messages_endpoint_requires_the_owner():
+    import main
+
+    _owner, uid = _login("page-owner")
+    cid, ids = _line(uid, 3)
+    assert _page(TestClient(main.app), cid, ids[-1], 2).status_code == 401
+    stranger, _ = _login("page-stranger")
+    assert _page(stranger, cid, ids[-1], 2).status_code == 404
@@ -0,0 +1,160 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+from starlette.testclient import TestClient
+
+import database
+import maintenance
+
+OLD = "2000-01-01T00:00:00"
+
+
+def _old_conversation(user_id: int, title: str) -> int:
+    """建立一個很久沒有活動、會被封存的會話"""
+    return database.import_conversation(
+        user_id,
+        {
+            "title": title,
+            "created_at": OLD,
+            "messages": [
+                {"id": 1, "parent_id": None, "role": "user", "text": f"{title} 問", "timestamp": OLD},
+                {"id": 2, "parent_id": 1, "role": "model", "text": f"{title} 答", "timestamp": OLD},
+            ],
+        },
+    )
+
+
+def test_archive_and_restore_round_trip(user_id):
+    cid = _old_conversation(user_id, "舊對話")
+    assert maintenance.archive_old_conversations(days=30) >= 1
+    assert database.get_conversation(cid) is None
+
+    (archived,) = maintenance.list_archived_conversations(user_id)
+    assert archived["message_count"] == 2
+    new_cid = maintenance.restore_conversation(user_id, archived["id"])
+    msgs = database.load_messages(new_cid, limit=10)
+    assert [m["text"] for m in msgs] == ["舊對話 問", "舊對話 答"]
+    assert maintenance.list_archived_conversations(user_id) == []
+
+
+def test_archive_during_restore_is_not_lost(user_id, monkeypatch):
+    _old_conversation(user_id, "第一個")
+    maintenance.archive_old_conversations(days=30)
+    (first,) = maintenance.list_archived_conversations(user_id)
+    _old_conversation(user_id, "第二個")
+
+    real_import = maintenance.import_conversation
+    archiver = threading.Thread(target=maintenance.archive_old_conversations, args=(30,))
+
+    def slow_import(uid, data):
+        # 還原讀完封存檔、還沒重寫之前，背景封存剛好附加了一筆
+        archiver.start()
+        time.sleep(0.3)
+        return real_import(uid, data)
+
+    monkeypatch.setattr(maintenance, "import_conversation", slow_import)
+    maintenance.restore_conversation(user_id, first["id"])
+    archiver.join()
+
+    titles = [a["title"] for a in maintenance.list_archived_conversations(user_id)]
+    assert "第二個" in titles
+
+
+def test_startup_does_not_vacuum_legacy_database(tmp_path, monkeypatch):
+    path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE legacy (x)")
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(database, "DB_PATH", path)
+
+    database.init_db()
+    conn = sqlite3.connect(path)
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+    conn.close()
+
+    assert maintenance.enable_incremental_vacuum() is True
+    assert maintenance.enable_incremental_vacuum() is False
+    conn = sqlite3.connect(path)
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    conn.close()
+
+
+def test_db_stats_requires_login():
+    import main
+
+    assert TestClient(main.app).get("/api/db/stats").status_code == 401
+
+
+def test_deleted_conversation_is_hidden_then_reaped(user_id, monkeypatch):
+    monkeypatch.setattr(maintenance, "REAPER_BATCH", 2)
+    cid = database.create_conversation(user_id, "要刪除")
+    for i in range(5):
+        database.save_message(cid, "user", f"第 {i} 則")
+
+    database.delete_conversation(cid)
+    assert database.get_conversation(cid) is None
+    assert cid not in [c["id"] for c in database.load_conversations(user_id)]
+
+    assert maintenance.reap_deleted() >= 5
+    conn = database.get_connection()
+    messages = conn.execute(
+        "SELECT COUNT(*) FROM messages WHERE conversation_id = ?", (cid,)
+    ).fetchone()[0]
+    rows = conn.execute("SELECT COUNT(*) FROM conversations WHERE id = ?", (cid,)).fetchone()[0]
+    conn.close()
+    assert messages == 0 and rows == 0
+
+
+def test_deleted_conversation_cannot_be_read_or_written(user_id):
+    cid = database.create_conversation(user_id, "已刪除")
+    mid = database.save_message(cid, "user", "問")
+    database.save_message(cid, "model", "答")
+    database.delete_conversation(cid)
+
+    assert database.load_messages(cid) == []
+    assert database.load_messages(cid, before_id=mid + 1) == []
+    with pytest.raises(database.ConversationDeleted):
+        database.save_message(cid, "user", "還在嗎")
+
+
+def _login(username: str) -> tuple[TestClient, int]:
+    import main
+
+    client = TestClient(main.app)
+    client.post("/login", data={"username": username}, follow_redirects=False)
+    return client, database.get_or_create_user(username)
+
+
+def test_deleted_conversation_routes_return_404():
+    client, uid = _login("tombstone-viewer")
+    cid = database.create_conversation(uid, "已刪除")
+    database.save_message(cid, "user", "問")
+    database.delete_conversation(cid)
+
+    assert client.get(f"/conversation/{cid}").status_code == 404
+    response = client.post("/chat", data={"user_input": "嗨", "model": "m", "conversation_id": cid})
+    assert response.status_code == 404
+
+
+def test_chat_into_conversation_deleted_during_generation(monkeypatch):
+    import main
+
+    client, uid = _login("tombstone-chatter")
+    cid = database.create_conversation(uid, "生成中被刪")
+
+    async def delete_while_generating(request, conversation_id, model, thread):
+        database.delete_conversation(conversation_id)  # 另一個分頁刪掉了這個會話
+        return "回答", model, None
+
+    monkeypatch.setattr(main, "_generate_reply", delete_while_generating)
+    response = client.post("/chat", data={"user_input": "嗨", "model": "m", "conversation_id": cid})
+    assert response.status_code == 404
+    conn = database.get_connection()
+    count = conn.execute(
+        "SELECT COUNT(*) FROM messages WHERE conversation_id = ?", (cid,)
+    ).fetchone()[0]
+    conn.close()
+    assert count == 0
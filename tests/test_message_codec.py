@@ -0,0 +1,69 @@
+import database
+import message_codec
+from message_codec import CODEC_PLAIN, CODEC_ZLIB
+
+LONG = "```python\ndef main():\n    return load()\n```\n" + "模型回覆的說明文字。" * 80
+
+
+def test_short_text_and_small_savings_stay_plain(monkeypatch):
+    assert message_codec.encode("短訊息") == (CODEC_PLAIN, "短訊息")
+    # 壓縮後要小到原本的 1% 以下才採用：一般內容達不到，維持原文
+    monkeypatch.setattr(message_codec, "MIN_SAVING_RATIO", 0.01)
+    assert message_codec.encode(LONG) == (CODEC_PLAIN, LONG)
+
+
+def test_roundtrip_with_and_without_dictionary():
+    zdict = message_codec.train_dictionary([LONG, LONG + "\n補充"])
+    assert zdict
+    for d in (None, zdict):
+        codec, value = message_codec.encode(LONG, d)
+        assert codec == CODEC_ZLIB and isinstance(value, bytes)
+        assert message_codec.decode(codec, value, d) == LONG
+
+
+def test_dictionary_keeps_only_lines_shared_between_messages():
+    zdict = message_codec.train_dictionary(["共同的一行\n只在第一則", "共同的一行\n只在第二則"])
+    assert b"\xe5\x85\xb1" in zdict  # 「共」
+    assert "只在".encode() not in zdict
+    assert len(message_codec.train_dictionary([LONG] * 3, size=64)) <= 64
+
+
+def test_messages_are_stored_compressed_and_read_back(user_id):
+    cid = database.create_conversation(user_id, "壓縮")
+    before = database.save_message(cid, "model", LONG)
+    database.add_zdict(message_codec.train_dictionary([LONG, LONG]))
+    after = database.save_message(cid, "model", LONG + "！")
+
+    conn = database.get_connection()
+    rows = dict(
+        (mid, (codec, zid))
+        for mid, codec, zid in conn.execute(
+            "SELECT id, codec, zdict_id FROM messages WHERE id IN (?, ?)", (before, after)
+        )
+    )
+    conn.close()
+    assert rows[before] == (CODEC_ZLIB, None)
+    assert rows[after][0] == CODEC_ZLIB and rows[after][1] is not None
+    assert [m["text"] for m in database.load_messages(cid)] == [LONG, LONG + "！"]
+
+
+
+def test_compression_progress_survives_a_restart(user_id, monkeypatch):
+    import maintenance
+
+    cid = database.create_conversation(user_id, "舊訊息")
+    mid = database.save_message(cid, "user", "太短，維持原文")
+    maintenance.compress_messages()
+    assert database.get_compression_progress() >= mid
+
+    # 進度存在資料庫：重新啟動後從記錄處接續，不會從 id 0 重新掃描解碼
+    scanned = []
+    real = maintenance.compress_plain_messages
+
+    def spy(after_id, batch_size=200):
+        scanned.append(after_id)
+        return real(after_id, batch_size)
+
+    monkeypatch.setattr(maintenance, "compress_plain_messages", spy)
+    maintenance.compress_messages()
+    assert scanned[0] >= mid
@@ -0,0 +1,106 @@
+import asyncio
+import sqlite3
+
+import httpx
+
+import database
+
+
+def test_migration_links_legacy_messages_into_a_line():
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE conversations (id INTEGER PRIMARY KEY, title TEXT)")
+    cur.execute(
+        "CREATE TABLE messages (id INTEGER PRIMARY KEY, conversation_id INTEGER, role TEXT, text TEXT)"
+    )
+    cur.executemany("INSERT INTO conversations (id, title) VALUES (?, ?)", [(1, "a"), (2, "b")])
+    cur.executemany(
+        "INSERT INTO messages (id, conversation_id, role, text) VALUES (?, ?, ?, ?)",
+        [(1, 1, "user", "q"), (2, 2, "user", "q"), (3, 1, "model", "a"), (4, 1, "user", "q2")],
+    )
+    database._migrate_message_tree(cur)
+    database._migrate_message_tree(cur)  # 已遷移過就不再動
+
+    parents = dict(cur.execute("SELECT id, parent_id FROM messages").fetchall())
+    assert parents == {1: None, 2: None, 3: 1, 4: 3}
+    leaves = dict(cur.execute("SELECT id, active_leaf_id FROM conversations").fetchall())
+    assert leaves == {1: 4, 2: 2}
+
+
+def test_init_db_is_idempotent():
+    database.init_db()
+    database.init_db()
+
+
+def test_fork_and_switch_branch(user_id):
+    cid = database.create_conversation(user_id, "分支")
+    q = database.save_message(cid, "user", "問")
+    a1 = database.save_message(cid, "model", "答一")
+    a2 = database.save_message(cid, "model", "答二", parent_id=q, fork=True)
+
+    assert [m["id"] for m in database.load_messages(cid)] == [q, a2]
+    assert database.set_active_branch(cid, a1) == a1
+    assert [m["id"] for m in database.load_messages(cid)] == [q, a1]
+
+
+def test_chat_reply_attaches_to_leaf_seen_when_thread_was_built(monkeypatch):
+    import main
+
+    async def no_title(*args):
+        return None
+
+    monkeypatch.setattr(main, "_maybe_generate_title", no_title)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            await client.post("/login", data={"username": "brancher"})
+            uid = database.get_or_create_user("brancher")
+            cid = database.create_conversation(uid, "分支")
+            q = database.save_message(cid, "user", "問")
+            a1 = database.save_message(cid, "model", "答一")
+            a2 = database.save_message(cid, "model", "答二", parent_id=q, fork=True)
+
+            async def switch_while_generating(request, conversation_id, model, thread):
+                # 生成期間使用者切到另一個分支
+                database.set_active_branch(conversation_id, a1)
+                return "新的回答", model, None
+
+            monkeypatch.setattr(main, "_generate_reply", switch_while_generating)
+            response = await client.post(
+                "/chat", data={"user_input": "追問", "model": "m", "conversation_id": cid}
+            )
+            return response, cid, a2
+
+    response, cid, a2 = asyncio.run(scenario())
+    assert response.status_code == 200
+    user_msg, reply = database.load_messages(cid)[-2:]
+    assert user_msg["parent_id"] == a2
+    assert reply["parent_id"] == user_msg["id"]
+
+
+def test_branch_routes_refuse_other_users_conversations(monkeypatch):
+    import main
+    from starlette.testclient import TestClient
+
+    async def must_not_generate(*args):
+        raise AssertionError("不應該替別人的會話呼叫模型")
+
+    monkeypatch.setattr(main, "_generate_reply", must_not_generate)
+    owner = database.get_or_create_user("tree-owner")
+    cid = database.create_conversation(owner, "別人的")
+    q = database.save_message(cid, "user", "問")
+    a1 = database.save_message(cid, "model", "答一")
+    database.save_message(cid, "model", "答二", parent_id=q, fork=True)
+
+    client = TestClient(main.app)
+    client.post("/login", data={"username": "tree-intruder"}, follow_redirects=False)
+    responses = [
+        client.post(f"/conversation/{cid}/messages/{a1}/regenerate", data={"model": "m"}),
+        client.post(
+            f"/conversation/{cid}/messages/{q}/edit", data={"user_input": "改", "model": "m"}
+        ),
+        client.post(f"/conversation/{cid}/branch/{a1}"),
+    ]
+    assert [r.status_code for r in responses] == [404, 404, 404]
+    assert [m["text"] for m in database.load_messages(cid)] == ["問", "答二"]
@@ -0,0 +1,85 @@
+import os
+import time
+
+import pytest
+
+import model_router
+from token_estimate import estimate_tokens
+
+
+@pytest.fixture
+def model():
+    return f"gemini-test-{os.urandom(4).hex()}-flash"
+
+
+def test_estimate_tokens_counts_cjk_per_character():
+    assert estimate_tokens("你好世界") == 4
+    assert estimate_tokens("abcdefgh") == 2
+    assert estimate_tokens("") == 0
+
+
+def test_thread_tokens_mixes_text_and_attachments():
+    contents = [
+        {"role": "user", "parts": [{"text": "你好"}, {"inline_data": {"data": b""}, "text": None}]},
+        {"role": "model", "parts": [{"text": "abcd"}]},
+    ]
+    assert model_router.thread_tokens(contents) == 2 + model_router.NON_TEXT_PART_TOKENS + 1
+
+
+def test_breaker_opens_after_error_rate_and_recovers(model):
+    for _ in range(model_router.MIN_SAMPLES_FOR_OPEN):
+        model_router.observe(model, "chat", "error", 100)
+    assert not model_router.is_healthy(model)
+    assert model_router.is_healthy(model, time.time() + model_router.OPEN_SECONDS + 1)
+
+
+def test_quota_cooldown_doubles_and_resets_on_success(model):
+    model_router.observe(model, "chat", "quota", None)
+    h = model_router._health[model]
+    first = h.quota_until - h.samples[-1][0]
+    model_router.observe(model, "chat", "quota", None)
+    assert h.quota_until - h.samples[-1][0] == first * 2
+    model_router.observe(model, "chat", "ok", 100)
+    assert h.quota_strikes == 0
+
+
+def test_cancelled_calls_do_not_count(model):
+    for _ in range(model_router.MIN_SAMPLES_FOR_OPEN * 2):
+        model_router.observe(model, "chat", "cancelled", None)
+    assert model_router.is_healthy(model)
+    assert model not in model_router._health
+
+
+def test_rank_puts_paused_models_last(model):
+    other = model.replace("flash", "pro")
+    for _ in range(model_router.MIN_SAMPLES_FOR_OPEN):
+        model_router.observe(model, "chat", "error", 100)
+    assert model_router.rank([model, other], 100) == [other, model]
+
+
+def test_generate_auto_fails_over(model):
+    other = model.replace("flash", "pro")
+    calls = []
+
+    def caller(client, m, contents, mode, prompt_tokens):
+        calls.append(m)
+        if m == model:
+            raise RuntimeError("boom")
+        return "ok"
+
+    assert model_router.generate_auto(None, [model, other], [], 10, caller) == ("ok", other)
+    assert calls == [model, other]
+
+
+def test_router_endpoints_require_login():
+    import main
+    from starlette.testclient import TestClient
+
+    anonymous = TestClient(main.app)
+    assert anonymous.get("/api/models/router").status_code == 401
+    assert anonymous.get("/api/models/stats").status_code == 401
+
+    client = TestClient(main.app)
+    client.post("/login", data={"username": "router-viewer"}, follow_redirects=False)
+    assert client.get("/api/models/router").status_code == 200
+    assert client.get("/api/models/stats", params={"hours": 1}).status_code == 200
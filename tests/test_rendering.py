@@ -0,0 +1,96 @@
+import os
+
+import jinja2
+import pytest
+from markupsafe import escape
+
+import rendering
+
+REPLY = "## 標題\n\n**粗體** 與 `code`\n\n```python\nprint('hi')\n```"
+ATTACHMENTS = [
+    {"sha256": "a" * 64, "filename": "photo.png", "mime_type": "image/png"},
+    {"sha256": "b" * 64, "filename": "notes.txt", "mime_type": "text/plain"},
+]
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache():
+    rendering.clear_fragments()
+    yield
+    rendering.clear_fragments()
+
+
+def _msg(mid, role="model", text=REPLY, attachments=(), siblings=()):
+    return {
+        "id": mid,
+        "role": role,
+        "text": text,
+        "attachments": list(attachments),
+        "siblings": list(siblings),
+    }
+
+
+def _fresh_bubble(msg) -> str:
+    """不經過片段快取、直接以模板渲染的泡泡"""
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(rendering.TEMPLATE_DIR), autoescape=True)
+    env.filters["markdown"] = rendering.render_markdown
+    env.globals["message_html"] = lambda m: (
+        escape(m["text"]) if m["role"] == "user" else rendering.render_markdown(m["text"])
+    )
+    return env.get_template("partials/message_bubble.html").render(msg=msg)
+
+
+def test_cached_bubble_matches_a_fresh_render():
+    msg = _msg(9001, attachments=ATTACHMENTS)
+    first = rendering.message_bubble(msg)
+    second = rendering.message_bubble(msg)
+    assert str(first) == str(second) == _fresh_bubble(msg)
+    assert "/attachments/" + "a" * 64 + "/thumb" in first
+    assert "📎 notes.txt" in first and "<h2>" in first
+
+
+def test_second_render_is_served_from_cache(monkeypatch):
+    calls = []
+    real = rendering.render_markdown
+    monkeypatch.setattr(rendering, "render_markdown", lambda text: calls.append(text) or real(text))
+    msg = _msg(9002)
+
+    rendering.message_bubble(msg)
+    rendering.message_bubble(msg)
+    rendering.message_html(msg)
+    assert len(calls) == 1
+
+
+def test_user_text_is_escaped_and_unsaved_messages_are_not_cached():
+    msg = _msg(None, role="user", text="<script>x</script>")
+    assert "&lt;script&gt;" in rendering.message_html(msg)
+    assert rendering._fragments.get(("html", None)) is None
+
+
+def test_branch_data_stays_outside_the_cache():
+    template = rendering.templates.get_template("partials/message_list.html")
+
+    def render(siblings):
+        msg = _msg(9003, siblings=siblings)
+        return template.render(chat_messages=[msg], has_more=False, conversation_id=1)
+
+    assert "branch-nav" not in render([])
+    # 同一則訊息之後多了兄弟分支：泡泡命中快取，分支導覽仍依最新資料渲染
+    assert "2/2" in render([9000, 9003])
+
+
+def test_templates_compile_through_the_bytecode_cache():
+    assert isinstance(rendering.templates.env.bytecode_cache, jinja2.FileSystemBytecodeCache)
+    rendering.templates.env.get_template("partials/message_bubble.html")
+    assert any(name.startswith("__jinja2_") for name in os.listdir(rendering.BYTECODE_CACHE_DIR))
+
+    # 另一個環境（例如重新啟動後）從 bytecode 載入，輸出與原本相同
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(rendering.TEMPLATE_DIR),
+        autoescape=True,
+        bytecode_cache=rendering.templates.env.bytecode_cache,
+    )
+    env.globals.update(rendering.templates.env.globals)
+    msg = _msg(9004, attachments=ATTACHMENTS)
+    expected = rendering.templates.env.get_template("partials/message_bubble.html").render(msg=msg)
+    assert env.get_template("partials/message_bubble.html").render(msg=msg) == expected
@@ -0,0 +1,41 @@
+import database
+import retrieval
+
+
+def test_hash_embedder_is_the_default():
+    assert retrieval.EMBEDDER == "hash"
+    assert isinstance(retrieval.embedder, retrieval.HashingEmbedder)
+
+
+def test_index_pending_resumes_from_saved_progress(user_id, monkeypatch):
+    cid = database.create_conversation(user_id, "索引")
+    database.save_message(cid, "user", "第一則訊息")
+    retrieval.index_pending()
+    mark = database.get_embedding_progress(retrieval.embedder.name)
+    assert mark > 0
+
+    scanned_from = []
+    real_load = retrieval.load_unindexed_messages
+
+    def spy(embedder, after_id, limit):
+        scanned_from.append(after_id)
+        return real_load(embedder, after_id, limit)
+
+    monkeypatch.setattr(retrieval, "load_unindexed_messages", spy)
+    new_mid = database.save_message(cid, "model", "第二則訊息")
+    assert retrieval.index_pending() == 1
+    # 從上次的進度往後掃，不是從 0 開始
+    assert scanned_from[0] == mark
+    assert database.get_embedding_progress(retrieval.embedder.name) == new_mid
+
+
+def test_build_context_pulls_from_other_conversations(user_id):
+    old = database.create_conversation(user_id, "旅行計畫")
+    database.save_message(old, "user", "我下個月要去京都賞楓，預算五萬元")
+    current = database.create_conversation(user_id, "新對話")
+    retrieval.index_pending()
+
+    context = retrieval.build_context(user_id, current, "京都賞楓的預算是多少？")
+    assert context is not None
+    assert "京都賞楓" in context
+    assert retrieval.build_context(user_id, old, "京都賞楓的預算是多少？") is None
@@ -0,0 +1,61 @@
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+import database
+from session_store import ServerSideSessionMiddleware
+
+
+async def _visit(request):
+    request.session["visits"] = request.session.get("visits", 0) + 1
+    return PlainTextResponse(str(request.session["visits"]))
+
+
+async def _login(request):
+    request.session["user_id"] = int(request.query_params["uid"])
+    return PlainTextResponse("ok")
+
+
+async def _logout(request):
+    request.session.clear()
+    return PlainTextResponse("bye")
+
+
+def _client() -> TestClient:
+    app = Starlette(
+        routes=[Route("/visit", _visit), Route("/login", _login), Route("/logout", _logout)]
+    )
+    app.add_middleware(ServerSideSessionMiddleware)
+    return TestClient(app)
+
+
+def test_session_data_is_kept_server_side():
+    client = _client()
+    assert client.get("/visit").text == "1"
+    sid = client.cookies["session"]
+    assert client.get("/visit").text == "2"
+    # cookie 只有 session id，內容在資料庫裡
+    assert client.cookies["session"] == sid
+    assert database.load_session(sid)[0] == {"visits": 2}
+
+
+def test_login_rotates_session_id():
+    client = _client()
+    client.get("/visit")
+    fixed_sid = client.cookies["session"]
+
+    client.get("/login?uid=7")
+    new_sid = client.cookies["session"]
+    assert new_sid != fixed_sid
+    # 預先取得的 session id 登入後就失效
+    assert database.load_session(fixed_sid) is None
+    assert database.load_session(new_sid)[0] == {"visits": 1, "user_id": 7}
+
+
+def test_logout_deletes_session():
+    client = _client()
+    client.get("/login?uid=3")
+    sid = client.cookies["session"]
+    client.get("/logout")
+    assert database.load_session(sid) is None
@@ -0,0 +1,15 @@
+"""
+粗估 token 數。不需要呼叫 count_tokens API，也不依賴其他模組，
+路由、檢索等只需要估算提示長度的地方都可以直接匯入。
+"""
+
+import re
+
+# 中日韓文字（平假名 / 片假名、中日韓統一表意文字、韓文音節）
+CJK_RE = re.compile(r"[぀-ヿ㐀-鿿가-힯]")
+
+
+def estimate_tokens(text: str) -> int:
+    """粗估 token 數：中日韓文字約一字一 token，其餘約四個字元一 token"""
+    cjk = len(CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4